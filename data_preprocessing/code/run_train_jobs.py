@@ -0,0 +1,279 @@
+import argparse
+import glob
+import logging
+import os
+import shlex
+import subprocess
+import sys
+import time
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s")
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+@dataclass
+class Job:
+    run_file: str
+    line: int
+    cmd: str
+    phases: List[str]
+    status: str = "pending"
+    attempts: int = 0
+    seconds: float = 0.0
+    phase_seconds: dict = field(default_factory=dict)
+
+    @property
+    def cwd(self) -> str:
+        return os.path.dirname(os.path.abspath(self.run_file))
+
+    @property
+    def name(self) -> str:
+        return f"{os.path.basename(self.cwd)}.{self.line}"
+
+    @property
+    def log_dir(self) -> Optional[str]:
+        argv = shlex.split(self.cmd)
+        if "--log" not in argv:
+            return None
+        return os.path.join(self.cwd, argv[argv.index("--log") + 1])
+
+    def is_finished(self, phase: str = "train") -> bool:
+        """
+        The phase reached its last output: the final test evaluation of a training with a best checkpoint,
+        or the ROC AUC of a test. The method scripts may exit with code 120 even then, as the loggers close
+        the standard output they tee to.
+        """
+        log_dir = self.log_dir
+        if log_dir is None or not os.path.exists(f"{log_dir}/checkpoints/best.pth"):
+            return False
+        marker = "test_acc1" if phase == "train" else "ROC AUC"
+        for log_file in glob.glob(f"{log_dir}/{phase}-*.txt"):
+            with open(log_file) as f:
+                if any(marker in line for line in f):
+                    return True
+        return False
+
+
+def read_jobs(run_files: List[str], test: bool) -> List[Job]:
+    jobs = []
+    for run_file in run_files:
+        with open(run_file) as f:
+            for i, line in enumerate(f):
+                if line.strip() and not line.startswith("#"):
+                    phases = ["train", "test"] if test else ["train"]
+                    jobs.append(Job(run_file, i + 1, line.strip(), phases))
+    return jobs
+
+
+def split_cores(cores: List[int], num_slots: int) -> List[List[int]]:
+    num_slots = min(num_slots, len(cores))
+    size = len(cores) // num_slots
+    return [cores[i * size : (i + 1) * size] for i in range(num_slots)]
+
+
+def start_phase(
+    job: Job, phase: str, cores: List[int], gpu: Optional[str], workers: int, dir_logs: str
+):
+    cmd = f"{job.cmd} -j {workers}"
+    if phase != "train":
+        cmd += f" --phase {phase}"
+    elif job.attempts > 1:
+        # continue from the training state of the failed attempt
+        cmd += " --resume"
+
+    env = dict(os.environ)
+    # one intra-op thread per core of the slot, DataLoader workers are single-threaded
+    for var in ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"]:
+        env[var] = str(len(cores))
+    if gpu is not None:
+        env["CUDA_VISIBLE_DEVICES"] = gpu
+
+    f_out = open(f"{dir_logs}/{job.name}.{phase}.log", "a")
+    f_out.write(f"# attempt {job.attempts}, cores {cores}: {cmd}\n")
+    f_out.flush()
+    process = subprocess.Popen(
+        cmd,
+        shell=True,
+        cwd=job.cwd,
+        env=env,
+        stdout=f_out,
+        stderr=subprocess.STDOUT,
+        preexec_fn=lambda: os.sched_setaffinity(0, cores),
+    )
+    return process, f_out
+
+
+def run_train_jobs(
+    run_files: List[str],
+    num_slots: int,
+    workers: int,
+    gpus: List[str],
+    retries: int,
+    test: bool,
+    force: bool,
+    dir_logs: str,
+    summary_path: str,
+):
+    os.makedirs(dir_logs, exist_ok=True)
+    jobs = read_jobs(run_files, test)
+    for job in jobs:
+        if not force:
+            # the test of a finished training is still run if it is missing or failed
+            job.phases = [phase for phase in job.phases if not job.is_finished(phase)]
+            if not job.phases:
+                job.status = "skipped"
+    pending = [job for job in jobs if job.status == "pending"]
+    logger.info(
+        f"{len(jobs)} jobs, {len(jobs) - len(pending)} already finished, {num_slots} parallel"
+    )
+
+    slots = split_cores(sorted(os.sched_getaffinity(0)), num_slots)
+    running = {}  # slot -> (job, phase index, process, output file, start time)
+    start = time.time()
+    while pending or running:
+        for slot, cores in enumerate(slots):
+            if slot not in running and pending:
+                job = pending.pop(0)
+                job.attempts += 1
+                gpu = gpus[slot % len(gpus)] if gpus else None
+                process, f_out = start_phase(job, job.phases[0], cores, gpu, workers, dir_logs)
+                running[slot] = (job, 0, process, f_out, time.time())
+
+        time.sleep(1)
+        for slot in list(running):
+            job, phase, process, f_out, phase_start = running[slot]
+            if process.poll() is None:
+                continue
+            f_out.close()
+            elapsed = time.time() - phase_start
+            job.seconds += elapsed
+            # summed over the attempts of the phase
+            job.phase_seconds[job.phases[phase]] = (
+                job.phase_seconds.get(job.phases[phase], 0.0) + elapsed
+            )
+            del running[slot]
+
+            if process.returncode != 0 and not job.is_finished(job.phases[phase]):
+                logger.warning(
+                    f"{job.name} {job.phases[phase]} failed with code {process.returncode} "
+                    f"(attempt {job.attempts} of {retries + 1})"
+                )
+                if job.attempts <= retries:
+                    # retry the failed phase, the completed ones are kept
+                    job.phases = job.phases[phase:]
+                    pending.append(job)
+                else:
+                    job.status = "failed"
+            elif phase + 1 < len(job.phases):
+                gpu = gpus[slot % len(gpus)] if gpus else None
+                process, f_out = start_phase(
+                    job, job.phases[phase + 1], slots[slot], gpu, workers, dir_logs
+                )
+                running[slot] = (job, phase + 1, process, f_out, time.time())
+            else:
+                job.status = "done"
+                logger.info(f"{job.name} done in {job.seconds:.0f} s")
+
+    with open(summary_path, "w") as f_out:
+        f_out.write("job\tstatus\tattempts\ttrain_s\ttest_s\ttotal_s\tlog\n")
+        for job in jobs:
+            f_out.write(
+                f"{job.name}\t{job.status}\t{job.attempts}\t"
+                f"{job.phase_seconds.get('train', 0):.0f}\t{job.phase_seconds.get('test', 0):.0f}\t"
+                f"{job.seconds:.0f}\t{job.log_dir}\n"
+            )
+    failed = sum(job.status == "failed" for job in jobs)
+    logger.info(
+        f"finished in {time.time() - start:.0f} s, {failed} failed, summary in {summary_path}"
+    )
+    return failed
+
+
+def main(args: argparse.Namespace):
+    num_slots = args.jobs or max(1, len(os.sched_getaffinity(0)) // args.cores_per_job)
+    failed = run_train_jobs(
+        args.run_files,
+        num_slots,
+        args.workers,
+        args.gpus,
+        args.retries,
+        not args.no_test,
+        args.force,
+        args.logs_dir,
+        args.summary or f"{args.logs_dir}/summary.tsv",
+    )
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run the commands of train.run files in parallel, each on its own set of cores."
+    )
+    parser.add_argument(
+        "run_files",
+        nargs="+",
+        metavar="PATH",
+        help="train.run files, every command is run from the directory of its file.",
+    )
+    parser.add_argument(
+        "-n",
+        "--jobs",
+        type=int,
+        default=None,
+        help="Number of parallel jobs (default: available cores / --cores-per-job).",
+    )
+    parser.add_argument(
+        "-c",
+        "--cores-per-job",
+        type=int,
+        default=8,
+        help="Cores pinned to every job, also its number of torch threads (default: 8).",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=2,
+        help="DataLoader workers of every job (default: 2).",
+    )
+    parser.add_argument(
+        "-g",
+        "--gpus",
+        nargs="*",
+        default=[],
+        help="GPUs assigned to the jobs round-robin by slot, e.g. 0 1 2 3.",
+    )
+    parser.add_argument(
+        "-r", "--retries", type=int, default=1, help="Retries of a failed job (default: 1)."
+    )
+    parser.add_argument(
+        "--no-test", action="store_true", help="Do not run the test phase after training."
+    )
+    parser.add_argument(
+        "-f",
+        "--force",
+        action="store_true",
+        help="Also rerun the phases whose --log directory holds their finished output.",
+    )
+    parser.add_argument(
+        "-l",
+        "--logs-dir",
+        type=str,
+        default="logs",
+        metavar="PATH",
+        help="Directory for the output of every job (default: logs).",
+    )
+    parser.add_argument(
+        "-s",
+        "--summary",
+        type=str,
+        default=None,
+        metavar="PATH",
+        help="Per-job timing summary (default: <logs-dir>/summary.tsv).",
+    )
+
+    args = parser.parse_args()
+    main(args)
@@ -5,30 +5,20 @@ Note: Our implementation is different from ADDA paper in several respects. We do
 source and target domain, nor fix classifier head. Besides, we do not adopt asymmetric objective loss function
 of the feature extractor.
 """
-import random
-import time
-import warnings
 import copy
 import argparse
-import shutil
-import os.path as osp
 
 import torch
 import torch.nn as nn
-import torch.backends.cudnn as cudnn
 from torch.optim import SGD
 from torch.optim.lr_scheduler import LambdaLR
-from torch.utils.data import DataLoader
 
 import utils
+import engine
 from tllib.alignment.adda import ImageClassifier
 from tllib.alignment.dann import DomainAdversarialLoss
 from tllib.modules.domain_discriminator import DomainDiscriminator
 from tllib.modules.grl import WarmStartGradientReverseLayer
-from tllib.utils.data import ForeverDataIterator
-from tllib.utils.meter import AverageMeter, ProgressMeter
-from tllib.utils.logger import CompleteLogger
-from tllib.utils.analysis import collect_feature, tsne, a_distance
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
@@ -41,202 +31,102 @@ def set_requires_grad(net, requires_grad=False):
         param.requires_grad = requires_grad
 
 
-def main(args: argparse.Namespace):
-    logger = CompleteLogger(args.log, args.phase)
-    print(args)
-
-    if args.seed is not None:
-        random.seed(args.seed)
-        torch.manual_seed(args.seed)
-        cudnn.deterministic = True
-        warnings.warn('You have chosen to seed training. '
-                      'This will turn on the CUDNN deterministic setting, '
-                      'which can slow down your training considerably! '
-                      'You may see unexpected behavior when restarting '
-                      'from checkpoints.')
-
-    cudnn.benchmark = True
-
-    # Data loading code
-    train_source_dataset, train_target_dataset, test_dataset = utils.get_train_datasets(args.source_positive,
-                                                                                        args.source_negative,
-                                                                                        args.target_train,
-                                                                                        dataset_name=args.data_name,
-                                                                                        cache_dir=args.ds_cache)
-    val_dataset = test_dataset
-
-    train_source_loader = DataLoader(train_source_dataset, batch_size=args.batch_size,
-                                     shuffle=True, num_workers=args.workers, drop_last=True)
-    train_target_loader = DataLoader(train_target_dataset, batch_size=args.batch_size,
-                                     shuffle=True, num_workers=args.workers, drop_last=True)
-    val_loader = DataLoader(val_dataset, batch_size=args.batch_size, shuffle=False, num_workers=args.workers)
-    test_loader = DataLoader(test_dataset, batch_size=args.batch_size, shuffle=False, num_workers=args.workers)
-
-    train_source_iter = ForeverDataIterator(train_source_loader)
-    train_target_iter = ForeverDataIterator(train_target_loader)
-
-    num_classes = 2
-
-    # create model
-    print("=> using model '{}'".format(args.arch))
-    backbone = utils.get_model(args.arch)
-    pool_layer = nn.Identity()
-    source_classifier = ImageClassifier(backbone, num_classes, bottleneck_dim=args.bottleneck_dim,
-                                        pool_layer=pool_layer, finetune=not args.scratch).to(device)
+class ADDA(engine.Method):
+    meters = (('Transfer Loss', ':6.2f'), ('Domain Acc', ':3.1f'))
 
-    if args.phase == 'train' and args.pretrain is None:
-        # first pretrain the classifier wish source data
-        print("Pretraining the model on source domain.")
-        args.pretrain = logger.get_checkpoint_path('pretrain')
-        pretrain_model = ImageClassifier(backbone, num_classes, bottleneck_dim=args.bottleneck_dim,
-                                         pool_layer=pool_layer, finetune=not args.scratch).to(device)
-        pretrain_optimizer = SGD(pretrain_model.get_parameters(), args.pretrain_lr, momentum=args.momentum,
-                                 weight_decay=args.weight_decay, nesterov=True)
-        pretrain_lr_scheduler = LambdaLR(pretrain_optimizer,
-                                         lambda x: args.pretrain_lr * (1. + args.lr_gamma * float(x)) ** (
-                                             -args.lr_decay))
-        # start pretraining
-        for epoch in range(args.pretrain_epochs):
-            print("lr:", pretrain_lr_scheduler.get_lr())
-            # pretrain for one epoch
-            utils.empirical_risk_minimization(train_source_iter, pretrain_model, pretrain_optimizer,
-                                              pretrain_lr_scheduler, epoch, args,
-                                              device)
-            # validate to show pretrain process
-            utils.validate(val_loader, pretrain_model, args, device)
+    @staticmethod
+    def uses_source_index(args):
+        return args.feature_bank
 
-        torch.save(pretrain_model.state_dict(), args.pretrain)
-        print("Pretraining process is done.")
+    def __init__(self, args: argparse.Namespace):
+        super().__init__(args)
 
-    if args.phase == 'test' and args.pretrain is None:
-        args.pretrain = logger.get_checkpoint_path('best')
+        # create model
+        print("=> using model '{}'".format(args.arch))
+        backbone = utils.get_model(args.arch)
+        pool_layer = nn.Identity()
+        self.source_classifier = ImageClassifier(backbone, self.num_classes, bottleneck_dim=args.bottleneck_dim,
+                                                 pool_layer=pool_layer, finetune=not args.scratch).to(device)
+        self.classifier = copy.deepcopy(self.source_classifier)
+        utils.compile_modules(args.compile, self.classifier)
 
-    checkpoint = torch.load(args.pretrain, map_location='cpu')
-    source_classifier.load_state_dict(checkpoint)
-    target_classifier = copy.deepcopy(source_classifier)
+    def prepare(self, engine):
+        args = self.args
+        source_classifier, target_classifier = self.source_classifier, self.classifier
+        if args.pretrain is None:
+            # first pretrain the classifier wish source data
+            args.pretrain = engine.source_pretraining()
 
-    # freeze source classifier
-    set_requires_grad(source_classifier, False)
-    source_classifier.freeze_bn()
-
-    domain_discri = DomainDiscriminator(in_feature=source_classifier.features_dim, hidden_size=1024).to(device)
-
-    # define loss function
-    grl = WarmStartGradientReverseLayer(alpha=1., lo=0., hi=2., max_iters=1000, auto_step=True)
-    domain_adv = DomainAdversarialLoss(domain_discri, grl=grl).to(device)
-
-    # define optimizer and lr scheduler
-    # note that we only optimize target feature extractor
-    optimizer = SGD(target_classifier.get_parameters(optimize_head=False) + domain_discri.get_parameters(), args.lr,
-                    momentum=args.momentum, weight_decay=args.weight_decay, nesterov=True)
-    lr_scheduler = LambdaLR(optimizer, lambda x: args.lr * (1. + args.lr_gamma * float(x)) ** (-args.lr_decay))
-
-    # resume from the best checkpoint
-    if args.phase != 'train':
-        checkpoint = torch.load(logger.get_checkpoint_path('best'), map_location='cpu')
+        checkpoint = torch.load(args.pretrain, map_location='cpu')
+        source_classifier.load_state_dict(checkpoint)
         target_classifier.load_state_dict(checkpoint)
 
-    # analysis the model
-    if args.phase == 'analysis':
-        # extract features from both domains
-        feature_extractor = nn.Sequential(target_classifier.backbone, target_classifier.pool_layer,
-                                          target_classifier.bottleneck).to(device)
-        source_feature = collect_feature(train_source_loader, feature_extractor, device)
-        target_feature = collect_feature(train_target_loader, feature_extractor, device)
-        # plot t-SNE
-        tSNE_filename = osp.join(logger.visualize_directory, 'TSNE.pdf')
-        tsne.visualize(source_feature, target_feature, tSNE_filename)
-        print("Saving t-SNE to", tSNE_filename)
-        # calculate A-distance, which is a measure for distribution discrepancy
-        A_distance = a_distance.calculate(source_feature, target_feature, device)
-        print("A-distance =", A_distance)
-        return
-
-    if args.phase == 'test':
-        test_dataset = utils.get_test_dataset(args.target_positive, args.target_negative,
-                                              dataset_name=f"{args.data_name}_test",
-                                              cache_dir=args.ds_cache)
-        test_loader = DataLoader(test_dataset, batch_size=args.batch_size,
-                                 shuffle=True, num_workers=args.workers, drop_last=True)
-
-        acc1 = utils.validate(test_loader, target_classifier, args, device, calc_auc=True)
-        print(acc1)
-        return
-
-    # start training
-    best_acc1 = 0.
-    for epoch in range(args.epochs):
-        print(lr_scheduler.get_lr())
-        # train for one epoch
-        train(train_source_iter, train_target_iter, source_classifier, target_classifier, domain_adv,
-              optimizer, lr_scheduler, epoch, args)
-
-        # evaluate on validation set
-        acc1 = utils.validate(val_loader, target_classifier, args, device)
-
-        # remember best acc@1 and save checkpoint
-        torch.save(target_classifier.state_dict(), logger.get_checkpoint_path('latest'))
-        if acc1 > best_acc1:
-            shutil.copy(logger.get_checkpoint_path('latest'), logger.get_checkpoint_path('best'))
-        best_acc1 = max(acc1, best_acc1)
-
-    print("best_acc1 = {:3.1f}".format(best_acc1))
-
-    # evaluate on test set
-    target_classifier.load_state_dict(torch.load(logger.get_checkpoint_path('best')))
-    acc1 = utils.validate(test_loader, target_classifier, args, device)
-    print("test_acc1 = {:3.1f}".format(acc1))
-
-    logger.close()
-
-
-def train(train_source_iter: ForeverDataIterator, train_target_iter: ForeverDataIterator,
-          source_model: ImageClassifier, target_model: ImageClassifier, domain_adv: DomainAdversarialLoss,
-          optimizer: SGD, lr_scheduler: LambdaLR, epoch: int, args: argparse.Namespace):
-    batch_time = AverageMeter('Time', ':5.2f')
-    data_time = AverageMeter('Data', ':5.2f')
-    losses_transfer = AverageMeter('Transfer Loss', ':6.2f')
-    domain_accs = AverageMeter('Domain Acc', ':3.1f')
-    progress = ProgressMeter(
-        args.iters_per_epoch,
-        [batch_time, data_time, losses_transfer, domain_accs],
-        prefix="Epoch: [{}]".format(epoch))
-
-    # switch to train mode
-    target_model.train()
-    domain_adv.train()
-
-    end = time.time()
-    for i in range(args.iters_per_epoch):
-        x_s, = next(train_source_iter)[:1]
-        x_t, = next(train_target_iter)[:1]
-
-        x_s = x_s.to(device)
-        x_t = x_t.to(device)
-
-        # measure data loading time
-        data_time.update(time.time() - end)
-
-        _, f_s = source_model(x_s)
-        _, f_t = target_model(x_t)
-        loss_transfer = domain_adv(f_s, f_t)
+        # freeze source classifier, whose features are computed without dropout or batch statistics
+        set_requires_grad(source_classifier, False)
+        source_classifier.eval()
+
+        domain_discri = DomainDiscriminator(in_feature=source_classifier.features_dim, hidden_size=1024).to(device)
+
+        # define loss function
+        grl = WarmStartGradientReverseLayer(alpha=1., lo=0., hi=2., max_iters=1000, auto_step=True)
+        self.domain_adv = DomainAdversarialLoss(domain_discri, grl=grl).to(device)
+
+        utils.compile_modules(args.compile, source_classifier, domain_discri)
+
+        self.feature_bank = None
+        if args.feature_bank:
+            self.feature_bank = self.compute_feature_bank(engine.train_source_loader.dataset)
+
+        # define optimizer and lr scheduler
+        # note that we only optimize target feature extractor
+        self.optimizer = SGD(target_classifier.get_parameters(optimize_head=False) + domain_discri.get_parameters(),
+                             args.lr, momentum=args.momentum, weight_decay=args.weight_decay, nesterov=True)
+        self.lr_scheduler = LambdaLR(self.optimizer,
+                                     lambda x: args.lr * (1. + args.lr_gamma * float(x)) ** (-args.lr_decay))
+
+    def source_features(self, x):
+        """Features of the frozen source classifier, the same per iteration and in the feature bank"""
+        classifier = self.source_classifier
+        return classifier.bottleneck(classifier.pool_layer(classifier.backbone(x)))
+
+    def compute_feature_bank(self, dataset):
+        """Features of the frozen source classifier for all samples of the source dataset"""
+        features = []
+        with torch.no_grad():
+            for start in range(0, len(dataset), self.args.batch_size):
+                index = torch.arange(start, min(start + self.args.batch_size, len(dataset)))
+                x = dataset.get_batch(index)[0].to(device)
+                with utils.autocast(device, self.args.amp):
+                    f = self.source_features(x)
+                features.append(f.float())
+        feature_bank = torch.cat(features)
+        print("=> feature bank of {} source samples, {:.1f} MB".format(
+            len(feature_bank), feature_bank.numel() * feature_bank.element_size() / 2 ** 20))
+        return feature_bank
+
+    def modules(self):
+        return [self.classifier, self.domain_adv]
+
+    def train_step(self, x_s, labels_s, x_t, labels_t, index_s=None):
+        with utils.autocast(device, self.args.amp):
+            if self.feature_bank is None:
+                f_s = self.source_features(x_s)
+            _, f_t = self.classifier(x_t)
+        if self.feature_bank is not None:
+            f_s = self.feature_bank.index_select(0, index_s)
+        f_s, f_t = f_s.float(), f_t.float()
+        loss_transfer = self.domain_adv(f_s, f_t)
 
         # Compute gradient and do SGD step
-        optimizer.zero_grad()
+        self.optimizer.zero_grad()
         loss_transfer.backward()
-        optimizer.step()
-        lr_scheduler.step()
-
-        losses_transfer.update(loss_transfer.item(), x_s.size(0))
-        domain_acc = domain_adv.domain_discriminator_accuracy
-        domain_accs.update(domain_acc.item(), x_s.size(0))
+        self.optimizer.step()
+        self.lr_scheduler.step()
+        return {'Transfer Loss': loss_transfer, 'Domain Acc': self.domain_adv.domain_discriminator_accuracy}
 
-        # measure elapsed time
-        batch_time.update(time.time() - end)
-        end = time.time()
 
-        if i % args.print_freq == 0:
-            progress.display(i)
+def main(args: argparse.Namespace):
+    engine.Engine(ADDA, args).run()
 
 
 if __name__ == '__main__':
@@ -256,6 +146,12 @@ if __name__ == '__main__':
                              ' | '.join(utils.get_model_names()))
     parser.add_argument('--pretrain', type=str, default=None,
                         help='pretrain checkpoint for classification model')
+    parser.add_argument('--feature-bank', action='store_true',
+                        help='compute the features of the frozen source classifier once, without dropout, '
+                             'instead of at every iteration')
+    parser.add_argument('--pretrain-cache', type=str, default=None, metavar='PATH',
+                        help='directory of source pretrainings shared by the runs with the same source domain, '
+                             'model, seed and pretraining hyperparameters (default: pretrain in every run)')
     parser.add_argument('--bottleneck-dim', default=256, type=int,
                         help='Dimension of bottleneck')
     parser.add_argument('--no-pool', action='store_true',
@@ -294,5 +190,6 @@ if __name__ == '__main__':
     parser.add_argument("--phase", type=str, default='train', choices=['train', 'test', 'analysis'],
                         help="When phase is 'test', only test the model."
                              "When phase is 'analysis', only analysis the model.")
+    engine.add_arguments(parser)
     args = parser.parse_args()
     main(args)
@@ -2,176 +2,58 @@
 @author: Baixu Chen
 @contact: cbx_99_hasta@outlook.com
 """
-import random
-import time
-import warnings
 import argparse
-import shutil
-import os.path as osp
 
 import torch
 import torch.nn as nn
-import torch.backends.cudnn as cudnn
 from torch.optim import SGD
-from torch.utils.data import DataLoader
 import torch.nn.functional as F
 
 import utils
+import engine
 from tllib.normalization.afn import AdaptiveFeatureNorm, ImageClassifier
 from tllib.modules.entropy import entropy
-from tllib.utils.data import ForeverDataIterator
 from tllib.utils.metric import accuracy
-from tllib.utils.meter import AverageMeter, ProgressMeter
-from tllib.utils.logger import CompleteLogger
-from tllib.utils.analysis import collect_feature, tsne, a_distance
 
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 
-def main(args: argparse.Namespace):
-    logger = CompleteLogger(args.log, args.phase)
-    print(args)
-
-    if args.seed is not None:
-        random.seed(args.seed)
-        torch.manual_seed(args.seed)
-        cudnn.deterministic = True
-        warnings.warn('You have chosen to seed training. '
-                      'This will turn on the CUDNN deterministic setting, '
-                      'which can slow down your training considerably! '
-                      'You may see unexpected behavior when restarting '
-                      'from checkpoints.')
-
-    cudnn.benchmark = True
-
-    # Data loading code
-    train_source_dataset, train_target_dataset, test_dataset = utils.get_train_datasets(args.source_positive,
-                                                                                        args.source_negative,
-                                                                                        args.target_train,
-                                                                                        dataset_name=args.data_name,
-                                                                                        cache_dir=args.ds_cache)
-    val_dataset = test_dataset
-
-    train_source_loader = DataLoader(train_source_dataset, batch_size=args.batch_size,
-                                     shuffle=True, num_workers=args.workers, drop_last=True)
-    train_target_loader = DataLoader(train_target_dataset, batch_size=args.batch_size,
-                                     shuffle=True, num_workers=args.workers, drop_last=True)
-    val_loader = DataLoader(val_dataset, batch_size=args.batch_size, shuffle=False, num_workers=args.workers)
-    test_loader = DataLoader(test_dataset, batch_size=args.batch_size, shuffle=False, num_workers=args.workers)
-
-    train_source_iter = ForeverDataIterator(train_source_loader)
-    train_target_iter = ForeverDataIterator(train_target_loader)
-
-    num_classes = 2
-
-    # create model
-    print("=> using model '{}'".format(args.arch))
-    backbone = utils.get_model(args.arch, )
-    pool_layer = nn.Identity()
-    classifier = ImageClassifier(backbone, num_classes, args.num_blocks,
-                                 bottleneck_dim=args.bottleneck_dim, dropout_p=args.dropout_p,
-                                 pool_layer=pool_layer, finetune=not args.scratch).to(device)
-    adaptive_feature_norm = AdaptiveFeatureNorm(args.delta).to(device)
-
-    # define optimizer
-    # the learning rate is fixed according to origin paper
-    optimizer = SGD(classifier.get_parameters(), args.lr, weight_decay=args.weight_decay)
-
-    # resume from the best checkpoint
-    if args.phase != 'train':
-        checkpoint = torch.load(logger.get_checkpoint_path('best'), map_location='cpu')
-        classifier.load_state_dict(checkpoint)
-
-    # analysis the model
-    if args.phase == 'analysis':
-        # extract features from both domains
-        feature_extractor = nn.Sequential(classifier.backbone, classifier.pool_layer, classifier.bottleneck).to(device)
-        source_feature = collect_feature(train_source_loader, feature_extractor, device)
-        target_feature = collect_feature(train_target_loader, feature_extractor, device)
-        # plot t-SNE
-        tSNE_filename = osp.join(logger.visualize_directory, 'TSNE.pdf')
-        tsne.visualize(source_feature, target_feature, tSNE_filename)
-        print("Saving t-SNE to", tSNE_filename)
-        # calculate A-distance, which is a measure for distribution discrepancy
-        A_distance = a_distance.calculate(source_feature, target_feature, device)
-        print("A-distance =", A_distance)
-        return
-
-    if args.phase == 'test':
-        test_dataset = utils.get_test_dataset(args.target_positive, args.target_negative,
-                                              dataset_name=f"{args.data_name}_test",
-                                              cache_dir=args.ds_cache)
-        test_loader = DataLoader(test_dataset, batch_size=args.batch_size,
-                                 shuffle=True, num_workers=args.workers, drop_last=True)
+class AFN(engine.Method):
+    meters = (('Cls Loss', ':3.2f'), ('Norm Loss', ':3.2f'), ('Source Feature Norm', ':3.2f'),
+              ('Target Feature Norm', ':3.2f'), ('Cls Acc', ':3.1f'))
 
-        acc1 = utils.validate(test_loader, classifier, args, device, calc_auc=True)
-        print(acc1)
-        return
+    def __init__(self, args: argparse.Namespace):
+        super().__init__(args)
 
-    # start training
-    best_acc1 = 0.
-    for epoch in range(args.epochs):
-        # train for one epoch
-        train(train_source_iter, train_target_iter, classifier, adaptive_feature_norm, optimizer, epoch, args)
+        # create model
+        print("=> using model '{}'".format(args.arch))
+        backbone = utils.get_model(args.arch, )
+        pool_layer = nn.Identity()
+        self.classifier = ImageClassifier(backbone, self.num_classes, args.num_blocks,
+                                          bottleneck_dim=args.bottleneck_dim, dropout_p=args.dropout_p,
+                                          pool_layer=pool_layer, finetune=not args.scratch).to(device)
+        self.adaptive_feature_norm = AdaptiveFeatureNorm(args.delta).to(device)
 
-        # evaluate on validation set
-        acc1 = utils.validate(val_loader, classifier, args, device)
+        utils.compile_modules(args.compile, self.classifier)
 
-        # remember best acc@1 and save checkpoint
-        torch.save(classifier.state_dict(), logger.get_checkpoint_path('latest'))
-        if acc1 > best_acc1:
-            shutil.copy(logger.get_checkpoint_path('latest'), logger.get_checkpoint_path('best'))
-        best_acc1 = max(acc1, best_acc1)
+        # define optimizer
+        # the learning rate is fixed according to origin paper
+        self.optimizer = SGD(self.classifier.get_parameters(), args.lr, weight_decay=args.weight_decay)
 
-    print("best_acc1 = {:3.1f}".format(best_acc1))
-
-    # evaluate on test set
-    classifier.load_state_dict(torch.load(logger.get_checkpoint_path('best')))
-    acc1 = utils.validate(test_loader, classifier, args, device)
-    print("test_acc1 = {:3.1f}".format(acc1))
-
-    logger.close()
-
-
-def train(train_source_iter: ForeverDataIterator, train_target_iter: ForeverDataIterator, model: ImageClassifier,
-          adaptive_feature_norm: AdaptiveFeatureNorm, optimizer: SGD, epoch: int, args: argparse.Namespace):
-    batch_time = AverageMeter('Time', ':3.1f')
-    data_time = AverageMeter('Data', ':3.1f')
-    cls_losses = AverageMeter('Cls Loss', ':3.2f')
-    norm_losses = AverageMeter('Norm Loss', ':3.2f')
-    src_feature_norm = AverageMeter('Source Feature Norm', ':3.2f')
-    tgt_feature_norm = AverageMeter('Target Feature Norm', ':3.2f')
-    cls_accs = AverageMeter('Cls Acc', ':3.1f')
-
-    progress = ProgressMeter(
-        args.iters_per_epoch,
-        [batch_time, data_time, cls_losses, norm_losses, src_feature_norm, tgt_feature_norm, cls_accs],
-        prefix="Epoch: [{}]".format(epoch))
-
-    # switch to train mode
-    model.train()
-
-    end = time.time()
-    for i in range(args.iters_per_epoch):
-        x_s, labels_s = next(train_source_iter)[:2]
-        x_t, = next(train_target_iter)[:1]
-
-        x_s = x_s.to(device)
-        x_t = x_t.to(device)
-        labels_s = labels_s.to(device)
-
-        # measure data loading time
-        data_time.update(time.time() - end)
+    def train_step(self, x_s, labels_s, x_t, labels_t):
+        args = self.args
 
         # compute output
-        y_s, f_s = model(x_s)
-        y_t, f_t = model(x_t)
+        with utils.autocast(device, args.amp):
+            y_s, f_s = self.classifier(x_s)
+            y_t, f_t = self.classifier(x_t)
+        y_s, f_s, y_t, f_t = y_s.float(), f_s.float(), y_t.float(), f_t.float()
 
         # classification loss
         cls_loss = F.cross_entropy(y_s, labels_s)
         # norm loss
-        norm_loss = adaptive_feature_norm(f_s) + adaptive_feature_norm(f_t)
+        norm_loss = self.adaptive_feature_norm(f_s) + self.adaptive_feature_norm(f_t)
         loss = cls_loss + norm_loss * args.trade_off_norm
 
         # using entropy minimization
@@ -181,25 +63,19 @@ def train(train_source_iter: ForeverDataIterator, train_target_iter: ForeverData
             loss += entropy_loss * args.trade_off_entropy
 
         # compute gradient and do SGD step
-        optimizer.zero_grad()
+        self.optimizer.zero_grad()
         loss.backward()
-        optimizer.step()
+        self.optimizer.step()
 
         # update statistics
         cls_acc = accuracy(y_s, labels_s)[0]
+        return {'Cls Loss': cls_loss, 'Norm Loss': norm_loss,
+                'Source Feature Norm': f_s.norm(p=2, dim=1).mean(),
+                'Target Feature Norm': f_t.norm(p=2, dim=1).mean(), 'Cls Acc': cls_acc}
 
-        cls_losses.update(cls_loss.item(), x_s.size(0))
-        norm_losses.update(norm_loss.item(), x_s.size(0))
-        src_feature_norm.update(f_s.norm(p=2, dim=1).mean().item(), x_s.size(0))
-        tgt_feature_norm.update(f_t.norm(p=2, dim=1).mean().item(), x_s.size(0))
-        cls_accs.update(cls_acc.item(), x_s.size(0))
 
-        # measure elapsed time
-        batch_time.update(time.time() - end)
-        end = time.time()
-
-        if i % args.print_freq == 0:
-            progress.display(i)
+def main(args: argparse.Namespace):
+    engine.Engine(AFN, args).run()
 
 
 if __name__ == '__main__':
@@ -221,6 +97,16 @@ if __name__ == '__main__':
     parser.add_argument('--no-pool', action='store_true',
                         help='no pool layer after the feature extractor.')
     parser.add_argument('--scratch', action='store_true', help='whether train from scratch.')
+    parser.add_argument('--warm-start', action='store_true',
+                        help='initialize the classifier with a classifier pretrained on the source domain')
+    parser.add_argument('--pretrain-cache', type=str, default=None, metavar='PATH',
+                        help='directory of source pretrainings shared by the runs with the same source domain, '
+                             'model, seed and pretraining hyperparameters (default: pretrain in every run)')
+    parser.add_argument('--pretrain-lr', default=0.001, type=float, help='initial pretrain learning rate')
+    parser.add_argument('--pretrain-epochs', default=3, type=int, metavar='N',
+                        help='number of total epochs (pretrain) to run')
+    parser.add_argument('--lr-gamma', default=0.001, type=float, help='parameter for lr scheduler (pretrain)')
+    parser.add_argument('--lr-decay', default=0.75, type=float, help='parameter for lr scheduler (pretrain)')
     parser.add_argument('-n', '--num-blocks', default=1, type=int, help='Number of basic blocks for classifier')
     parser.add_argument('--bottleneck-dim', default=1000, type=int, help='Dimension of bottleneck')
     parser.add_argument('--dropout-p', default=0.5, type=float,
@@ -258,5 +144,6 @@ if __name__ == '__main__':
     parser.add_argument("--phase", type=str, default='train', choices=['train', 'test', 'analysis'],
                         help="When phase is 'test', only test the model."
                              "When phase is 'analysis', only analysis the model.")
+    engine.add_arguments(parser)
     args = parser.parse_args()
     main(args)
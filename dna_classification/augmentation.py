@@ -0,0 +1,101 @@
+"""
+Random augmentation of batches of one-hot DNA sequences of shape (N, L, 4), in the ``atgc`` order of
+:data:`utils.NUCS`. Every transformation is a few tensor operations on the whole batch, on the device the batch
+is on, and draws its randomness from a generator seeded per training step, so that resumed runs see the same
+views.
+"""
+import random
+
+import torch
+import torch.nn.functional as F
+
+# a <-> t, g <-> c
+COMPLEMENT = [1, 0, 3, 2]
+
+
+def reverse_complement(x):
+    """Reverse complement of the sequences ``x``"""
+    return x[:, :, COMPLEMENT].flip(1)
+
+
+class DNAAugmentation:
+    """
+    Augmentation of a batch of one-hot sequences: every sequence is reverse complemented with probability
+    ``rc_prob`` and shifted by up to ``max_shift`` positions, padded with unknown bases (all-zero rows). Then every
+    known base is mutated to another one with probability ``mutation_rate``, and a random segment of
+    ``mask_ratio`` of every sequence is masked with unknown bases.
+    """
+
+    def __init__(self, rc_prob=0., max_shift=0, mutation_rate=0., mask_ratio=0.):
+        self.rc_prob = rc_prob
+        self.max_shift = max_shift
+        self.mutation_rate = mutation_rate
+        self.mask_ratio = mask_ratio
+
+    def __call__(self, x, generator=None):
+        n, length = x.shape[:2]
+
+        def rand(*size):
+            return torch.rand(size, generator=generator, device=x.device)
+
+        def randint(low, high, *size):
+            return torch.randint(low, high, size, generator=generator, device=x.device)
+
+        if self.rc_prob > 0:
+            x = torch.where((rand(n) < self.rc_prob)[:, None, None], reverse_complement(x), x)
+
+        if self.max_shift > 0:
+            shifts = randint(-self.max_shift, self.max_shift + 1, n)
+            index = torch.arange(length, device=x.device) + (self.max_shift - shifts)[:, None]
+            x = F.pad(x, (0, 0, self.max_shift, self.max_shift)).gather(1, index[:, :, None].expand(-1, -1, 4))
+
+        if self.mutation_rate > 0:
+            mutated = (rand(n, length) < self.mutation_rate) & (x.sum(dim=2) > 0)
+            bases = (x.argmax(dim=2) + randint(1, 4, n, length)) % 4
+            x = torch.where(mutated[:, :, None], F.one_hot(bases, 4).to(x.dtype), x)
+
+        mask_length = round(self.mask_ratio * length)
+        if mask_length > 0:
+            positions = torch.arange(length, device=x.device) - randint(0, length - mask_length + 1, n)[:, None]
+            x = x * ((positions < 0) | (positions >= mask_length))[:, :, None]
+        return x
+
+    def __repr__(self):
+        return '{}(rc_prob={}, max_shift={}, mutation_rate={}, mask_ratio={})'.format(
+            type(self).__name__, self.rc_prob, self.max_shift, self.mutation_rate, self.mask_ratio)
+
+
+class AugmentedIterator:
+    """
+    Data iterator yielding the batches of ``iterator`` as ``((weak(x), strong(x)), labels)``, both views computed
+    on ``device``. The views of a step only depend on ``seed`` and the number of the step.
+    """
+
+    def __init__(self, iterator, weak, strong, seed, device):
+        self.iterator = iterator
+        self.weak = weak
+        self.strong = strong
+        self.seed = seed if seed is not None else random.randrange(2 ** 31)
+        self.step = 0
+        self.device = device
+        self.generator = torch.Generator(device)
+
+    def __next__(self):
+        x, labels = next(self.iterator)[:2]
+        x = x.to(self.device)
+        self.generator.manual_seed((self.seed << 32) + self.step)
+        self.step += 1
+        return (self.weak(x, self.generator), self.strong(x, self.generator)), labels
+
+    def __iter__(self):
+        return self
+
+    def __len__(self):
+        return len(self.iterator)
+
+    def state_dict(self):
+        return {'iterator': self.iterator.state_dict(), 'seed': self.seed, 'step': self.step}
+
+    def load_state_dict(self, state_dict):
+        self.iterator.load_state_dict(state_dict['iterator'])
+        self.seed, self.step = state_dict['seed'], state_dict['step']
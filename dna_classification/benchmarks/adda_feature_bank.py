@@ -0,0 +1,100 @@
+"""
+Check that the feature bank of ``adda.py --feature-bank`` holds the features the frozen source classifier computes
+at every iteration otherwise, for every backbone, then compare the adaptation steps with and without the bank.
+
+    python benchmarks/adda_feature_bank.py
+    python benchmarks/adda_feature_bank.py --check-only
+    python benchmarks/adda_feature_bank.py -a cnn -b 64 -n 50
+"""
+import argparse
+import os.path as osp
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+import torch
+
+sys.path.append(osp.join(osp.dirname(osp.abspath(__file__)), '..'))
+import utils
+import adda
+
+
+def make_method(arch, dataset, args, feature_bank):
+    method_args = argparse.Namespace(arch=arch, bottleneck_dim=256, scratch=False, compile=False, amp=False,
+                                     batch_size=args.batch_size, lr=0.01, lr_gamma=0.0003, lr_decay=0.75,
+                                     momentum=0.9, weight_decay=1e-3, pretrain_cache=None,
+                                     feature_bank=feature_bank)
+    torch.manual_seed(0)
+    method = adda.ADDA(method_args)
+    with tempfile.TemporaryDirectory() as directory:
+        # a random source classifier in place of the pretrained one
+        method_args.pretrain = osp.join(directory, 'pretrain.pth')
+        torch.save(method.source_classifier.state_dict(), method_args.pretrain)
+        method.prepare(SimpleNamespace(train_source_loader=SimpleNamespace(dataset=dataset)))
+    method.train()
+    return method
+
+
+def steps_per_second(method, dataset, target, args):
+    def step(i):
+        index = torch.randint(0, len(dataset), (args.batch_size,))
+        x_s, labels_s, index_s = dataset.get_batch(index)
+        x_t = target[i % len(target)]
+        method.train_step(x_s.to(adda.device), labels_s.to(adda.device), x_t, None, index_s.to(adda.device))
+
+    step(0)
+    start = time.perf_counter()
+    for i in range(args.num_steps):
+        step(i)
+    if adda.device.type == 'cuda':
+        torch.cuda.synchronize()
+    return args.num_steps / (time.perf_counter() - start)
+
+
+def check_feature_bank(arch, dataset, args):
+    """
+    Compare the rows of the bank gathered for random source batches, as with ``--feature-bank``, with the features
+    of the source classifier computed for these batches, as without it
+    """
+    method = make_method(arch, dataset, args, True)
+    with torch.no_grad():
+        for _ in range(4):
+            index = torch.randint(0, len(dataset), (args.batch_size,))
+            x_s, _, index_s = dataset.get_batch(index)
+            f_s = method.source_features(x_s.to(adda.device)).float()
+            torch.testing.assert_close(method.feature_bank.index_select(0, index_s.to(adda.device)), f_s)
+
+
+def main(args: argparse.Namespace):
+    torch.manual_seed(0)
+    source = utils.SeqDataset(torch.eye(4)[torch.randint(0, 4, (args.num_samples, args.length))],
+                              torch.randint(0, 2, (args.num_samples,)))
+    dataset = utils.IndexedDataset(source)
+    target = [torch.eye(4)[torch.randint(0, 4, (args.batch_size, args.length))].to(adda.device) for _ in range(8)]
+
+    archs = args.arch or utils.get_model_names()
+    for arch in archs:
+        check_feature_bank(arch, dataset, args)
+    print("feature bank matches the source features of: " + ", ".join(archs))
+    if args.check_only:
+        return
+
+    print(f"{'arch':<8} {'forward, it/s':>14} {'bank, it/s':>11} {'speedup':>8}")
+    for arch in archs:
+        forward = steps_per_second(make_method(arch, dataset, args, False), dataset, target, args)
+        bank = steps_per_second(make_method(arch, dataset, args, True), dataset, target, args)
+        print(f"{arch:<8} {forward:>14.2f} {bank:>11.2f} {bank / forward:>7.2f}x")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the feature bank of ADDA')
+    parser.add_argument('-a', '--arch', nargs='*', choices=utils.get_model_names(),
+                        help='backbones to benchmark (default: all)')
+    parser.add_argument('-b', '--batch-size', default=32, type=int, help='mini-batch size per domain (default: 32)')
+    parser.add_argument('--length', default=1000, type=int, help='sequence length (default: 1000)')
+    parser.add_argument('--num-samples', default=512, type=int, help='number of source samples (default: 512)')
+    parser.add_argument('-n', '--num-steps', default=10, type=int, help='number of timed steps')
+    parser.add_argument('--check-only', action='store_true', help='only check the feature bank, without timing')
+    args = parser.parse_args()
+    main(args)
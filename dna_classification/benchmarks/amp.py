@@ -0,0 +1,46 @@
+"""
+Compare the fp32 training steps of every method script with its bfloat16 autocast steps of the ``--amp`` mode,
+on the backbone of the runs. The steps are the ``train_step`` of the methods, built by the engine of the scripts
+from their command line options.
+
+    python benchmarks/amp.py
+    python benchmarks/amp.py -m dann mdd -a cnn -b 64 -n 50
+"""
+import argparse
+import os.path as osp
+import sys
+import tempfile
+
+sys.path.append(osp.join(osp.dirname(osp.abspath(__file__)), '..'))
+import utils
+from method_steps import METHODS, RUN_OPTIONS, write_fasta, method_options, build_engine, time_steps
+
+
+def main(args: argparse.Namespace):
+    with tempfile.TemporaryDirectory() as directory:
+        data_options = write_fasta(directory, args.length, args.num_records)
+        options = data_options + RUN_OPTIONS + ['-a', args.arch, '-c', osp.join(directory, 'cache')]
+
+        print(f"{'method':<10} {'fp32, it/s':>11} {'bf16, it/s':>11} {'speedup':>8}")
+        for method in args.methods or METHODS:
+            speed = []
+            for amp in ([], ['--amp']):
+                log = ['--log', osp.join(directory, method + ''.join(amp))]
+                method_engine = build_engine(method, options + method_options(method, args.batch_size) + log + amp)
+                speed.append(time_steps(method_engine, args.num_steps)[1])
+            fp32, bf16 = speed
+            print(f"{method:<10} {fp32:>11.2f} {bf16:>11.2f} {bf16 / fp32:>7.2f}x")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark bfloat16 autocast training steps')
+    parser.add_argument('-m', '--methods', nargs='*', choices=METHODS, help='methods to benchmark (default: all)')
+    parser.add_argument('-a', '--arch', default='hybrid', choices=utils.get_model_names(),
+                        help='backbone of the methods (default: hybrid, as in the runs)')
+    parser.add_argument('-b', '--batch-size', default=32, type=int, help='mini-batch size per domain (default: 32)')
+    parser.add_argument('--length', default=1000, type=int, help='sequence length (default: 1000)')
+    parser.add_argument('--num-records', default=256, type=int,
+                        help='number of sequences of every random FASTA file (default: 256)')
+    parser.add_argument('-n', '--num-steps', default=20, type=int, help='number of timed steps')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,87 @@
+"""
+Compare the time training waits for the checkpoints written at the end of an epoch: ``latest`` and ``best``
+written with ``torch.save`` and a copy, against the CPU snapshot handed to the background writer of the
+engine and a hard link for ``best``. The checkpoint holds the classifier and its SGD momentum, as the training
+state of the methods does.
+
+    python benchmarks/checkpoint.py
+    python benchmarks/checkpoint.py -a hybrid -n 5 -d /scratch/tmp
+"""
+import argparse
+import os.path as osp
+import shutil
+import sys
+import tempfile
+import time
+
+import torch
+import torch.nn.functional as F
+
+sys.path.append(osp.join(osp.dirname(osp.abspath(__file__)), '..'))
+import utils
+import engine
+from method_steps import make_classifier
+
+
+def training_state(arch, device):
+    model = make_classifier(arch).to(device)
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.01, momentum=0.9)
+    x = torch.eye(4)[torch.randint(0, 4, (8, 1000))].to(device)
+    loss = F.cross_entropy(model(x), torch.randint(0, 2, (8,), device=device))
+    loss.backward()
+    optimizer.step()
+    return {'model': model.state_dict(), 'optimizer': optimizer.state_dict()}
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def save_copy(state, directory):
+    start = time.perf_counter()
+    torch.save(state, osp.join(directory, 'latest.pth'))
+    shutil.copy(osp.join(directory, 'latest.pth'), osp.join(directory, 'best.pth'))
+    return time.perf_counter() - start
+
+
+def save_background(state, directory, device, writer):
+    """Time training waits, then time until the files are written"""
+    start = time.perf_counter()
+    snapshot = engine.cpu_snapshot(state)
+    synchronize(device)
+    writer.save(snapshot, osp.join(directory, 'latest.pth'))
+    writer.link(osp.join(directory, 'latest.pth'), osp.join(directory, 'best.pth'))
+    blocking = time.perf_counter() - start
+    writer.wait()
+    return blocking, time.perf_counter() - start
+
+
+def main(args: argparse.Namespace):
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    writer = engine.CheckpointWriter()
+    print(f"{'arch':<8} {'size, MB':>9} {'save+copy, s':>13} {'snapshot, s':>12} {'written, s':>11}")
+    for arch in args.arch or utils.get_model_names():
+        state = training_state(arch, device)
+        with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+            save_copy(state, directory)
+            sync = min(save_copy(state, directory) for _ in range(args.repeat))
+            save_background(state, directory, device, writer)
+            background = min(save_background(state, directory, device, writer) for _ in range(args.repeat))
+            size = osp.getsize(osp.join(directory, 'latest.pth')) / 2 ** 20
+            loaded = torch.load(osp.join(directory, 'best.pth'), map_location='cpu')
+            assert all(torch.equal(loaded['model'][key].cpu(), value.cpu()) for key, value in state['model'].items())
+        print(f"{arch:<8} {size:>9.1f} {sync:>13.3f} {background[0]:>12.3f} {background[1]:>11.3f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the checkpoint writes of an epoch')
+    parser.add_argument('-a', '--arch', nargs='*', choices=utils.get_model_names(),
+                        help='backbones to benchmark (default: all)')
+    parser.add_argument('-n', '--repeat', default=3, type=int, help='number of timed writes')
+    parser.add_argument('-d', '--dir', default=None, help='directory of the checkpoints (default: temporary)')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu',
+                        help='device of the model (default: cuda if available)')
+    args = parser.parse_args()
+    main(args)
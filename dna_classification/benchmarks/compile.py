@@ -0,0 +1,61 @@
+"""
+Compare the eager training steps of every method script with its steps in the ``--compile`` mode, on the backbone
+of the runs: the time of the first steps, which compile the graphs, the steady-state iterations per second, and the
+number of graphs and graph breaks of the compiled steps. The steps are the ``train_step`` of the methods, built by
+the engine of the scripts from their command line options. The graphs of a method are compiled anew, but may be
+loaded from the on-disk caches of inductor filled by earlier runs.
+
+    python benchmarks/compile.py
+    python benchmarks/compile.py -m dann mdd -a cnn --amp
+"""
+import argparse
+import os.path as osp
+import sys
+import tempfile
+
+import torch._dynamo
+from torch._dynamo.utils import counters
+
+sys.path.append(osp.join(osp.dirname(osp.abspath(__file__)), '..'))
+import utils
+from method_steps import METHODS, RUN_OPTIONS, write_fasta, method_options, build_engine, time_steps
+
+
+def main(args: argparse.Namespace):
+    with tempfile.TemporaryDirectory() as directory:
+        data_options = write_fasta(directory, args.length, args.num_records)
+        options = data_options + RUN_OPTIONS + ['-a', args.arch, '-c', osp.join(directory, 'cache')]
+        if args.amp:
+            options.append('--amp')
+
+        print(f"{'method':<10} {'eager warm-up, s':>17} {'eager, it/s':>12} {'compile warm-up, s':>19} "
+              f"{'compiled, it/s':>15} {'speedup':>8} {'graphs':>7} {'breaks':>7}")
+        for method in args.methods or METHODS:
+            results = []
+            for compile in ([], ['--compile']):
+                torch._dynamo.reset()
+                counters.clear()
+                log = ['--log', osp.join(directory, method + ''.join(compile))]
+                method_engine = build_engine(method, options + method_options(method, args.batch_size) + log + compile)
+                results.append(time_steps(method_engine, args.num_steps, args.warmup_steps))
+            (eager_warmup, eager), (compiled_warmup, compiled) = results
+            graphs = counters['stats']['unique_graphs']
+            breaks = sum(counters['graph_break'].values())
+            print(f"{method:<10} {eager_warmup:>17.2f} {eager:>12.2f} {compiled_warmup:>19.2f} "
+                  f"{compiled:>15.2f} {compiled / eager:>7.2f}x {graphs:>7} {breaks:>7}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark torch.compile training steps')
+    parser.add_argument('-m', '--methods', nargs='*', choices=METHODS, help='methods to benchmark (default: all)')
+    parser.add_argument('-a', '--arch', default='hybrid', choices=utils.get_model_names(),
+                        help='backbone of the methods (default: hybrid, as in the runs)')
+    parser.add_argument('-b', '--batch-size', default=32, type=int, help='mini-batch size per domain (default: 32)')
+    parser.add_argument('--length', default=1000, type=int, help='sequence length (default: 1000)')
+    parser.add_argument('--num-records', default=256, type=int,
+                        help='number of sequences of every random FASTA file (default: 256)')
+    parser.add_argument('--amp', action='store_true', help='also use bfloat16 autocast')
+    parser.add_argument('-w', '--warmup-steps', default=2, type=int, help='number of warm-up steps')
+    parser.add_argument('-n', '--num-steps', default=20, type=int, help='number of timed steps')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,105 @@
+"""
+Compare the time spent waiting for a batch (the ``Data`` meter of the training scripts) with the per-item
+DataLoader, with the batched loader of utils.get_data_loader and with the in-process utils.DeviceDataIterator,
+along with the time to the first batch, which includes starting the loader workers.
+
+    python benchmarks/data_loading.py                     # every *.fa under data/
+    python benchmarks/data_loading.py --synthetic 50000 -j 2 --packed
+"""
+import argparse
+import glob
+import os.path as osp
+import sys
+import time
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+sys.path.append(osp.join(osp.dirname(osp.abspath(__file__)), '..'))
+import utils
+
+DATA_DIR = osp.join(osp.dirname(osp.abspath(__file__)), '..', '..', 'data')
+
+
+def synthetic_onehot(num, length, seed=0):
+    rng = np.random.default_rng(seed)
+    return np.eye(4, dtype=np.int8)[rng.integers(0, 4, size=(num, length))]
+
+
+def per_item_loader(dataset, batch_size, num_workers):
+    return DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers, drop_last=True,
+                      collate_fn=dataset.collate_fn)
+
+
+def batched_loader(dataset, batch_size, num_workers):
+    return utils.get_data_loader(dataset, batch_size, shuffle=True, num_workers=num_workers, drop_last=True)
+
+
+def data_time(make_iter, num_batches, device):
+    """Time to the first batch and mean time per batch afterwards, with the batch moved to ``device``."""
+    start = time.perf_counter()
+    it = make_iter()
+    next(it)[0].to(device)
+    first = time.perf_counter() - start
+    num_batches = min(num_batches, len(it) - 1)
+    start = time.perf_counter()
+    for _ in range(num_batches):
+        next(it)[0].to(device)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return first, (time.perf_counter() - start) / num_batches
+
+
+def check_batches(dataset, batch_size):
+    index = torch.randperm(len(dataset))[:batch_size].tolist()
+    x, y = dataset[index]
+    x_ref, y_ref = dataset.collate_fn([dataset[i] for i in index])
+    if not (torch.equal(x, x_ref) and torch.equal(y, y_ref)):
+        raise AssertionError("batched fetch differs from the per-item one")
+
+
+def benchmark(name, data, args):
+    cls = utils.PackedSeqDataset if args.packed else utils.SeqDataset
+    half = len(data) // 2
+    dataset = utils.ConcatSeqDataset([cls(data[:half]), cls(data[half:])],
+                                     labels=np.arange(len(data)) % 2).subset(np.arange(len(data)))
+    check_batches(dataset, args.batch_size)
+
+    device = torch.device(args.device)
+    times = [
+        data_time(lambda: iter(per_item_loader(dataset, args.batch_size, args.workers)), args.num_batches, device),
+        data_time(lambda: iter(batched_loader(dataset, args.batch_size, args.workers)), args.num_batches, device),
+        data_time(lambda: utils.DeviceDataIterator(dataset, args.batch_size, device), args.num_batches, device),
+    ]
+    print(f"{name:<40} {len(data):>8} " + " ".join(f"{first * 1e3:>9.1f} {mean * 1e3:>8.3f}" for first, mean in times))
+
+
+def main(args: argparse.Namespace):
+    torch.set_num_threads(1)
+    print(f"{'':<40} {'':>8} {'per item':^18} {'batched loader':^18} {'device feeder':^18}")
+    print(f"{'data':<40} {'records':>8} " + " ".join([f"{'first, ms':>9} {'mean, ms':>8}"] * 3))
+    if args.synthetic:
+        benchmark(f"synthetic {args.synthetic}x{args.length}", synthetic_onehot(args.synthetic, args.length), args)
+        return
+
+    paths = args.fasta or sorted(glob.glob(osp.join(DATA_DIR, '*', '*.fa')))
+    if not paths:
+        print(f"No FASTA files found under {osp.normpath(DATA_DIR)}, pass them explicitly or use --synthetic.")
+    for path in paths:
+        benchmark(osp.basename(path), utils.read_fasta(path), args)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark per-item and batched data loading')
+    parser.add_argument('fasta', nargs='*', help='FASTA files (default: every *.fa under data/)')
+    parser.add_argument('--synthetic', default=0, type=int, help='use this many random sequences instead')
+    parser.add_argument('--length', default=1000, type=int, help='length of the synthetic sequences')
+    parser.add_argument('--packed', action='store_true', help='use 2-bit packed datasets')
+    parser.add_argument('-b', '--batch-size', default=32, type=int, help='mini-batch size (default: 32)')
+    parser.add_argument('-j', '--workers', default=0, type=int, help='number of data loading workers (default: 0)')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu',
+                        help='device the batches are moved to (default: cuda if available)')
+    parser.add_argument('-n', '--num-batches', default=200, type=int, help='number of timed batches')
+    args = parser.parse_args()
+    main(args)
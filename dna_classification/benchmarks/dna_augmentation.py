@@ -0,0 +1,77 @@
+"""
+Compare the batched :class:`augmentation.DNAAugmentation` of ``fixmatch.py`` with the same augmentation applied
+to one sequence at a time, as a per-sample dataset transform would, and check the transformations: the reverse
+complement is an involution, unknown bases are never mutated into known ones, and the views of a step only depend
+on its seed.
+
+    python benchmarks/dna_augmentation.py
+    python benchmarks/dna_augmentation.py -b 256 --length 2000 --device cuda
+"""
+import argparse
+import os.path as osp
+import sys
+import time
+
+import torch
+
+sys.path.append(osp.join(osp.dirname(osp.abspath(__file__)), '..'))
+from augmentation import DNAAugmentation, reverse_complement
+
+
+def sequences_per_second(augment, x, device, num_steps):
+    generator = torch.Generator(device)
+    augment(x, generator)
+    start = time.perf_counter()
+    for step in range(num_steps):
+        generator.manual_seed(step)
+        augment(x, generator)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return num_steps * x.size(0) / (time.perf_counter() - start)
+
+
+def check(strong, x, device):
+    assert torch.equal(reverse_complement(reverse_complement(x)), x)
+    # 'aattg' -> 'caatt'
+    seq = torch.eye(4, device=device)[torch.tensor([[0, 0, 1, 1, 2]], device=device)]
+    assert reverse_complement(seq).argmax(dim=2).tolist() == [[3, 0, 0, 1, 1]]
+
+    generator = torch.Generator(device)
+    generator.manual_seed(0)
+    view = strong(x, generator)
+    generator.manual_seed(0)
+    assert torch.equal(view, strong(x, generator))
+    assert view.shape == x.shape and view.sum(dim=2).max() <= 1
+
+    unknown = torch.zeros_like(x)
+    assert torch.equal(DNAAugmentation(mutation_rate=1.)(unknown, generator), unknown)
+    mutated = DNAAugmentation(mutation_rate=1.)(x, generator)
+    assert not (mutated.argmax(dim=2) == x.argmax(dim=2))[x.sum(dim=2) > 0].any()
+
+
+def main(args: argparse.Namespace):
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    x = torch.eye(4)[torch.randint(0, 4, (args.batch_size, args.length))].to(device)
+    weak = DNAAugmentation(0.5, 10)
+    strong = DNAAugmentation(0.5, 10, 0.05, 0.1)
+    check(strong, x, device)
+
+    print(f"{'view':<8} {'per sample, seq/s':>18} {'batched, seq/s':>15} {'speedup':>8}")
+    for name, augment in (('weak', weak), ('strong', strong)):
+        batched = sequences_per_second(augment, x, device, args.num_steps)
+        per_sample = sequences_per_second(
+            lambda x, generator: torch.cat([augment(x[i:i + 1], generator) for i in range(x.size(0))]),
+            x, device, args.num_steps)
+        print(f"{name:<8} {per_sample:>18.0f} {batched:>15.0f} {batched / per_sample:>7.2f}x")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the batched augmentation of DNA sequences')
+    parser.add_argument('-b', '--batch-size', default=32, type=int, help='mini-batch size (default: 32)')
+    parser.add_argument('--length', default=1000, type=int, help='sequence length (default: 1000)')
+    parser.add_argument('-n', '--num-steps', default=20, type=int, help='number of timed steps')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu',
+                        help='device to augment on (default: cuda if available)')
+    args = parser.parse_args()
+    main(args)
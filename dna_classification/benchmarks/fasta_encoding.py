@@ -0,0 +1,85 @@
+"""
+Compare the per-record Bio.SeqIO one-hot encoder with the lookup-table encoder used by utils.read_fasta,
+both in a single process and sharded over worker processes.
+
+    python benchmarks/fasta_encoding.py                   # every *.fa under data/
+    python benchmarks/fasta_encoding.py a.fa b.fa -r 3 -w 32
+"""
+import argparse
+import functools
+import glob
+import os.path as osp
+import sys
+import time
+
+import numpy as np
+from Bio import SeqIO
+
+sys.path.append(osp.join(osp.dirname(osp.abspath(__file__)), '..'))
+import utils
+
+DATA_DIR = osp.join(osp.dirname(osp.abspath(__file__)), '..', '..', 'data')
+
+
+def read_fasta_reference(path: str):
+    with open(path) as f:
+        num_lines = sum(1 for line in f)
+
+    data = None
+    cur_ind = 0
+    for record in SeqIO.parse(path, "fasta"):
+        if data is None:
+            data = np.zeros((num_lines, len(record), 4), dtype=np.int8)
+        seq = record.seq.lower()
+        if len(seq) != data.shape[1]:
+            continue
+        if "n" in seq:
+            continue
+        utils.onehot_seq(seq, data, cur_ind)
+        cur_ind += 1
+    return data[:cur_ind]
+
+
+def best_time(fn, path, repeat):
+    best, result = float('inf'), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(path)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main(args: argparse.Namespace):
+    paths = args.fasta or sorted(glob.glob(osp.join(DATA_DIR, '*', '*.fa')))
+    if not paths:
+        print(f"No FASTA files found under {osp.normpath(DATA_DIR)}, pass them explicitly.")
+        return
+
+    serial = functools.partial(utils.read_fasta, num_workers=1)
+    parallel = functools.partial(utils.read_fasta, num_workers=args.workers)
+
+    rows = []
+    for path in paths:
+        t_ref, ref = best_time(read_fasta_reference, path, args.repeat)
+        t_lut, lut = best_time(serial, path, args.repeat)
+        t_par, par = best_time(parallel, path, args.repeat)
+        for out in (lut, par):
+            if ref.dtype != out.dtype or not np.array_equal(ref, out):
+                raise AssertionError(f"encoders disagree on {path}")
+        rows.append((osp.basename(path), lut.shape[0], t_ref, t_lut, t_par))
+    rows.append(('total', '', *(sum(row[i] for row in rows) for i in range(2, 5))))
+
+    print(f"{'file':<60} {'records':>8} {'reference, s':>13} {'lut, s':>8} "
+          f"{f'lut x{args.workers}, s':>12} {'speedup':>8}")
+    for name, records, t_ref, t_lut, t_par in rows:
+        print(f"{name:<60} {records:>8} {t_ref:>13.3f} {t_lut:>8.3f} {t_par:>12.3f} {t_ref / t_par:>7.1f}x")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark FASTA one-hot encoding')
+    parser.add_argument('fasta', nargs='*', help='FASTA files (default: every *.fa under data/)')
+    parser.add_argument('-r', '--repeat', default=1, type=int, help='number of timed runs per file')
+    parser.add_argument('-w', '--workers', default=utils.available_cores(), type=int,
+                        help='processes for the sharded encoder (default: all available cores)')
+    args = parser.parse_args()
+    main(args)
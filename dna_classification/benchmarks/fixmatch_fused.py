@@ -0,0 +1,93 @@
+"""
+Compare the training steps of ``fixmatch.py``, which run the weak target, source and strong target batches through
+the model in three forward passes and two backward passes, against its ``--fused-forward`` steps with both
+``--bn-mode``, and against a single forward and backward pass of a batch as large as the three. With the ``split``
+batch normalization, the fused steps must leave the model as the separate passes do, up to the order of floating
+point sums, for the backbones without dropout.
+
+    python benchmarks/fixmatch_fused.py
+    python benchmarks/fixmatch_fused.py -a cnn -b 64 -n 50
+"""
+import argparse
+import os.path as osp
+import sys
+import time
+
+import torch
+import torch.nn.functional as F
+
+sys.path.append(osp.join(osp.dirname(osp.abspath(__file__)), '..'))
+import utils
+import fixmatch
+
+
+def make_method(arch, args, **options):
+    method_args = argparse.Namespace(arch=arch, bottleneck_dim=args.bottleneck_dim, scratch=False, compile=False,
+                                     amp=False, lr=0.003, lr_gamma=0.0004, lr_decay=0.75, momentum=0.9,
+                                     weight_decay=1e-3, threshold=0.9, trade_off=1., fused_forward=False,
+                                     bn_mode='split')
+    vars(method_args).update(options)
+    torch.manual_seed(0)
+    method = fixmatch.FixMatch(method_args)
+    method.train()
+    return method
+
+
+def timed(step, num_steps):
+    step()
+    start = time.perf_counter()
+    for _ in range(num_steps):
+        step()
+    if fixmatch.device.type == 'cuda':
+        torch.cuda.synchronize()
+    return num_steps / (time.perf_counter() - start)
+
+
+def main(args: argparse.Namespace):
+    torch.manual_seed(0)
+    x_s, x_t, x_t_strong = (torch.eye(4)[torch.randint(0, 4, (args.batch_size, args.length))].to(fixmatch.device)
+                            for _ in range(3))
+    labels_s, labels_t = (torch.randint(0, 2, (args.batch_size,), device=fixmatch.device) for _ in range(2))
+
+    def method_step(method):
+        return lambda: method.train_step(x_s, labels_s, (x_t, x_t_strong), labels_t)
+
+    print(f"{'arch':<8} {'3 passes, it/s':>15} {'split, it/s':>12} {'speedup':>8} {'joint, it/s':>12} "
+          f"{'speedup':>8} {'1 batch, it/s':>14}")
+    for arch in args.arch or utils.get_model_names():
+        reference_method = make_method(arch, args)
+        reference = timed(method_step(reference_method), args.num_steps)
+        split_method = make_method(arch, args, fused_forward=True)
+        split = timed(method_step(split_method), args.num_steps)
+        if not any(isinstance(module, torch.nn.Dropout) for module in split_method.classifier.modules()):
+            reference_state = reference_method.classifier.state_dict()
+            for name, tensor in split_method.classifier.state_dict().items():
+                assert torch.allclose(tensor.float(), reference_state[name].float(), rtol=1e-3, atol=1e-4), name
+        joint = timed(method_step(make_method(arch, args, fused_forward=True, bn_mode='joint')), args.num_steps)
+
+        # lower bound: the three batches as one plain classification batch
+        model = make_method(arch, args).classifier
+        optimizer = torch.optim.SGD(model.parameters(), lr=0.003, momentum=0.9)
+        x, labels = torch.cat((x_t, x_s, x_t_strong)), torch.cat((labels_t, labels_s, labels_t))
+
+        def batch_step():
+            optimizer.zero_grad()
+            F.cross_entropy(model(x), labels).backward()
+            optimizer.step()
+
+        batch = timed(batch_step, args.num_steps)
+        print(f"{arch:<8} {reference:>15.2f} {split:>12.2f} {split / reference:>7.2f}x {joint:>12.2f} "
+              f"{joint / reference:>7.2f}x {batch:>14.2f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the fused forward pass of FixMatch')
+    parser.add_argument('-a', '--arch', nargs='*', choices=utils.get_model_names(),
+                        help='backbones to benchmark (default: all)')
+    parser.add_argument('-b', '--batch-size', default=32, type=int,
+                        help='mini-batch size of each of the three batches (default: 32)')
+    parser.add_argument('--length', default=1000, type=int, help='sequence length (default: 1000)')
+    parser.add_argument('--bottleneck-dim', default=1024, type=int, help='dimension of bottleneck (default: 1024)')
+    parser.add_argument('-n', '--num-steps', default=10, type=int, help='number of timed steps')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,71 @@
+"""
+Compare the training steps of ``mcd.py`` with ``--reference-steps``, which build the autograd graph of every
+forward pass, against its default steps, which run the generator of step B without graph and compute no gradient
+of the classifier parameters in step C, and against ``--reuse-features``, which trains the classifiers of step B
+on the features of step A. The default steps must leave the networks as the reference ones do.
+
+    python benchmarks/mcd_steps.py
+    python benchmarks/mcd_steps.py -a cnn -b 64 -n 20 -k 1 4 8
+"""
+import argparse
+import os.path as osp
+import sys
+import time
+
+import torch
+
+sys.path.append(osp.join(osp.dirname(osp.abspath(__file__)), '..'))
+import utils
+import mcd
+
+
+def train(arch, num_k, x_s, labels_s, x_t, args, **steps):
+    method_args = argparse.Namespace(arch=arch, bottleneck_dim=args.bottleneck_dim, compile=False, amp=False,
+                                     lr=0.01, momentum=0.9, weight_decay=5e-4, trade_off=1.,
+                                     trade_off_entropy=0.01, num_k=num_k, reference_steps=False,
+                                     reuse_features=False)
+    vars(method_args).update(steps)
+    torch.manual_seed(0)
+    method = mcd.MCD(method_args)
+    method.train()
+    method.train_step(x_s, labels_s, x_t, None)
+    start = time.perf_counter()
+    for _ in range(args.num_steps):
+        method.train_step(x_s, labels_s, x_t, None)
+    if mcd.device.type == 'cuda':
+        torch.cuda.synchronize()
+    return args.num_steps / (time.perf_counter() - start), method.state_dict()
+
+
+def main(args: argparse.Namespace):
+    torch.manual_seed(0)
+    x_s, x_t = (torch.eye(4)[torch.randint(0, 4, (args.batch_size, args.length))].to(mcd.device)
+                for _ in range(2))
+    labels_s = torch.randint(0, 2, (args.batch_size,), device=mcd.device)
+
+    print(f"{'arch':<8} {'num_k':>5} {'reference, it/s':>16} {'default, it/s':>14} {'speedup':>8} "
+          f"{'reuse, it/s':>12} {'speedup':>8}")
+    for arch in args.arch or utils.get_model_names():
+        for num_k in args.num_k:
+            reference, reference_state = train(arch, num_k, x_s, labels_s, x_t, args, reference_steps=True)
+            default, state = train(arch, num_k, x_s, labels_s, x_t, args)
+            for network in state:
+                for name, tensor in state[network].items():
+                    assert torch.equal(tensor, reference_state[network][name]), (network, name)
+            reuse, _ = train(arch, num_k, x_s, labels_s, x_t, args, reuse_features=True)
+            print(f"{arch:<8} {num_k:>5} {reference:>16.2f} {default:>14.2f} {default / reference:>7.2f}x "
+                  f"{reuse:>12.2f} {reuse / reference:>7.2f}x")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the training steps of MCD')
+    parser.add_argument('-a', '--arch', nargs='*', choices=utils.get_model_names(),
+                        help='backbones to benchmark (default: all)')
+    parser.add_argument('-k', '--num-k', nargs='+', default=[1, 2, 4], type=int,
+                        help='numbers of generator updates per step (default: 1 2 4)')
+    parser.add_argument('-b', '--batch-size', default=32, type=int, help='mini-batch size per domain (default: 32)')
+    parser.add_argument('--length', default=1000, type=int, help='sequence length (default: 1000)')
+    parser.add_argument('--bottleneck-dim', default=1024, type=int, help='width of the heads (default: 1024)')
+    parser.add_argument('-n', '--num-steps', default=5, type=int, help='number of timed steps')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,79 @@
+"""
+Compare training steps which update their meters with ``.item()``, waiting for the device at every iteration,
+against the :class:`utils.DeviceAverageMeter` of the method scripts, which are read back every ``--print-freq``
+iterations. A step is the forward and backward pass of a batch through backbone, bottleneck and head followed by
+an SGD update, and records the loss, the accuracy and the mean confidence, as the methods record 2 to 5 values.
+The printed meters of both versions must be the same.
+
+    python benchmarks/meters.py
+    python benchmarks/meters.py -a cnn -b 64 -n 200
+"""
+import argparse
+import copy
+import os.path as osp
+import sys
+import time
+
+import torch
+import torch.nn.functional as F
+
+sys.path.append(osp.join(osp.dirname(osp.abspath(__file__)), '..'))
+import utils
+from method_steps import make_classifier
+from tllib.utils.meter import AverageMeter
+from tllib.utils.metric import accuracy
+
+
+def train(model, x, labels, device, meter_cls, num_steps, print_freq):
+    torch.manual_seed(0)
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.01, momentum=0.9)
+    meters = [meter_cls(name, ':3.2f') for name in ('Loss', 'Cls Acc', 'Confidence')]
+    lines = []
+    start = time.perf_counter()
+    for i in range(num_steps):
+        y = model(x)
+        loss = F.cross_entropy(y, labels)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        values = (loss, accuracy(y, labels)[0], F.softmax(y.detach(), dim=1).max(dim=1)[0].mean())
+        for meter, value in zip(meters, values):
+            meter.update(value.item() if meter_cls is AverageMeter else value, x.size(0))
+        if i % print_freq == 0:
+            lines.append('\t'.join(str(meter) for meter in meters))
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return num_steps / (time.perf_counter() - start), lines
+
+
+def main(args: argparse.Namespace):
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    x = torch.eye(4)[torch.randint(0, 4, (args.batch_size, args.length))].to(device)
+    labels = torch.randint(0, 2, (args.batch_size,), device=device)
+
+    print(f"{'arch':<8} {'.item(), it/s':>14} {'device, it/s':>13} {'speedup':>8}")
+    for arch in args.arch or utils.get_model_names():
+        model = make_classifier(arch).to(device)
+        train(copy.deepcopy(model), x, labels, device, AverageMeter, 2, args.print_freq)
+        item, item_lines = train(copy.deepcopy(model), x, labels, device, AverageMeter, args.num_steps,
+                                 args.print_freq)
+        dev, dev_lines = train(copy.deepcopy(model), x, labels, device, utils.DeviceAverageMeter, args.num_steps,
+                               args.print_freq)
+        assert item_lines == dev_lines, (item_lines, dev_lines)
+        print(f"{arch:<8} {item:>14.2f} {dev:>13.2f} {dev / item:>7.2f}x")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark meter updates without device synchronization')
+    parser.add_argument('-a', '--arch', nargs='*', choices=utils.get_model_names(),
+                        help='backbones to benchmark (default: all)')
+    parser.add_argument('-b', '--batch-size', default=32, type=int, help='mini-batch size (default: 32)')
+    parser.add_argument('--length', default=1000, type=int, help='sequence length (default: 1000)')
+    parser.add_argument('-n', '--num-steps', default=100, type=int, help='number of timed steps')
+    parser.add_argument('-p', '--print-freq', default=100, type=int,
+                        help='iterations between displays of the meters (default: 100)')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu',
+                        help='device to train on (default: cuda if available)')
+    args = parser.parse_args()
+    main(args)
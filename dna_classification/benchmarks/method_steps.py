@@ -0,0 +1,109 @@
+"""
+Training steps of the method scripts as they are run: the engine of ``python <method>.py <options>`` is built from
+the command line options, on random FASTA files, and the ``train_step`` of its method is timed on batches drawn by
+the engine. Shared by the benchmarks of the options of the engine, e.g. benchmarks/amp.py.
+"""
+import os
+import os.path as osp
+import runpy
+import sys
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+SCRIPT_DIR = osp.join(osp.dirname(osp.abspath(__file__)), '..')
+sys.path.append(SCRIPT_DIR)
+import utils
+import engine
+from run_methods import KeepOpen
+
+METHODS = ('adda', 'afn', 'bsp', 'cdan', 'dan', 'dann', 'fixmatch', 'jan', 'mcc', 'mcd', 'mdd', 'src_only')
+# model options of the commands of the job files, see data_preprocessing/code/generate_training_scripts.py
+RUN_OPTIONS = ['--scratch', '--bottleneck-dim', '256']
+
+
+def make_classifier(arch, bottleneck_dim=256, num_classes=2):
+    """Backbone, bottleneck and head of a classifier, without the method around them"""
+    backbone = utils.get_model(arch)
+    return nn.Sequential(
+        backbone,
+        nn.Linear(backbone.out_features, bottleneck_dim),
+        nn.BatchNorm1d(bottleneck_dim),
+        nn.ReLU(),
+        nn.Linear(bottleneck_dim, num_classes),
+    )
+
+
+def write_fasta(directory, length, num_records, seed=0):
+    """Files of ``num_records`` random sequences of ``length`` bases for the dataset options of the scripts"""
+    rng = np.random.default_rng(seed)
+    options = []
+    for option in ('--source-positive', '--source-negative', '--target-train', '--target-positive',
+                   '--target-negative'):
+        path = osp.join(directory, option.lstrip('-') + '.fa')
+        bases = np.array(list('acgt'))[rng.integers(0, 4, (num_records, length))]
+        with open(path, 'w') as f:
+            for i, sequence in enumerate(bases):
+                f.write('>chr1:{}-{}\n{}\n'.format(i * length, (i + 1) * length, ''.join(sequence)))
+        options += [option, path]
+    return options
+
+
+def method_options(method, batch_size):
+    """Options every command of ``method`` needs for the benchmarks"""
+    options = ['-b', str(batch_size), '-j', '0', '--seed', '0']
+    if method in ('adda', 'bsp'):
+        # an untrained source classifier is as fast to adapt as a pretrained one
+        options += ['--pretrain-epochs', '0']
+    if method == 'fixmatch':
+        options += ['-ub', str(batch_size)]
+    return options
+
+
+class FileLogger(engine.CompleteLogger):
+    """Logger of the engines of the benchmarks, which writes the output of the scripts to their log file only"""
+
+    def __init__(self, root, phase='train'):
+        super().__init__(root, phase)
+        self.logger.terminal = KeepOpen(open(os.devnull, 'w'))
+
+
+def build_engine(method, options):
+    """Engine of ``python <method>.py <options>``, with its method prepared for training as in ``Engine.run``"""
+    script = osp.join(SCRIPT_DIR, method + '.py')
+    engines = []
+    run, logger, stdout, stderr, argv = engine.Engine.run, engine.CompleteLogger, sys.stdout, sys.stderr, sys.argv
+    engine.Engine.run = lambda self: engines.append(self)
+    engine.CompleteLogger = FileLogger
+    sys.argv = [script] + options
+    try:
+        runpy.run_path(script, run_name='__main__')
+        engines[0].method.prepare(engines[0])
+        engines[0].logger.close()
+    finally:
+        engine.Engine.run, engine.CompleteLogger = run, logger
+        sys.stdout, sys.stderr, sys.argv = stdout, stderr, argv
+    return engines[0]
+
+
+def time_steps(method_engine, num_steps, warmup_steps=1):
+    """
+    Time of the ``warmup_steps`` first training steps of the method of ``method_engine``, and training steps per
+    second after them. The batches are drawn beforehand, so that only the steps are timed.
+    """
+    method = method_engine.method
+    method.train()
+    batches = [method_engine.next_batch(method) for _ in range(warmup_steps + num_steps)]
+
+    def elapsed(batches):
+        start = time.perf_counter()
+        for inputs, kwargs in batches:
+            method.train_step(*inputs, **kwargs)
+        if engine.device.type == 'cuda':
+            torch.cuda.synchronize()
+        return time.perf_counter() - start
+
+    warmup = elapsed(batches[:warmup_steps])
+    return warmup, num_steps / elapsed(batches[warmup_steps:])
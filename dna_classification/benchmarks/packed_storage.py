@@ -0,0 +1,83 @@
+"""
+Check that PackedSeqDataset round-trips the one-hot encoding of SeqDataset and compare their memory footprint
+and per-batch cost.
+
+    python benchmarks/packed_storage.py                   # every *.fa under data/
+    python benchmarks/packed_storage.py --synthetic 50000
+"""
+import argparse
+import glob
+import os.path as osp
+import sys
+import time
+
+import numpy as np
+import torch
+
+sys.path.append(osp.join(osp.dirname(osp.abspath(__file__)), '..'))
+import utils
+
+DATA_DIR = osp.join(osp.dirname(osp.abspath(__file__)), '..', '..', 'data')
+
+
+def synthetic_onehot(num, length, ambiguous_rate=0.001, seed=0):
+    rng = np.random.default_rng(seed)
+    data = np.eye(4, dtype=np.int8)[rng.integers(0, 4, size=(num, length))]
+    data[rng.random((num, length)) < ambiguous_rate] = 0
+    return data
+
+
+def dataset_bytes(dataset):
+    return sum(t.numel() * t.element_size() for t in vars(dataset).values() if isinstance(t, torch.Tensor))
+
+
+def batches_per_second(dataset, batch_size, num_batches=200):
+    loader = utils.get_data_loader(dataset, batch_size=batch_size, shuffle=True, drop_last=True)
+    it = iter(loader)
+    start = time.perf_counter()
+    for _ in range(min(num_batches, len(loader))):
+        next(it)
+    return min(num_batches, len(loader)) / (time.perf_counter() - start)
+
+
+def check_round_trip(name, data, batch_size):
+    labels = np.arange(len(data)) % 2
+    onehot = utils.SeqDataset(data, labels)
+    packed = utils.PackedSeqDataset(data, labels)
+
+    for start in range(0, len(data), 4096):
+        index = range(start, min(start + 4096, len(data)))
+        x, y = onehot.collate_fn([onehot[i] for i in index])
+        x_packed, y_packed = packed.collate_fn([packed[i] for i in index])
+        if not (torch.equal(x, x_packed) and torch.equal(y, y_packed)):
+            raise AssertionError(f"packed round trip differs on {name}, rows {start}..{index[-1]}")
+
+    onehot_bytes, packed_bytes = dataset_bytes(onehot), dataset_bytes(packed)
+    print(f"{name:<60} {len(data):>8} {onehot_bytes / 2 ** 20:>11.1f} {packed_bytes / 2 ** 20:>11.1f} "
+          f"{onehot_bytes / packed_bytes:>6.1f}x {batches_per_second(onehot, batch_size):>10.0f} "
+          f"{batches_per_second(packed, batch_size):>10.0f}")
+
+
+def main(args: argparse.Namespace):
+    print(f"{'data':<60} {'records':>8} {'onehot, MB':>11} {'packed, MB':>11} {'ratio':>7} "
+          f"{'onehot b/s':>10} {'packed b/s':>10}")
+    if args.synthetic:
+        check_round_trip(f"synthetic {args.synthetic}x{args.length}",
+                         synthetic_onehot(args.synthetic, args.length), args.batch_size)
+        return
+
+    paths = args.fasta or sorted(glob.glob(osp.join(DATA_DIR, '*', '*.fa')))
+    if not paths:
+        print(f"No FASTA files found under {osp.normpath(DATA_DIR)}, pass them explicitly or use --synthetic.")
+    for path in paths:
+        check_round_trip(osp.basename(path), utils.read_fasta(path), args.batch_size)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Round-trip check and benchmark of 2-bit packed sequences')
+    parser.add_argument('fasta', nargs='*', help='FASTA files (default: every *.fa under data/)')
+    parser.add_argument('--synthetic', default=0, type=int, help='use this many random sequences instead')
+    parser.add_argument('--length', default=1000, type=int, help='length of the synthetic sequences')
+    parser.add_argument('-b', '--batch-size', default=32, type=int, help='mini-batch size (default: 32)')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,101 @@
+"""
+Compare the training throughput of N separate models, trained one after another on the same batches, with
+an ``ensemble.Ensemble`` of N replicas trained at once as with ``src_only.py --ensemble N``, for the backbones
+without recurrent layers. The throughput is in replica steps per second. The replicas must end up with the
+parameters of the separate models, up to floating point reassociation.
+
+    python benchmarks/seed_ensemble.py
+    python benchmarks/seed_ensemble.py -a cnn -r 2 4 8 -b 64
+"""
+import argparse
+import copy
+import os.path as osp
+import sys
+import time
+
+import torch
+import torch.nn.functional as F
+
+sys.path.append(osp.join(osp.dirname(osp.abspath(__file__)), '..'))
+import utils
+import ensemble
+from method_steps import make_classifier
+
+# backbones the ensemble can run
+ARCHS = [arch for arch in utils.get_model_names() if not ensemble.recurrent(utils.get_model(arch))]
+
+
+def sgd(params):
+    return torch.optim.SGD(params, lr=0.01, momentum=0.9, weight_decay=1e-3, nesterov=True)
+
+
+def train_separate(models, x, labels, num_steps):
+    optimizers = [sgd(model.parameters()) for model in models]
+    start = time.perf_counter()
+    for _ in range(num_steps):
+        for model, optimizer in zip(models, optimizers):
+            loss = F.cross_entropy(model(x), labels)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+    return len(models) * num_steps / (time.perf_counter() - start)
+
+
+def train_ensemble(models, x, labels, num_steps):
+    model = ensemble.Ensemble(models)
+    optimizer = sgd(model.param_groups(models[0], [{'params': models[0].parameters()}]))
+    start = time.perf_counter()
+    for _ in range(num_steps):
+        y = model(x)
+        loss = F.cross_entropy(y.flatten(0, 1), labels.repeat(len(model)), reduction='none').view(len(model), -1)
+        optimizer.zero_grad()
+        loss.mean(dim=1).sum().backward()
+        optimizer.step()
+    return len(models) * num_steps / (time.perf_counter() - start), model
+
+
+def parameter_difference(models, model):
+    """Largest difference between the parameters and buffers of the separate models and of the replicas"""
+    return max((value.float() - models[k].state_dict()[name].float()).abs().max().item()
+               for k in range(len(models)) for name, value in model.replica_state_dict(k).items())
+
+
+def main(args: argparse.Namespace):
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    x = torch.eye(4)[torch.randint(0, 4, (args.batch_size, args.length))].to(device)
+    labels = torch.randint(0, 2, (args.batch_size,), device=device)
+
+    print(f"{'arch':<8} {'replicas':>8} {'separate, it/s':>15} {'ensemble, it/s':>15} {'speedup':>8} {'diff':>9}")
+    for arch in args.arch or ARCHS:
+        for num_replicas in args.replicas:
+            models = []
+            for seed in range(num_replicas):
+                torch.manual_seed(seed)
+                # without dropout, whose masks differ between both versions
+                models.append(make_classifier(arch).to(device))
+                for module in models[-1].modules():
+                    if isinstance(module, torch.nn.Dropout):
+                        module.p = 0.
+            separate_models = copy.deepcopy(models)
+            separate = train_separate(separate_models, x, labels, args.num_steps)
+            ensembled, model = train_ensemble(models, x, labels, args.num_steps)
+            diff = parameter_difference(separate_models, model)
+            assert diff < 1e-3, diff
+            print(f"{arch:<8} {num_replicas:>8} {separate:>15.2f} {ensembled:>15.2f} {ensembled / separate:>7.2f}x "
+                  f"{diff:>9.2e}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the training of an ensemble of seeds')
+    parser.add_argument('-a', '--arch', nargs='*', choices=ARCHS,
+                        help='backbones to benchmark (default: all of them)')
+    parser.add_argument('-r', '--replicas', nargs='*', default=[4], type=int,
+                        help='numbers of replicas (default: 4)')
+    parser.add_argument('-b', '--batch-size', default=32, type=int, help='mini-batch size (default: 32)')
+    parser.add_argument('--length', default=1000, type=int, help='sequence length (default: 1000)')
+    parser.add_argument('-n', '--num-steps', default=5, type=int, help='number of timed steps')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu',
+                        help='device to train on (default: cuda if available)')
+    args = parser.parse_args()
+    main(args)
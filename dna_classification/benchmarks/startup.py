@@ -0,0 +1,58 @@
+"""
+Measure the startup time of the method scripts, i.e. the wall-clock time of ``python <script> --help``, and
+list the packages that are slowest to import.
+
+    python benchmarks/startup.py                          # dann.py
+    python benchmarks/startup.py dann.py mcd.py -r 10
+"""
+import argparse
+import os.path as osp
+import re
+import subprocess
+import sys
+import time
+
+METHODS_DIR = osp.join(osp.dirname(osp.abspath(__file__)), '..')
+
+
+def run(script, *options):
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, *options, script, '--help'], cwd=METHODS_DIR,
+                            capture_output=True, text=True)
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(f"{script} --help failed:\n{result.stderr}")
+    return elapsed, result.stderr
+
+
+def slowest_imports(script, top):
+    """Top-level packages sorted by the total time spent importing their modules, from ``python -X importtime``"""
+    _, log = run(script, '-X', 'importtime')
+    packages = {}
+    for line in log.splitlines():
+        match = re.match(r'import time:\s+(\d+) \|\s+\d+ \| *(\S+)', line)
+        if match:
+            package = match.group(2).split('.')[0]
+            packages[package] = packages.get(package, 0) + int(match.group(1)) / 1e6
+    return sorted(((seconds, package) for package, seconds in packages.items()), reverse=True)[:top]
+
+
+def main(args: argparse.Namespace):
+    print(f"{'script':<16} {'min, s':>7} {'mean, s':>8}")
+    for script in args.scripts:
+        run(script)  # warm up the file system cache
+        times = [run(script)[0] for _ in range(args.repeat)]
+        print(f"{script:<16} {min(times):>7.2f} {sum(times) / len(times):>8.2f}")
+        if args.imports:
+            for seconds, package in slowest_imports(script, args.imports):
+                print(f"    {package:<28} {seconds:>6.2f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the startup time of the method scripts')
+    parser.add_argument('scripts', nargs='*', default=['dann.py'], help='method scripts (default: dann.py)')
+    parser.add_argument('-r', '--repeat', default=5, type=int, help='number of timed runs per script')
+    parser.add_argument('--imports', default=10, type=int, metavar='N',
+                        help='list the N slowest imported packages, 0 to disable (default: 10)')
+    args = parser.parse_args()
+    main(args)
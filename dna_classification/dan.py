@@ -2,197 +2,76 @@
 @author: Junguang Jiang
 @contact: JiangJunguang1123@outlook.com
 """
-import random
-import time
-import warnings
 import argparse
-import shutil
-import os.path as osp
 
 import torch
 import torch.nn as nn
-import torch.backends.cudnn as cudnn
 from torch.optim import SGD
 from torch.optim.lr_scheduler import LambdaLR
-from torch.utils.data import DataLoader
 import torch.nn.functional as F
 
 import utils
+import engine
 from tllib.alignment.dan import MultipleKernelMaximumMeanDiscrepancy, ImageClassifier
 from tllib.modules.kernels import GaussianKernel
-from tllib.utils.data import ForeverDataIterator
 from tllib.utils.metric import accuracy
-from tllib.utils.meter import AverageMeter, ProgressMeter
-from tllib.utils.logger import CompleteLogger
-from tllib.utils.analysis import collect_feature, tsne, a_distance
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 
-def main(args: argparse.Namespace):
-    logger = CompleteLogger(args.log, args.phase)
-    print(args)
-
-    if args.seed is not None:
-        random.seed(args.seed)
-        torch.manual_seed(args.seed)
-        cudnn.deterministic = True
-        warnings.warn('You have chosen to seed training. '
-                      'This will turn on the CUDNN deterministic setting, '
-                      'which can slow down your training considerably! '
-                      'You may see unexpected behavior when restarting '
-                      'from checkpoints.')
-
-    cudnn.benchmark = True
-
-    # Data loading code
-    train_source_dataset, train_target_dataset, test_dataset = utils.get_train_datasets(args.source_positive,
-                                                                                        args.source_negative,
-                                                                                        args.target_train,
-                                                                                        dataset_name=args.data_name,
-                                                                                        cache_dir=args.ds_cache)
-    val_dataset = test_dataset
-
-    train_source_loader = DataLoader(train_source_dataset, batch_size=args.batch_size,
-                                     shuffle=True, num_workers=args.workers, drop_last=True)
-    train_target_loader = DataLoader(train_target_dataset, batch_size=args.batch_size,
-                                     shuffle=True, num_workers=args.workers, drop_last=True)
-    val_loader = DataLoader(val_dataset, batch_size=args.batch_size, shuffle=False, num_workers=args.workers)
-    test_loader = DataLoader(test_dataset, batch_size=args.batch_size, shuffle=False, num_workers=args.workers)
-
-    train_source_iter = ForeverDataIterator(train_source_loader)
-    train_target_iter = ForeverDataIterator(train_target_loader)
-
-    num_classes = 2
-
-    # create model
-    print("=> using model '{}'".format(args.arch))
-    backbone = utils.get_model(args.arch)
-    pool_layer = nn.Identity()
-    classifier = ImageClassifier(backbone, num_classes, bottleneck_dim=args.bottleneck_dim,
-                                 pool_layer=pool_layer, finetune=not args.scratch).to(device)
-
-    # define optimizer and lr scheduler
-    optimizer = SGD(classifier.get_parameters(), args.lr, momentum=args.momentum, weight_decay=args.wd, nesterov=True)
-    lr_scheduler = LambdaLR(optimizer, lambda x: args.lr * (1. + args.lr_gamma * float(x)) ** (-args.lr_decay))
-
-    # define loss function
-    mkmmd_loss = MultipleKernelMaximumMeanDiscrepancy(
-        kernels=[GaussianKernel(alpha=2 ** k) for k in range(-3, 2)],
-        linear=not args.non_linear
-    )
-
-    # resume from the best checkpoint
-    if args.phase != 'train':
-        checkpoint = torch.load(logger.get_checkpoint_path('best'), map_location='cpu')
-        classifier.load_state_dict(checkpoint)
-
-    # analysis the model
-    if args.phase == 'analysis':
-        # extract features from both domains
-        feature_extractor = nn.Sequential(classifier.backbone, classifier.pool_layer, classifier.bottleneck).to(device)
-        source_feature = collect_feature(train_source_loader, feature_extractor, device)
-        target_feature = collect_feature(train_target_loader, feature_extractor, device)
-        # plot t-SNE
-        tSNE_filename = osp.join(logger.visualize_directory, 'TSNE.pdf')
-        tsne.visualize(source_feature, target_feature, tSNE_filename)
-        print("Saving t-SNE to", tSNE_filename)
-        # calculate A-distance, which is a measure for distribution discrepancy
-        A_distance = a_distance.calculate(source_feature, target_feature, device)
-        print("A-distance =", A_distance)
-        return
-
-    if args.phase == 'test':
-        test_dataset = utils.get_test_dataset(args.target_positive, args.target_negative,
-                                              dataset_name=f"{args.data_name}_test",
-                                              cache_dir=args.ds_cache)
-        test_loader = DataLoader(test_dataset, batch_size=args.batch_size,
-                                 shuffle=True, num_workers=args.workers, drop_last=True)
-        acc1 = utils.validate(test_loader, classifier, args, device, calc_auc=True)
-        print(acc1)
-        return
-
-    # start training
-    best_acc1 = 0.
-    for epoch in range(args.epochs):
-        # train for one epoch
-        train(train_source_iter, train_target_iter, classifier, mkmmd_loss, optimizer,
-              lr_scheduler, epoch, args)
-
-        # evaluate on validation set
-        acc1 = utils.validate(val_loader, classifier, args, device)
-
-        # remember best acc@1 and save checkpoint
-        torch.save(classifier.state_dict(), logger.get_checkpoint_path('latest'))
-        if acc1 > best_acc1:
-            shutil.copy(logger.get_checkpoint_path('latest'), logger.get_checkpoint_path('best'))
-        best_acc1 = max(acc1, best_acc1)
-
-    print("best_acc1 = {:3.1f}".format(best_acc1))
-
-    # evaluate on test set
-    classifier.load_state_dict(torch.load(logger.get_checkpoint_path('best')))
-    acc1 = utils.validate(test_loader, classifier, args, device)
-    print("test_acc1 = {:3.1f}".format(acc1))
-
-    logger.close()
-
-
-def train(train_source_iter: ForeverDataIterator, train_target_iter: ForeverDataIterator, model: ImageClassifier,
-          mkmmd_loss: MultipleKernelMaximumMeanDiscrepancy, optimizer: SGD,
-          lr_scheduler: LambdaLR, epoch: int, args: argparse.Namespace):
-    batch_time = AverageMeter('Time', ':4.2f')
-    data_time = AverageMeter('Data', ':3.1f')
-    losses = AverageMeter('Loss', ':3.2f')
-    trans_losses = AverageMeter('Trans Loss', ':5.4f')
-    cls_accs = AverageMeter('Cls Acc', ':3.1f')
-
-    progress = ProgressMeter(
-        args.iters_per_epoch,
-        [batch_time, data_time, losses, trans_losses, cls_accs],
-        prefix="Epoch: [{}]".format(epoch))
-
-    # switch to train mode
-    model.train()
-    mkmmd_loss.train()
-
-    end = time.time()
-    for i in range(args.iters_per_epoch):
-        x_s, labels_s = next(train_source_iter)[:2]
-        x_t, = next(train_target_iter)[:1]
-        x_s = x_s.to(device)
-        x_t = x_t.to(device)
-        labels_s = labels_s.to(device)
-
-        # measure data loading time
-        data_time.update(time.time() - end)
+class DAN(engine.Method):
+    meters = (('Loss', ':3.2f'), ('Trans Loss', ':5.4f'), ('Cls Acc', ':3.1f'))
+
+    def __init__(self, args: argparse.Namespace):
+        super().__init__(args)
+
+        # create model
+        print("=> using model '{}'".format(args.arch))
+        backbone = utils.get_model(args.arch)
+        pool_layer = nn.Identity()
+        self.classifier = ImageClassifier(backbone, self.num_classes, bottleneck_dim=args.bottleneck_dim,
+                                          pool_layer=pool_layer, finetune=not args.scratch).to(device)
+
+        utils.compile_modules(args.compile, self.classifier)
+
+        # define optimizer and lr scheduler
+        self.optimizer = SGD(self.classifier.get_parameters(), args.lr, momentum=args.momentum,
+                             weight_decay=args.wd, nesterov=True)
+        self.lr_scheduler = LambdaLR(self.optimizer,
+                                     lambda x: args.lr * (1. + args.lr_gamma * float(x)) ** (-args.lr_decay))
 
+        # define loss function
+        self.mkmmd_loss = MultipleKernelMaximumMeanDiscrepancy(
+            kernels=[GaussianKernel(alpha=2 ** k) for k in range(-3, 2)],
+            linear=not args.non_linear
+        )
+
+    def modules(self):
+        return [self.classifier, self.mkmmd_loss]
+
+    def train_step(self, x_s, labels_s, x_t, labels_t):
         # compute output
-        y_s, f_s = model(x_s)
-        y_t, f_t = model(x_t)
+        with utils.autocast(device, self.args.amp):
+            y_s, f_s = self.classifier(x_s)
+            y_t, f_t = self.classifier(x_t)
+        y_s, f_s, y_t, f_t = y_s.float(), f_s.float(), y_t.float(), f_t.float()
 
         cls_loss = F.cross_entropy(y_s, labels_s)
-        transfer_loss = mkmmd_loss(f_s, f_t)
-        loss = cls_loss + transfer_loss * args.trade_off
+        transfer_loss = self.mkmmd_loss(f_s, f_t)
+        loss = cls_loss + transfer_loss * self.args.trade_off
 
         cls_acc = accuracy(y_s, labels_s)[0]
 
-        losses.update(loss.item(), x_s.size(0))
-        cls_accs.update(cls_acc.item(), x_s.size(0))
-        trans_losses.update(transfer_loss.item(), x_s.size(0))
-
         # compute gradient and do SGD step
-        optimizer.zero_grad()
+        self.optimizer.zero_grad()
         loss.backward()
-        optimizer.step()
-        lr_scheduler.step()
+        self.optimizer.step()
+        self.lr_scheduler.step()
+        return {'Loss': loss, 'Trans Loss': transfer_loss, 'Cls Acc': cls_acc}
 
-        # measure elapsed time
-        batch_time.update(time.time() - end)
-        end = time.time()
 
-        if i % args.print_freq == 0:
-            progress.display(i)
+def main(args: argparse.Namespace):
+    engine.Engine(DAN, args).run()
 
 
 if __name__ == '__main__':
@@ -215,6 +94,14 @@ if __name__ == '__main__':
     parser.add_argument('--no-pool', action='store_true',
                         help='no pool layer after the feature extractor.')
     parser.add_argument('--scratch', action='store_true', help='whether train from scratch.')
+    parser.add_argument('--warm-start', action='store_true',
+                        help='initialize the classifier with a classifier pretrained on the source domain')
+    parser.add_argument('--pretrain-cache', type=str, default=None, metavar='PATH',
+                        help='directory of source pretrainings shared by the runs with the same source domain, '
+                             'model, seed and pretraining hyperparameters (default: pretrain in every run)')
+    parser.add_argument('--pretrain-lr', default=0.001, type=float, help='initial pretrain learning rate')
+    parser.add_argument('--pretrain-epochs', default=3, type=int, metavar='N',
+                        help='number of total epochs (pretrain) to run')
     parser.add_argument('--non-linear', default=False, action='store_true',
                         help='whether not use the linear version')
     parser.add_argument('--trade-off', default=1., type=float,
@@ -248,5 +135,6 @@ if __name__ == '__main__':
     parser.add_argument("--phase", type=str, default='train', choices=['train', 'test', 'analysis'],
                         help="When phase is 'test', only test the model."
                              "When phase is 'analysis', only analysis the model.")
+    engine.add_arguments(parser)
     args = parser.parse_args()
     main(args)
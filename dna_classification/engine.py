@@ -0,0 +1,657 @@
+"""
+Training engine shared by the method scripts. The engine owns seeding, the data path, the training loop,
+validation and checkpointing, while every domain adaptation method is a small :class:`Method` plugin that
+builds its models and implements a single training step.
+"""
+import functools
+import hashlib
+import json
+import os
+import os.path as osp
+import random
+import shutil
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+import torch.backends.cudnn as cudnn
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.optim import SGD
+from torch.optim.lr_scheduler import LambdaLR, LRScheduler
+
+import utils
+import augmentation
+from tllib.utils.logger import CompleteLogger
+from tllib.utils.meter import AverageMeter, ProgressMeter
+from tllib.utils.metric import accuracy
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def cpu_snapshot(state):
+    """Copy of a (nested) state dict with its tensors copied to the CPU, which later training steps do not modify"""
+    if torch.is_tensor(state):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        snapshot = type(state)((key, cpu_snapshot(value)) for key, value in state.items())
+        if hasattr(state, '_metadata'):
+            # versions of the modules, used by load_state_dict
+            snapshot._metadata = state._metadata
+        return snapshot
+    if isinstance(state, (list, tuple)):
+        return type(state)(cpu_snapshot(value) for value in state)
+    return state
+
+
+class CheckpointWriter:
+    """
+    Writes checkpoints in a background thread, in the order they are submitted, so that training only waits for
+    the snapshot of the state. Files are written under a temporary name and renamed, which leaves the previous
+    checkpoint intact if the process is killed during a write, and checkpoints of the same content are hard links.
+    Errors of the background writes are raised by the next call.
+    """
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.futures = []
+
+    def save(self, snapshot, path):
+        """Write a snapshot taken with :func:`cpu_snapshot` to ``path``"""
+        self.submit(self._save, snapshot, path)
+
+    def link(self, src, dst):
+        """Make ``dst`` a hard link to the file ``src`` will hold once the pending writes are done"""
+        self.submit(self._link, src, dst)
+
+    def submit(self, fn, *args):
+        self.futures = [future for future in self.futures if not self._done(future)]
+        self.futures.append(self.executor.submit(fn, *args))
+
+    def wait(self):
+        for future in self.futures:
+            future.result()
+        self.futures = []
+
+    @staticmethod
+    def _done(future):
+        if future.done():
+            future.result()
+            return True
+        return False
+
+    @staticmethod
+    def _save(snapshot, path):
+        torch.save(snapshot, path + '.tmp')
+        os.replace(path + '.tmp', path)
+
+    @staticmethod
+    def _link(src, dst):
+        try:
+            os.link(src, dst + '.tmp')
+        except OSError:
+            # file systems without hard links
+            shutil.copy(src, dst + '.tmp')
+        os.replace(dst + '.tmp', dst)
+
+
+@functools.lru_cache(maxsize=1)
+def load_train_datasets(source_positive, source_negative, target_train, cache_dir, num_workers, packed):
+    """``utils.get_train_datasets`` kept in memory for the next run of the same process on the same domains"""
+    return utils.get_train_datasets(source_positive, source_negative, target_train, cache_dir=cache_dir,
+                                    num_workers=num_workers, packed=packed)
+
+
+@functools.lru_cache(maxsize=1)
+def load_test_dataset(target_positive, target_negative, cache_dir, num_workers, packed):
+    return utils.get_test_dataset(target_positive, target_negative, cache_dir=cache_dir,
+                                  num_workers=num_workers, packed=packed)
+
+
+# bump when the source pretraining changes
+PRETRAIN_CACHE_VERSION = 1
+
+
+def weight_decay(args):
+    # the method scripts store --wd under either name
+    return args.weight_decay if 'weight_decay' in args else args.wd
+
+
+def pretrain_cache_key(args):
+    """Key of the source pretraining of a run: its source domain, model, seed and pretraining hyperparameters"""
+    key = [PRETRAIN_CACHE_VERSION, utils.fasta_cache_key(args.source_positive),
+           utils.fasta_cache_key(args.source_negative), args.arch, args.bottleneck_dim, args.scratch, args.seed,
+           args.batch_size, args.iters_per_epoch, args.device_data, args.amp, args.pretrain_epochs, args.pretrain_lr,
+           args.lr_gamma, args.lr_decay, args.momentum, weight_decay(args)]
+    return hashlib.sha1(json.dumps(key).encode()).hexdigest()[:16]
+
+
+def add_arguments(parser):
+    """Add the options of the engine, shared by all the method scripts, to their ``parser``"""
+    # data loading
+    parser.add_argument('--parse-workers', default=None, type=int,
+                        help='number of processes used to encode FASTA files (default: all available cores)')
+    parser.add_argument('--packed', action='store_true',
+                        help='keep sequences 2-bit packed in memory and expand them per batch')
+    parser.add_argument('--device-data', action='store_true',
+                        help='keep the training data on the device and draw batches there without loader workers')
+    # speed
+    parser.add_argument('--compile', action='store_true',
+                        help='compile the backbone and heads with torch.compile, falling back to eager mode on failure')
+    parser.add_argument('--amp', action='store_true',
+                        help='run the forward passes under bfloat16 autocast, losses stay in fp32')
+    # checkpointing and validation
+    parser.add_argument('--checkpoint-freq', default=0, type=int, metavar='N',
+                        help='also save the training state every N iterations, not only after every epoch')
+    parser.add_argument('--resume', action='store_true',
+                        help='resume an interrupted training from the training state in the log directory')
+    parser.add_argument('--best-flush-freq', default=1, type=int, metavar='N',
+                        help='keep the best checkpoint in memory and write it every N epochs and at the end '
+                             '(default: 1, written when it improves; 0: only at the end)')
+    parser.add_argument('--val-freq', default=0, type=int, metavar='N',
+                        help='also validate every N iterations of an epoch (default: 0, only at its end)')
+    parser.add_argument('--val-size', default=0, type=int, metavar='N',
+                        help='validate on a fixed stratified subset of N sequences of the validation set '
+                             '(default: 0, all of it)')
+    parser.add_argument('--patience', default=0, type=int, metavar='N',
+                        help='stop training after N validations in a row without improvement, '
+                             'keeping the best checkpoint (default: 0, never)')
+
+
+def to_device(data):
+    if isinstance(data, (list, tuple)):
+        return type(data)(to_device(x) for x in data)
+    return data.to(device)
+
+
+class Method:
+    """
+    Training method plugged into :class:`Engine`. Subclasses build their models, losses and optimizers in
+    ``__init__`` and implement :meth:`train_step`, which returns the values of the meters listed in ``meters``.
+    ``classifier`` is validated and checkpointed unless :meth:`validate`, :meth:`state_dict` and
+    :meth:`load_state_dict` are overridden.
+    """
+
+    # name and format of the meters returned by train_step
+    meters = (('Loss', ':6.2f'), ('Cls Acc', ':3.1f'))
+    # whether train_step needs a batch of the target domain
+    uses_target = True
+    num_classes = 2
+
+    @staticmethod
+    def target_batch_size(args):
+        """Batch size of the target domain, which some methods set apart from the source one"""
+        return args.batch_size
+
+    @staticmethod
+    def uses_source_index(args):
+        """Whether train_step also takes the indices of the source samples in the source dataset, as ``index_s``"""
+        return False
+
+    @staticmethod
+    def target_augmentations(args):
+        """
+        Weak and strong :class:`augmentation.DNAAugmentation` of the target domain, with which ``x_t`` becomes the
+        pair of both views of the target batch, or None
+        """
+        return None
+
+    def __init__(self, args):
+        self.args = args
+        self.classifier = None
+        self.lr_scheduler = None
+
+    def modules(self):
+        """Modules switched to train mode at the start of every epoch"""
+        return [self.classifier]
+
+    def train(self):
+        for module in self.modules():
+            module.train()
+
+    def prepare(self, engine):
+        """
+        Called before the first epoch of the train phase, e.g. to pretrain on the source domain. By default
+        warm starts from a source-only classifier with ``--warm-start``.
+        """
+        if self.args.warm_start:
+            self.warm_start(torch.load(engine.source_pretraining(), map_location='cpu'))
+
+    def warm_start(self, state_dict):
+        """Initialize ``classifier`` with the tensors of a source-only classifier of the same name and shape"""
+        own = self.classifier.state_dict()
+        matching = {name: value for name, value in state_dict.items()
+                    if name in own and own[name].shape == value.shape}
+        self.classifier.load_state_dict(matching, strict=False)
+        print("=> warm start of {} of the {} tensors of the classifier".format(len(matching), len(own)))
+
+    def train_step(self, x_s, labels_s, x_t, labels_t):
+        """
+        One optimization step on a source batch and, if ``uses_target``, a target batch whose labels must
+        only be used for monitoring. Returns a dict of meter values, optionally as ``(value, count)`` pairs.
+        """
+        raise NotImplementedError
+
+    def validate(self, val_loader, calc_auc=False) -> float:
+        return utils.validate(val_loader, self.classifier, self.args, device, calc_auc=calc_auc)
+
+    def feature_extractor(self) -> nn.Module:
+        return nn.Sequential(self.classifier.backbone, self.classifier.pool_layer, self.classifier.bottleneck)
+
+    def state_dict(self):
+        return self.classifier.state_dict()
+
+    def load_state_dict(self, state_dict):
+        self.classifier.load_state_dict(state_dict)
+
+    def training_state(self):
+        """State of all the modules, optimizers and lr schedulers of the method, to resume training"""
+        state = {}
+        for name, value in vars(self).items():
+            if isinstance(value, (nn.Module, torch.optim.Optimizer, LRScheduler)):
+                state[name] = value.state_dict()
+            if isinstance(value, nn.Module):
+                # step counters of the warm start gradient reverse layers are plain attributes
+                iter_nums = {key: module.iter_num for key, module in value.named_modules()
+                             if hasattr(module, 'iter_num')}
+                if iter_nums:
+                    state[name + '.iter_num'] = iter_nums
+        return state
+
+    def load_training_state(self, state):
+        for name, value in state.items():
+            if name.endswith('.iter_num'):
+                modules = dict(getattr(self, name[:-len('.iter_num')]).named_modules())
+                for key, iter_num in value.items():
+                    modules[key].iter_num = iter_num
+            else:
+                getattr(self, name).load_state_dict(value)
+
+
+class SourceOnly(Method):
+    """Empirical risk minimization on the source domain, also used to pretrain the classifiers of other methods"""
+
+    meters = (('Loss', ':3.2f'), ('Cls Acc', ':3.1f'))
+    uses_target = False
+
+    def __init__(self, args, classifier, optimizer, lr_scheduler):
+        super().__init__(args)
+        self.classifier = classifier
+        self.optimizer = optimizer
+        self.lr_scheduler = lr_scheduler
+
+    def train_step(self, x_s, labels_s, x_t, labels_t):
+        with utils.autocast(device, self.args.amp):
+            y_s, f_s = self.classifier(x_s)
+        y_s = y_s.float()
+
+        cls_loss = F.cross_entropy(y_s, labels_s)
+        cls_acc = accuracy(y_s, labels_s)[0]
+
+        self.optimizer.zero_grad()
+        cls_loss.backward()
+        self.optimizer.step()
+        self.lr_scheduler.step()
+        return {'Loss': cls_loss, 'Cls Acc': cls_acc}
+
+
+class Engine:
+    """Runs the phase given by ``args.phase`` of a method script for the method ``method_cls``"""
+
+    def __init__(self, method_cls, args):
+        self.args = args
+        self.logger = CompleteLogger(args.log, args.phase)
+        print(args)
+
+        if args.seed is not None:
+            random.seed(args.seed)
+            torch.manual_seed(args.seed)
+            cudnn.deterministic = True
+            warnings.warn('You have chosen to seed training. '
+                          'This will turn on the CUDNN deterministic setting, '
+                          'which can slow down your training considerably! '
+                          'You may see unexpected behavior when restarting '
+                          'from checkpoints.')
+
+        cudnn.benchmark = True
+
+        # Data loading code
+        train_source_dataset, train_target_dataset, test_dataset = load_train_datasets(
+            args.source_positive, args.source_negative, args.target_train, args.ds_cache, args.parse_workers,
+            args.packed)
+        val_dataset = test_dataset
+        self.source_index = method_cls.uses_source_index(args)
+        if self.source_index:
+            train_source_dataset = utils.IndexedDataset(train_source_dataset)
+        if args.val_size:
+            val_dataset = utils.stratified_subset(test_dataset, args.val_size)
+        self.train_source_loader = utils.get_data_loader(train_source_dataset, batch_size=args.batch_size,
+                                                         shuffle=True, num_workers=args.workers, drop_last=True)
+        target_batch_size = method_cls.target_batch_size(args)
+        self.train_target_loader = utils.get_data_loader(train_target_dataset, batch_size=target_batch_size,
+                                                         shuffle=True, num_workers=args.workers, drop_last=True)
+        self.val_loader = utils.get_data_loader(val_dataset, batch_size=args.batch_size, shuffle=False,
+                                                num_workers=args.workers)
+        self.test_loader = utils.get_data_loader(test_dataset, batch_size=args.batch_size, shuffle=False,
+                                                 num_workers=args.workers)
+
+        self.train_source_iter = self.train_iterator(train_source_dataset, self.train_source_loader, args.batch_size)
+        self.train_target_iter = None
+        if method_cls.uses_target:
+            self.train_target_iter = self.train_iterator(train_target_dataset, self.train_target_loader,
+                                                         target_batch_size)
+            augmentations = method_cls.target_augmentations(args)
+            if augmentations is not None:
+                self.train_target_iter = augmentation.AugmentedIterator(self.train_target_iter, *augmentations,
+                                                                        args.seed, device)
+
+        self.method = method_cls(args)
+        self.writer = CheckpointWriter()
+        self.best_acc1 = 0.
+        # best checkpoint kept in memory until it is written, and the accuracy of the one on disk
+        self.best_snapshot = None
+        self.saved_best_acc1 = 0.
+        # validations since the best one, and the epoch and iteration training was stopped early at
+        self.num_bad_validations = 0
+        self.stopped_at = None
+        # meters of the current epoch, and of the interrupted epoch when resuming
+        self.epoch_meters = []
+        self.resumed_meters = {}
+
+    def train_iterator(self, dataset, loader, batch_size):
+        if self.args.device_data:
+            return utils.DeviceDataIterator(dataset, batch_size, device)
+        return utils.ForeverDataIterator(loader)
+
+    def run(self):
+        args, method, logger = self.args, self.method, self.logger
+
+        # resume from the best checkpoint
+        if args.phase != 'train':
+            method.load_state_dict(torch.load(logger.get_checkpoint_path('best'), map_location='cpu'))
+
+        if args.phase == 'analysis':
+            self.analyse()
+            logger.close()
+            return
+
+        if args.phase == 'test':
+            test_dataset = load_test_dataset(args.target_positive, args.target_negative, args.ds_cache,
+                                             args.parse_workers, args.packed)
+            test_loader = utils.get_data_loader(test_dataset, batch_size=args.batch_size,
+                                                shuffle=True, num_workers=args.workers, drop_last=True)
+            acc1 = method.validate(test_loader, calc_auc=True)
+            print(acc1)
+            logger.close()
+            return
+
+        method.prepare(self)
+
+        # start training
+        self.best_acc1, start_epoch, start_iter = 0., 0, 0
+        if args.resume:
+            if osp.exists(logger.get_checkpoint_path('state')):
+                start_epoch, start_iter = self.load_state()
+                print("=> resuming from epoch {} iteration {}".format(start_epoch, start_iter))
+            else:
+                print("=> no training state in {}, starting from scratch".format(args.log))
+        for epoch in range(start_epoch, args.epochs):
+            if self.stopped_at is not None:
+                break
+            if method.lr_scheduler is not None:
+                print("lr:", method.lr_scheduler.get_last_lr()[0])
+            # train for one epoch
+            self.train_epoch(method, epoch, start_iter, main=True)
+            start_iter = 0
+
+            # evaluate on validation set and save checkpoint
+            if self.stopped_at is None:
+                self.evaluate(epoch, args.iters_per_epoch)
+            if args.best_flush_freq > 1 and (epoch + 1) % args.best_flush_freq == 0:
+                self.flush_best()
+            self.save_state(epoch + 1, 0)
+
+        print("best_acc1 = {:3.1f}".format(self.best_acc1))
+        if self.stopped_at is not None:
+            total = args.epochs * args.iters_per_epoch
+            done = self.stopped_at[0] * args.iters_per_epoch + self.stopped_at[1]
+            print("=> early stopping at epoch {} iteration {} after {} validations without improvement, "
+                  "{} of {} iterations saved ({:.0%})".format(*self.stopped_at, args.patience, total - done, total,
+                                                             (total - done) / total))
+        self.flush_best()
+        self.writer.wait()
+
+        # evaluate on test set
+        self.test()
+
+        logger.close()
+
+    def test(self):
+        """Test the best checkpoint at the end of training"""
+        method = self.method
+        method.load_state_dict(torch.load(self.logger.get_checkpoint_path('best'), map_location='cpu'))
+        acc1 = method.validate(self.test_loader)
+        print("test_acc1 = {:3.1f}".format(acc1))
+
+    def train_epoch(self, method, epoch, start_iter=0, main=False):
+        """
+        Train ``method`` for an epoch from ``start_iter``. The ``main`` training of the method, unlike the
+        pretraining of a classifier, also saves its state and validates it during the epoch.
+        """
+        args = self.args
+        batch_time = AverageMeter('Time', ':5.2f')
+        data_time = AverageMeter('Data', ':5.2f')
+        meters = {name: utils.DeviceAverageMeter(name, fmt) for name, fmt in method.meters}
+        progress = ProgressMeter(
+            args.iters_per_epoch,
+            [batch_time, data_time] + list(meters.values()),
+            prefix="Epoch: [{}]".format(epoch))
+        if main:
+            self.epoch_meters = progress.meters
+            if start_iter > 0:
+                # averages of the iterations before the interruption
+                for meter in self.epoch_meters:
+                    meter.__dict__.update(self.resumed_meters.get(meter.name, {}))
+
+        # switch to train mode
+        method.train()
+
+        end = time.time()
+        for i in range(start_iter, args.iters_per_epoch):
+            inputs, kwargs = self.next_batch(method)
+
+            # measure data loading time
+            data_time.update(time.time() - end)
+
+            results = method.train_step(*inputs, **kwargs)
+            for name, value in results.items():
+                value, n = value if isinstance(value, tuple) else (value, inputs[1].size(0))
+                meters[name].update(value, n)
+
+            # measure elapsed time
+            batch_time.update(time.time() - end)
+            end = time.time()
+
+            if i % args.print_freq == 0:
+                progress.display(i)
+
+            if main and args.val_freq and (i + 1) % args.val_freq == 0 and i + 1 < args.iters_per_epoch:
+                print("=> validating at epoch {} iteration {}".format(epoch, i + 1))
+                self.evaluate(epoch, i + 1)
+                if self.stopped_at is not None:
+                    break
+                method.train()
+
+            if main and args.checkpoint_freq and (i + 1) % args.checkpoint_freq == 0 \
+                    and i + 1 < args.iters_per_epoch:
+                self.save_state(epoch, i + 1)
+
+    def next_batch(self, method):
+        """Positional and keyword arguments of ``method.train_step`` for the next source and target batches"""
+        batch_s = next(self.train_source_iter)
+        x_s, labels_s = to_device(batch_s[0]), to_device(batch_s[1])
+        # taken by the method itself, not by the classifiers it pretrains
+        kwargs = {'index_s': to_device(batch_s[2])} if self.source_index and method is self.method else {}
+        x_t = labels_t = None
+        if method.uses_target:
+            x_t, labels_t = next(self.train_target_iter)[:2]
+            x_t, labels_t = to_device(x_t), to_device(labels_t)
+        return (x_s, labels_s, x_t, labels_t), kwargs
+
+    def evaluate(self, epoch, iteration):
+        """
+        Validate the method after ``iteration`` of ``epoch`` and save its checkpoints, training is stopped
+        after ``--patience`` validations in a row without improvement
+        """
+        args, logger = self.args, self.logger
+        acc1 = self.method.validate(self.val_loader)
+
+        # remember best acc@1 and save checkpoint
+        snapshot = cpu_snapshot(self.method.state_dict())
+        self.writer.save(snapshot, logger.get_checkpoint_path('latest'))
+        if acc1 > self.best_acc1:
+            self.best_acc1 = acc1
+            self.num_bad_validations = 0
+            if args.best_flush_freq == 1:
+                self.writer.link(logger.get_checkpoint_path('latest'), logger.get_checkpoint_path('best'))
+                self.saved_best_acc1 = acc1
+            else:
+                self.best_snapshot = snapshot
+        else:
+            self.num_bad_validations += 1
+            if args.patience and self.num_bad_validations >= args.patience:
+                self.stopped_at = (epoch, iteration)
+
+    def flush_best(self):
+        """Write the best checkpoint kept in memory"""
+        if self.best_snapshot is not None:
+            self.writer.save(self.best_snapshot, self.logger.get_checkpoint_path('best'))
+            self.saved_best_acc1 = self.best_acc1
+            self.best_snapshot = None
+
+    def save_state(self, epoch, iteration):
+        """Save everything needed to resume training before ``iteration`` of ``epoch``"""
+        for meter in self.epoch_meters:
+            if isinstance(meter, utils.DeviceAverageMeter):
+                meter.synchronize()
+        state = {
+            'epoch': epoch,
+            'iteration': iteration,
+            # a best checkpoint still in memory is lost with the process
+            'best_acc1': self.saved_best_acc1,
+            'num_bad_validations': self.num_bad_validations,
+            'stopped_at': self.stopped_at,
+            'meters': {meter.name: dict(vars(meter)) for meter in self.epoch_meters} if iteration > 0 else {},
+            'method': self.method.training_state(),
+            'train_source_iter': self.train_source_iter.state_dict(),
+            'train_target_iter': None if self.train_target_iter is None else self.train_target_iter.state_dict(),
+            'rng': {
+                'python': random.getstate(),
+                'numpy': np.random.get_state(),
+                'torch': torch.get_rng_state(),
+                'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+            },
+        }
+        self.writer.save(cpu_snapshot(state), self.logger.get_checkpoint_path('state'))
+
+    def load_state(self):
+        """Restore the state saved by :meth:`save_state`, returns the epoch and iteration to resume from"""
+        state = torch.load(self.logger.get_checkpoint_path('state'), map_location='cpu', weights_only=False)
+        self.best_acc1 = self.saved_best_acc1 = state['best_acc1']
+        self.num_bad_validations = state['num_bad_validations']
+        self.stopped_at = state['stopped_at']
+        self.resumed_meters = state['meters']
+        self.method.load_training_state(state['method'])
+        self.train_source_iter.load_state_dict(state['train_source_iter'])
+        if self.train_target_iter is not None:
+            self.train_target_iter.load_state_dict(state['train_target_iter'])
+        # restored last, restarting the data loaders draws from the global generator
+        rng = state['rng']
+        random.setstate(rng['python'])
+        np.random.set_state(rng['numpy'])
+        torch.set_rng_state(rng['torch'])
+        if rng['cuda'] is not None and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(rng['cuda'])
+        return state['epoch'], state['iteration']
+
+    def source_pretraining(self):
+        """
+        Path of the checkpoint of a classifier trained on the source domain only. With ``--pretrain-cache``
+        it is trained once for all the runs with the same :func:`pretrain_cache_key`, by the first of them.
+        It is trained on its own random generator and source iterator, so that the rest of the run is the
+        same whether it is trained or loaded.
+        """
+        args = self.args
+        if args.pretrain_cache is None:
+            path = self.logger.get_checkpoint_path('pretrain')
+            if args.resume and osp.exists(path):
+                print("=> using the source pretraining of the interrupted run", path)
+            else:
+                self.pretrain_source_classifier(path)
+            return path
+
+        path = osp.join(args.pretrain_cache, 'source.{}.pth'.format(pretrain_cache_key(args)))
+        if not osp.exists(path):
+            os.makedirs(args.pretrain_cache, exist_ok=True)
+            with utils.file_lock(path + '.lock'):
+                if not osp.exists(path):
+                    self.pretrain_source_classifier(path + '.tmp')
+                    os.replace(path + '.tmp', path)
+                    return path
+        print("=> using the cached source pretraining", path)
+        return path
+
+    def pretrain_source_classifier(self, path):
+        from tllib.alignment.dann import ImageClassifier
+        args = self.args
+        with torch.random.fork_rng(devices=range(torch.cuda.device_count())):
+            if args.seed is not None:
+                torch.manual_seed(args.seed)
+            classifier = ImageClassifier(utils.get_model(args.arch), self.method.num_classes,
+                                         bottleneck_dim=args.bottleneck_dim, pool_layer=nn.Identity(),
+                                         finetune=not args.scratch).to(device)
+            utils.compile_modules(args.compile, classifier)
+            # a loader of its own, which leaves the sampler of the main one and its saved position untouched
+            dataset = self.train_source_loader.dataset
+            loader = utils.get_data_loader(dataset, batch_size=args.batch_size, shuffle=True,
+                                           num_workers=args.workers, drop_last=True)
+            train_source_iter = self.train_source_iter
+            self.train_source_iter = self.train_iterator(dataset, loader, args.batch_size)
+            try:
+                self.train_source_only(classifier, path)
+            finally:
+                self.train_source_iter = train_source_iter
+
+    def train_source_only(self, classifier, path):
+        args = self.args
+        print("Pretraining the model on source domain.")
+        optimizer = SGD(classifier.get_parameters(), args.pretrain_lr, momentum=args.momentum,
+                        weight_decay=weight_decay(args), nesterov=True)
+        lr_scheduler = LambdaLR(optimizer,
+                                lambda x: args.pretrain_lr * (1. + args.lr_gamma * float(x)) ** (-args.lr_decay))
+        method = SourceOnly(args, classifier, optimizer, lr_scheduler)
+        for epoch in range(args.pretrain_epochs):
+            print("lr:", lr_scheduler.get_last_lr()[0])
+            # pretrain for one epoch
+            self.train_epoch(method, epoch)
+            # validate to show pretrain process
+            method.validate(self.val_loader)
+
+        torch.save(classifier.state_dict(), path)
+        print("Pretraining process is done.")
+
+    def analyse(self):
+        from tllib.utils.analysis import collect_feature, tsne, a_distance
+        # extract features from both domains
+        feature_extractor = self.method.feature_extractor().to(device)
+        source_feature = collect_feature(self.train_source_loader, feature_extractor, device)
+        target_feature = collect_feature(self.train_target_loader, feature_extractor, device)
+        # plot t-SNE
+        tSNE_filename = osp.join(self.logger.visualize_directory, 'TSNE.pdf')
+        tsne.visualize(source_feature, target_feature, tSNE_filename)
+        print("Saving t-SNE to", tSNE_filename)
+        # calculate A-distance, which is a measure for distribution discrepancy
+        A_distance = a_distance.calculate(source_feature, target_feature, device)
+        print("A-distance =", A_distance)
@@ -0,0 +1,243 @@
+"""
+Training of several seeds of the source-only method at once: the replicas of its classifier are stacked into a
+single :class:`Ensemble` which runs them with ``torch.func.vmap``, on shared source batches or on a batch per
+replica.
+Every replica is validated and checkpointed under ``<log>/seed<seed>``, laid out like the log directory of a
+single run, so that ``--phase test --log <log>/seed<seed>`` tests it as usual.
+"""
+import copy
+import os
+import os.path as osp
+import random
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.func import functional_call, stack_module_state, vmap
+from torch.optim import SGD
+from torch.optim.lr_scheduler import LambdaLR
+
+import utils
+import engine
+from engine import device
+
+
+def recurrent(module):
+    """Whether ``module`` has recurrent layers, which :class:`Ensemble` cannot run"""
+    return any(isinstance(m, nn.RNNBase) for m in module.modules())
+
+
+def replica_seeds(args):
+    """Seeds of the replicas, following ``--seed``"""
+    seed = args.seed if args.seed is not None else random.randrange(2 ** 31)
+    return [seed + k for k in range(args.ensemble)]
+
+
+class Ensemble(nn.Module):
+    """
+    Replicas of a module whose parameters and buffers are stacked along a new first dimension and which are run
+    at once with ``torch.func.vmap``. vmap has no batching rule for ``nn.LSTM``, whose weights cannot differ
+    within a batch, so modules with recurrent layers, e.g. the ``hybrid`` and ``rnn`` backbones, are not
+    supported. The replicas only share their hyperparameters: an SGD optimizer over the stacked
+    parameters updates them independently, as separate optimizers would.
+    """
+
+    def __init__(self, modules):
+        super().__init__()
+        if recurrent(modules[0]):
+            raise ValueError("{} has recurrent layers, which cannot be ensembled".format(type(modules[0]).__name__))
+        params, buffers = stack_module_state(modules)
+        self.param_names, self.buffer_names = list(params), list(buffers)
+        self.params = nn.ParameterList(params.values())
+        for i, buffer in enumerate(buffers.values()):
+            self.register_buffer('buffer{}'.format(i), buffer)
+        # structure of the replicas, without storage, which is not a submodule
+        object.__setattr__(self, 'module', copy.deepcopy(modules[0]).to('meta'))
+
+    def __len__(self):
+        return self.params[0].shape[0]
+
+    def stacked_buffers(self):
+        return [getattr(self, 'buffer{}'.format(i)) for i in range(len(self.buffer_names))]
+
+    def forward(self, x, stacked=False):
+        """
+        Outputs of the replicas stacked along the first dimension, for a batch ``x`` shared by the replicas
+        or, if ``stacked``, a batch per replica along the first dimension of ``x``
+        """
+        params = dict(zip(self.param_names, self.params))
+        buffers = dict(zip(self.buffer_names, self.stacked_buffers()))
+        return vmap(self.call, in_dims=(0, 0, 0 if stacked else None), randomness='different')(params, buffers, x)
+
+    def call(self, params, buffers, x):
+        return functional_call(self.module, (params, buffers), (x,))
+
+    def train(self, mode=True):
+        self.module.train(mode)
+        return super().train(mode)
+
+    def param_groups(self, module, groups):
+        """Parameter ``groups`` of ``module``, one of the replicas, with the stacked parameters instead"""
+        index = {id(param): i for i, param in enumerate(module.parameters())}
+        return [dict(group, params=[self.params[index[id(param)]] for param in group['params']])
+                for group in groups]
+
+    def replica_state_dict(self, k):
+        """State dict of the replica ``k``, which loads into the replicated module"""
+        tensors = dict(zip(self.param_names, self.params))
+        tensors.update(zip(self.buffer_names, self.stacked_buffers()))
+        return {name: tensors[name][k].detach() for name in self.module.state_dict()}
+
+
+class StackedIterator:
+    """Batches of several data iterators, stacked along a new first dimension"""
+
+    def __init__(self, iterators):
+        self.iterators = iterators
+
+    def __next__(self):
+        batches = [next(iterator)[:2] for iterator in self.iterators]
+        return [torch.stack(tensors) for tensors in zip(*batches)]
+
+    def __iter__(self):
+        return self
+
+    def __len__(self):
+        return len(self.iterators[0])
+
+    def state_dict(self):
+        return [iterator.state_dict() for iterator in self.iterators]
+
+    def load_state_dict(self, state_dict):
+        for iterator, iterator_state in zip(self.iterators, state_dict):
+            iterator.load_state_dict(iterator_state)
+
+
+class SourceOnlyEnsemble(engine.Method):
+    """Empirical risk minimization on the source domain of the replicas ``classifiers``, one per seed"""
+
+    meters = (('Loss', ':3.2f'), ('Cls Acc', ':3.1f'))
+    uses_target = False
+
+    def __init__(self, args, classifiers, seeds):
+        super().__init__(args)
+        self.seeds = seeds
+        self.ensemble = Ensemble(classifiers).to(device)
+        # replica the ensemble is copied into for validation
+        self.classifier = classifiers[0]
+        self.optimizer = SGD(self.ensemble.param_groups(self.classifier, self.classifier.get_parameters()),
+                             args.lr, momentum=args.momentum, weight_decay=engine.weight_decay(args), nesterov=True)
+        self.lr_scheduler = LambdaLR(self.optimizer,
+                                     lambda x: args.lr * (1. + args.lr_gamma * float(x)) ** (-args.lr_decay))
+
+    def modules(self):
+        return [self.ensemble]
+
+    def train_step(self, x_s, labels_s, x_t, labels_t):
+        # a batch per replica with --ensemble-shuffle
+        stacked = labels_s.dim() == 2
+        with utils.autocast(device, self.args.amp):
+            y_s, f_s = self.ensemble(x_s, stacked)
+        y_s = y_s.float()
+        if not stacked:
+            labels_s = labels_s.expand(len(self.ensemble), -1)
+
+        # mean over the batch of every replica, summed over the replicas, whose gradients are independent
+        cls_losses = F.cross_entropy(y_s.flatten(0, 1), labels_s.flatten(), reduction='none').view_as(labels_s)
+        cls_losses = cls_losses.mean(dim=1)
+        cls_acc = (y_s.argmax(dim=2) == labels_s).float().mean() * 100.
+
+        self.optimizer.zero_grad()
+        cls_losses.sum().backward()
+        self.optimizer.step()
+        self.lr_scheduler.step()
+        batch_size = labels_s.size(1)
+        return {'Loss': (cls_losses.mean(), batch_size), 'Cls Acc': (cls_acc, batch_size)}
+
+    def replica(self, k):
+        """The classifier with the parameters and buffers of the replica ``k``"""
+        self.classifier.load_state_dict(self.ensemble.replica_state_dict(k))
+        return self.classifier
+
+    def state_dict(self):
+        return self.ensemble.state_dict()
+
+    def load_state_dict(self, state_dict):
+        self.ensemble.load_state_dict(state_dict)
+
+
+class EnsembleEngine(engine.Engine):
+    """
+    :class:`engine.Engine` training an ensemble method, which validates every replica and keeps its latest and
+    best checkpoints under ``<log>/seed<seed>/checkpoints``, and its validation accuracies in
+    ``<log>/seed<seed>/metrics.tsv``. The reported best accuracy is the mean of the best ones of the replicas,
+    and the patience counts validations improving none of them.
+    """
+
+    def __init__(self, method_cls, args):
+        for option in ('resume', 'checkpoint_freq', 'compile', 'warm_start'):
+            if getattr(args, option):
+                raise ValueError("--{} is not supported with --ensemble".format(option.replace('_', '-')))
+        if args.best_flush_freq != 1:
+            raise ValueError("--best-flush-freq is not supported with --ensemble")
+        if recurrent(utils.get_model(args.arch)):
+            raise ValueError("--ensemble is not supported with the recurrent layers of the {} backbone, "
+                             "train its seeds in separate runs".format(args.arch))
+        super().__init__(method_cls, args)
+        seeds = self.method.seeds
+        if args.ensemble_shuffle:
+            # an independent shuffle of the source domain per replica
+            loader = self.train_source_loader
+            self.train_source_iter = StackedIterator(
+                [self.train_source_iter] +
+                [self.train_iterator(loader.dataset, loader, args.batch_size) for _ in seeds[1:]])
+        self.seed_dirs = [osp.join(args.log, 'seed{}'.format(seed)) for seed in seeds]
+        for seed_dir in self.seed_dirs:
+            os.makedirs(osp.join(seed_dir, 'checkpoints'), exist_ok=True)
+            with open(osp.join(seed_dir, 'metrics.tsv'), 'w') as f:
+                f.write('epoch\titeration\tacc1\n')
+        self.best_accs = [0.] * len(seeds)
+
+    def checkpoint_path(self, k, name):
+        return osp.join(self.seed_dirs[k], 'checkpoints', name + '.pth')
+
+    def evaluate(self, epoch, iteration):
+        args, method = self.args, self.method
+        improved = False
+        for k, seed in enumerate(method.seeds):
+            print("=> seed {}".format(seed))
+            acc1 = utils.validate(self.val_loader, method.replica(k), args, device)
+            with open(osp.join(self.seed_dirs[k], 'metrics.tsv'), 'a') as f:
+                f.write('{}\t{}\t{:.3f}\n'.format(epoch, iteration, acc1))
+            self.writer.save(engine.cpu_snapshot(method.classifier.state_dict()), self.checkpoint_path(k, 'latest'))
+            if acc1 > self.best_accs[k]:
+                self.best_accs[k] = acc1
+                self.writer.link(self.checkpoint_path(k, 'latest'), self.checkpoint_path(k, 'best'))
+                improved = True
+        self.best_acc1 = self.saved_best_acc1 = sum(self.best_accs) / len(self.best_accs)
+        print(" * best Acc@1 per seed: " + " ".join("{:.3f}".format(acc1) for acc1 in self.best_accs))
+
+        if improved:
+            self.num_bad_validations = 0
+        else:
+            self.num_bad_validations += 1
+            if args.patience and self.num_bad_validations >= args.patience:
+                self.stopped_at = (epoch, iteration)
+
+    def save_state(self, epoch, iteration):
+        # the ensemble is not resumable
+        pass
+
+    def test(self):
+        args, method = self.args, self.method
+        accs = []
+        for k, seed in enumerate(method.seeds):
+            print("=> seed {}".format(seed))
+            method.classifier.load_state_dict(torch.load(self.checkpoint_path(k, 'best'), map_location='cpu'))
+            accs.append(utils.validate(self.test_loader, method.classifier, args, device))
+            with open(osp.join(self.seed_dirs[k], 'metrics.tsv'), 'a') as f:
+                f.write('test\t\t{:.3f}\n'.format(accs[-1]))
+        mean = sum(accs) / len(accs)
+        std = (sum((acc - mean) ** 2 for acc in accs) / len(accs)) ** 0.5
+        print("test_acc1 = {:3.1f} +- {:3.1f} ({})".format(mean, std, " ".join("{:3.1f}".format(acc)
+                                                                             for acc in accs)))
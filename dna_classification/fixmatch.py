@@ -2,30 +2,20 @@
 @author: Baixu Chen
 @contact: cbx_99_hasta@outlook.com
 """
-import random
-import time
-import warnings
 import argparse
-import shutil
-import os.path as osp
 
 import torch
 import torch.nn as nn
-import torch.backends.cudnn as cudnn
 from torch.optim import SGD
 from torch.optim.lr_scheduler import LambdaLR
-from torch.utils.data import DataLoader
 import torch.nn.functional as F
 
 import utils
+import engine
+from augmentation import DNAAugmentation
 from tllib.modules.classifier import Classifier
 from tllib.self_training.pseudo_label import ConfidenceBasedSelfTrainingLoss
-from tllib.vision.transforms import MultipleApply
-from tllib.utils.data import ForeverDataIterator
 from tllib.utils.metric import accuracy
-from tllib.utils.meter import AverageMeter, ProgressMeter
-from tllib.utils.logger import CompleteLogger
-from tllib.utils.analysis import collect_feature, tsne, a_distance
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
@@ -47,196 +37,140 @@ class ImageClassifier(Classifier):
         return predictions
 
 
-def main(args: argparse.Namespace):
-    logger = CompleteLogger(args.log, args.phase)
-    print(args)
-
-    if args.seed is not None:
-        random.seed(args.seed)
-        torch.manual_seed(args.seed)
-        cudnn.deterministic = True
-        warnings.warn('You have chosen to seed training. '
-                      'This will turn on the CUDNN deterministic setting, '
-                      'which can slow down your training considerably! '
-                      'You may see unexpected behavior when restarting '
-                      'from checkpoints.')
-
-    cudnn.benchmark = True
-
-    # Data loading code
-    train_source_dataset, train_target_dataset, test_dataset = utils.get_train_datasets(args.source_positive,
-                                                                                        args.source_negative,
-                                                                                        args.target_train,
-                                                                                        dataset_name=args.data_name,
-                                                                                        cache_dir=args.ds_cache)
-    val_dataset = test_dataset
-
-    train_source_loader = DataLoader(train_source_dataset, batch_size=args.batch_size,
-                                     shuffle=True, num_workers=args.workers, drop_last=True)
-    train_target_loader = DataLoader(train_target_dataset, batch_size=args.unlabeled_batch_size,
-                                     shuffle=True, num_workers=args.workers, drop_last=True)
-    val_loader = DataLoader(val_dataset, batch_size=args.batch_size, shuffle=False, num_workers=args.workers)
-    test_loader = DataLoader(test_dataset, batch_size=args.batch_size, shuffle=False, num_workers=args.workers)
-
-    train_source_iter = ForeverDataIterator(train_source_loader)
-    train_target_iter = ForeverDataIterator(train_target_loader)
-
-    num_classes = 2
-
-    # create model
-    print("=> using model '{}'".format(args.arch))
-    backbone = utils.get_model(args.arch)
-    pool_layer = nn.Identity()
-    classifier = ImageClassifier(backbone, num_classes, bottleneck_dim=args.bottleneck_dim,
-                                 pool_layer=pool_layer, finetune=not args.scratch).to(device)
-    print(classifier)
-
-    # define optimizer and lr scheduler
-    optimizer = SGD(classifier.get_parameters(), args.lr, momentum=args.momentum, weight_decay=args.weight_decay,
-                    nesterov=True)
-    lr_scheduler = LambdaLR(optimizer, lambda x: args.lr * (1. + args.lr_gamma * float(x)) ** (-args.lr_decay))
-
-    # resume from the best checkpoint
-    if args.phase != 'train':
-        checkpoint = torch.load(logger.get_checkpoint_path('best'), map_location='cpu')
-        classifier.load_state_dict(checkpoint)
-
-    # analysis the model
-    if args.phase == 'analysis':
-        # extract features from both domains
-        feature_extractor = nn.Sequential(classifier.backbone, classifier.pool_layer, classifier.bottleneck).to(device)
-        source_feature = collect_feature(train_source_loader, feature_extractor, device)
-        target_feature = collect_feature(train_target_loader, feature_extractor, device)
-        # plot t-SNE
-        tSNE_filename = osp.join(logger.visualize_directory, 'TSNE.pdf')
-        tsne.visualize(source_feature, target_feature, tSNE_filename)
-        print("Saving t-SNE to", tSNE_filename)
-        # calculate A-distance, which is a measure for distribution discrepancy
-        A_distance = a_distance.calculate(source_feature, target_feature, device)
-        print("A-distance =", A_distance)
-        return
-
-    if args.phase == 'test':
-        test_dataset = utils.get_test_dataset(args.target_positive, args.target_negative,
-                                              dataset_name=f"{args.data_name}_test",
-                                              cache_dir=args.ds_cache)
-        test_loader = DataLoader(test_dataset, batch_size=args.batch_size,
-                                 shuffle=True, num_workers=args.workers, drop_last=True)
-
-        acc1 = utils.validate(test_loader, classifier, args, device, calc_auc=True)
-        print(acc1)
-        return
-
-    # start training
-    best_acc1 = 0.
-    for epoch in range(args.epochs):
-        print("lr:", lr_scheduler.get_last_lr())
-        # train for one epoch
-        train(train_source_iter, train_target_iter, classifier, optimizer, lr_scheduler, epoch, args)
-
-        # evaluate on validation set
-        acc1 = utils.validate(val_loader, classifier, args, device)
-
-        # remember best acc@1 and save checkpoint
-        torch.save(classifier.state_dict(), logger.get_checkpoint_path('latest'))
-        if acc1 > best_acc1:
-            shutil.copy(logger.get_checkpoint_path('latest'), logger.get_checkpoint_path('best'))
-        best_acc1 = max(acc1, best_acc1)
-
-    print("best_acc1 = {:3.1f}".format(best_acc1))
-
-    # evaluate on test set
-    classifier.load_state_dict(torch.load(logger.get_checkpoint_path('best')))
-    acc1 = utils.validate(test_loader, classifier, args, device)
-    print("test_acc1 = {:3.1f}".format(acc1))
-
-    logger.close()
-
-
-def train(train_source_iter: ForeverDataIterator, train_target_iter: ForeverDataIterator,
-          model: ImageClassifier, optimizer: SGD, lr_scheduler: LambdaLR, epoch: int, args: argparse.Namespace):
-    batch_time = AverageMeter('Time', ':5.2f')
-    data_time = AverageMeter('Data', ':5.2f')
-    cls_losses = AverageMeter('Cls Loss', ':6.2f')
-    self_training_losses = AverageMeter('Self Training Loss', ':6.2f')
-    losses = AverageMeter('Loss', ':6.2f')
-    cls_accs = AverageMeter('Cls Acc', ':3.1f')
-    pseudo_label_ratios = AverageMeter('Pseudo Label Ratio', ':3.1f')
-    pseudo_label_accs = AverageMeter('Pseudo Label Acc', ':3.1f')
-
-    progress = ProgressMeter(
-        args.iters_per_epoch,
-        [batch_time, data_time, losses, cls_losses, self_training_losses, cls_accs, pseudo_label_accs,
-         pseudo_label_ratios],
-        prefix="Epoch: [{}]".format(epoch))
-
-    self_training_criterion = ConfidenceBasedSelfTrainingLoss(args.threshold).to(device)
-    # switch to train mode
-    model.train()
-
-    end = time.time()
-    for i in range(args.iters_per_epoch):
-        x_s, labels_s = next(train_source_iter)[:2]
-        (x_t, x_t_strong), labels_t = next(train_target_iter)[:2]
-
-        x_s = x_s.to(device)
-        x_t = x_t.to(device)
-        x_t_strong = x_t_strong.to(device)
-        labels_s = labels_s.to(device)
-        labels_t = labels_t.to(device)
-
-        # measure data loading time
-        data_time.update(time.time() - end)
+class SplitBatchNorm:
+    """
+    Batch normalization layer which, given ``split_sizes``, normalizes the consecutive chunks of these sizes along
+    the batch with their own statistics and updates its running statistics with them one after another, as
+    separate forward passes of the chunks would.
+    """
+    split_sizes = None
+
+    def forward(self, x):
+        if self.split_sizes is None or not self.training:
+            return super().forward(x)
+        return torch.cat([super(SplitBatchNorm, self).forward(chunk) for chunk in x.split(self.split_sizes)])
+
+
+def split_batch_norm(model: nn.Module):
+    """Turn the batch normalization layers of ``model`` into :class:`SplitBatchNorm` ones, which it returns"""
+    layers, classes = [], {}
+    for module in model.modules():
+        if isinstance(module, nn.modules.batchnorm._BatchNorm):
+            cls = type(module)
+            if cls not in classes:
+                classes[cls] = type('Split' + cls.__name__, (SplitBatchNorm, cls), {})
+            module.__class__ = classes[cls]
+            layers.append(module)
+    return layers
+
+
+class FixMatch(engine.Method):
+    meters = (('Loss', ':6.2f'), ('Cls Loss', ':6.2f'), ('Self Training Loss', ':6.2f'), ('Cls Acc', ':3.1f'),
+              ('Pseudo Label Acc', ':3.1f'), ('Pseudo Label Ratio', ':3.1f'))
+
+    @staticmethod
+    def target_batch_size(args):
+        return args.unlabeled_batch_size
+
+    @staticmethod
+    def target_augmentations(args):
+        weak = DNAAugmentation(args.rc_prob, args.max_shift)
+        strong = DNAAugmentation(args.rc_prob, args.max_shift, args.mutation_rate, args.mask_ratio)
+        return weak, strong
+
+    def __init__(self, args: argparse.Namespace):
+        super().__init__(args)
+        if args.bn_mode != 'split' and not args.fused_forward:
+            raise ValueError("--bn-mode is only supported with --fused-forward")
+
+        # create model
+        print("=> using model '{}'".format(args.arch))
+        backbone = utils.get_model(args.arch)
+        pool_layer = nn.Identity()
+        self.classifier = ImageClassifier(backbone, self.num_classes, bottleneck_dim=args.bottleneck_dim,
+                                          pool_layer=pool_layer, finetune=not args.scratch).to(device)
+        print(self.classifier)
+        # the fused forward pass normalizes the weak, source and strong batches apart
+        self.split_layers = split_batch_norm(self.classifier) \
+            if args.fused_forward and args.bn_mode == 'split' else []
+
+        utils.compile_modules(args.compile, self.classifier)
+
+        # define optimizer and lr scheduler
+        self.optimizer = SGD(self.classifier.get_parameters(), args.lr, momentum=args.momentum,
+                             weight_decay=args.weight_decay, nesterov=True)
+        self.lr_scheduler = LambdaLR(self.optimizer,
+                                     lambda x: args.lr * (1. + args.lr_gamma * float(x)) ** (-args.lr_decay))
+
+        self.self_training_criterion = ConfidenceBasedSelfTrainingLoss(args.threshold).to(device)
+
+    def train_step(self, x_s, labels_s, x_t, labels_t):
+        args, model = self.args, self.classifier
+        x_t, x_t_strong = x_t
 
         # clear grad
-        optimizer.zero_grad()
-
-        # compute output
-        with torch.no_grad():
-            y_t = model(x_t)
-
-        # cross entropy loss
-        y_s = model(x_s)
-        cls_loss = F.cross_entropy(y_s, labels_s)
-        cls_loss.backward()
-
-        # self-training loss
-        y_t_strong = model(x_t_strong)
-        self_training_loss, mask, pseudo_labels = self_training_criterion(y_t_strong, y_t)
-        self_training_loss = args.trade_off * self_training_loss
-        self_training_loss.backward()
+        self.optimizer.zero_grad()
+
+        if args.fused_forward:
+            # a single forward and backward pass of the weak, source and strong batches
+            split_sizes = [x_t.size(0), x_s.size(0), x_t_strong.size(0)]
+            for layer in self.split_layers:
+                layer.split_sizes = split_sizes
+            with utils.autocast(device, args.amp):
+                y = model(torch.cat((x_t, x_s, x_t_strong), dim=0))
+            for layer in self.split_layers:
+                layer.split_sizes = None
+            y_t, y_s, y_t_strong = y.float().split(split_sizes)
+            y_t = y_t.detach()
+            cls_loss = F.cross_entropy(y_s, labels_s)
+            self_training_loss, mask, pseudo_labels = self.self_training_criterion(y_t_strong, y_t)
+            self_training_loss = args.trade_off * self_training_loss
+            (cls_loss + self_training_loss).backward()
+        else:
+            # compute output
+            with torch.no_grad(), utils.autocast(device, args.amp):
+                y_t = model(x_t).float()
+
+            # cross entropy loss
+            with utils.autocast(device, args.amp):
+                y_s = model(x_s)
+            y_s = y_s.float()
+            cls_loss = F.cross_entropy(y_s, labels_s)
+            cls_loss.backward()
+
+            # self-training loss
+            with utils.autocast(device, args.amp):
+                y_t_strong = model(x_t_strong)
+            y_t_strong = y_t_strong.float()
+            self_training_loss, mask, pseudo_labels = self.self_training_criterion(y_t_strong, y_t)
+            self_training_loss = args.trade_off * self_training_loss
+            self_training_loss.backward()
 
         # measure accuracy and record loss
         loss = cls_loss + self_training_loss
-        losses.update(loss.item(), x_s.size(0))
-        cls_losses.update(cls_loss.item(), x_s.size(0))
-        self_training_losses.update(self_training_loss.item(), x_s.size(0))
-
         cls_acc = accuracy(y_s, labels_s)[0]
-        cls_accs.update(cls_acc.item(), x_s.size(0))
+        results = {'Loss': loss, 'Cls Loss': cls_loss, 'Self Training Loss': self_training_loss,
+                   'Cls Acc': cls_acc}
 
         # ratio of pseudo labels
         n_pseudo_labels = mask.sum()
         ratio = n_pseudo_labels / x_t.size(0)
-        pseudo_label_ratios.update(ratio.item() * 100, x_t.size(0))
+        results['Pseudo Label Ratio'] = (ratio * 100, x_t.size(0))
 
-        # accuracy of pseudo labels
-        if n_pseudo_labels > 0:
-            pseudo_labels = pseudo_labels * mask - (1 - mask)
-            n_correct = (pseudo_labels == labels_t).float().sum()
-            pseudo_label_acc = n_correct / n_pseudo_labels * 100
-            pseudo_label_accs.update(pseudo_label_acc.item(), n_pseudo_labels)
+        # accuracy of pseudo labels, weighted by their number, which stays on the device
+        pseudo_labels = pseudo_labels * mask - (1 - mask)
+        n_correct = (pseudo_labels == labels_t).float().sum()
+        pseudo_label_acc = n_correct / n_pseudo_labels.clamp_min(1) * 100
+        results['Pseudo Label Acc'] = (pseudo_label_acc, n_pseudo_labels)
 
         # compute gradient and do SGD step
-        optimizer.step()
-        lr_scheduler.step()
+        self.optimizer.step()
+        self.lr_scheduler.step()
+        return results
 
-        # measure elapsed time
-        batch_time.update(time.time() - end)
-        end = time.time()
 
-        if i % args.print_freq == 0:
-            progress.display(i)
+def main(args: argparse.Namespace):
+    engine.Engine(FixMatch, args).run()
 
 
 if __name__ == '__main__':
@@ -261,6 +195,14 @@ if __name__ == '__main__':
     parser.add_argument('--no-pool', action='store_true',
                         help='no pool layer after the feature extractor.')
     parser.add_argument('--scratch', action='store_true', help='whether train from scratch.')
+    parser.add_argument('--warm-start', action='store_true',
+                        help='initialize the classifier with a classifier pretrained on the source domain')
+    parser.add_argument('--pretrain-cache', type=str, default=None, metavar='PATH',
+                        help='directory of source pretrainings shared by the runs with the same source domain, '
+                             'model, seed and pretraining hyperparameters (default: pretrain in every run)')
+    parser.add_argument('--pretrain-lr', default=0.001, type=float, help='initial pretrain learning rate')
+    parser.add_argument('--pretrain-epochs', default=3, type=int, metavar='N',
+                        help='number of total epochs (pretrain) to run')
     parser.add_argument('--trade-off', default=1., type=float,
                         help='the trade-off hyper-parameter for transfer loss')
     # training parameters
@@ -271,6 +213,21 @@ if __name__ == '__main__':
                         help='mini-batch size of unlabeled data (target domain) (default: 32)')
     parser.add_argument('--threshold', default=0.9, type=float,
                         help='confidence threshold')
+    parser.add_argument('--rc-prob', default=0.5, type=float,
+                        help='probability to reverse complement a target sequence in both views (default: 0.5)')
+    parser.add_argument('--max-shift', default=10, type=int,
+                        help='largest shift of the target sequences in both views, in bases (default: 10)')
+    parser.add_argument('--mutation-rate', default=0.05, type=float,
+                        help='probability of a point mutation per base in the strong view (default: 0.05)')
+    parser.add_argument('--mask-ratio', default=0.1, type=float,
+                        help='fraction of every sequence masked in the strong view (default: 0.1)')
+    parser.add_argument('--fused-forward', action='store_true',
+                        help='run the weak target, source and strong target batches through the model in a '
+                             'single forward and backward pass')
+    parser.add_argument('--bn-mode', default='split', choices=['split', 'joint'],
+                        help="batch normalization of the fused forward pass: 'split' normalizes each batch with "
+                             "its own statistics, as the separate passes; 'joint' normalizes them together "
+                             "(default: split)")
     parser.add_argument('--lr', '--learning-rate', default=0.003, type=float,
                         metavar='LR', help='initial learning rate', dest='lr')
     parser.add_argument('--lr-gamma', default=0.0004, type=float, help='parameter for lr scheduler')
@@ -297,5 +254,6 @@ if __name__ == '__main__':
     parser.add_argument("--phase", type=str, default='train', choices=['train', 'test', 'analysis'],
                         help="When phase is 'test', only test the model."
                              "When phase is 'analysis', only analysis the model.")
+    engine.add_arguments(parser)
     args = parser.parse_args()
     main(args)
@@ -2,195 +2,71 @@
 @author: Junguang Jiang
 @contact: JiangJunguang1123@outlook.com
 """
-import random
 import time
-import warnings
 import argparse
-import shutil
-import os.path as osp
 from typing import Tuple
 
 import torch
 import torch.nn as nn
-import torch.backends.cudnn as cudnn
 from torch.optim import SGD
 import torch.utils.data
 from torch.utils.data import DataLoader
 import torch.nn.functional as F
 
-from sklearn.metrics import precision_recall_curve, roc_curve, auc
-
-
 import utils
+import engine
 from tllib.alignment.mcd import ImageClassifierHead, entropy, classifier_discrepancy
-from tllib.utils.data import ForeverDataIterator
 from tllib.utils.metric import accuracy, ConfusionMatrix
 from tllib.utils.meter import AverageMeter, ProgressMeter
-from tllib.utils.logger import CompleteLogger
-from tllib.utils.analysis import collect_feature, tsne, a_distance
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 
-def main(args: argparse.Namespace):
-    logger = CompleteLogger(args.log, args.phase)
-    print(args)
-
-    if args.seed is not None:
-        random.seed(args.seed)
-        torch.manual_seed(args.seed)
-        cudnn.deterministic = True
-        warnings.warn('You have chosen to seed training. '
-                      'This will turn on the CUDNN deterministic setting, '
-                      'which can slow down your training considerably! '
-                      'You may see unexpected behavior when restarting '
-                      'from checkpoints.')
-
-    cudnn.benchmark = True
-
-    # Data loading code
-    train_source_dataset, train_target_dataset, test_dataset = utils.get_train_datasets(args.source_positive,
-                                                                                        args.source_negative,
-                                                                                        args.target_train,
-                                                                                        dataset_name=args.data_name,
-                                                                                        cache_dir=args.ds_cache)
-    val_dataset = test_dataset
-    train_source_loader = DataLoader(train_source_dataset, batch_size=args.batch_size,
-                                     shuffle=True, num_workers=args.workers, drop_last=True)
-    train_target_loader = DataLoader(train_target_dataset, batch_size=args.batch_size,
-                                     shuffle=True, num_workers=args.workers, drop_last=True)
-    val_loader = DataLoader(val_dataset, batch_size=args.batch_size, shuffle=False, num_workers=args.workers)
-    test_loader = DataLoader(test_dataset, batch_size=args.batch_size, shuffle=False, num_workers=args.workers)
-
-    train_source_iter = ForeverDataIterator(train_source_loader)
-    train_target_iter = ForeverDataIterator(train_target_loader)
-
-    num_classes = 2
-
-
-    # create model
-    print("=> using model '{}'".format(args.arch))
-    G = utils.get_model(args.arch).to(device)  # feature extractor
-    # two image classifier heads
-    pool_layer = nn.Identity()
-    F1 = ImageClassifierHead(G.out_features, num_classes, args.bottleneck_dim, pool_layer).to(device)
-    F2 = ImageClassifierHead(G.out_features, num_classes, args.bottleneck_dim, pool_layer).to(device)
-
-    # define optimizer
-    # the learning rate is fixed according to origin paper
-    optimizer_g = SGD(G.parameters(), lr=args.lr, weight_decay=0.0005)
-    optimizer_f = SGD([
-        {"params": F1.parameters()},
-        {"params": F2.parameters()},
-    ], momentum=0.9, lr=args.lr, weight_decay=0.0005)
-
-    # resume from the best checkpoint
-    if args.phase != 'train':
-        checkpoint = torch.load(logger.get_checkpoint_path('best'), map_location='cpu')
-        G.load_state_dict(checkpoint['G'])
-        F1.load_state_dict(checkpoint['F1'])
-        F2.load_state_dict(checkpoint['F2'])
-
-    # analysis the model
-    if args.phase == 'analysis':
-        # extract features from both domains
-        feature_extractor = nn.Sequential(G, F1.pool_layer).to(device)
-        source_feature = collect_feature(train_source_loader, feature_extractor, device)
-        target_feature = collect_feature(train_target_loader, feature_extractor, device)
-        # plot t-SNE
-        tSNE_filename = osp.join(logger.visualize_directory, 'TSNE.pdf')
-        tsne.visualize(source_feature, target_feature, tSNE_filename)
-        print("Saving t-SNE to", tSNE_filename)
-        # calculate A-distance, which is a measure for distribution discrepancy
-        A_distance = a_distance.calculate(source_feature, target_feature, device)
-        print("A-distance =", A_distance)
-        return
-
-    if args.phase == 'test':
-        test_dataset = utils.get_test_dataset(args.target_positive, args.target_negative,
-                                              dataset_name=f"{args.data_name}_test",
-                                              cache_dir=args.ds_cache)
-        test_loader = DataLoader(test_dataset, batch_size=args.batch_size,
-                                 shuffle=True, num_workers=args.workers, drop_last=True)
-
-        acc1 = validate(test_loader, G, F1, F2, args, calc_auc=True)
-        print(acc1)
-        return
-
-    # start training
-    best_acc1 = 0.
-    best_results = None
-    for epoch in range(args.epochs):
-        # train for one epoch
-        train(train_source_iter, train_target_iter, G, F1, F2, optimizer_g, optimizer_f, epoch, args)
-
-        # evaluate on validation set
-        results = validate(val_loader, G, F1, F2, args)
-
-        # remember best acc@1 and save checkpoint
-        torch.save({
-            'G': G.state_dict(),
-            'F1': F1.state_dict(),
-            'F2': F2.state_dict()
-        }, logger.get_checkpoint_path('latest'))
-        if max(results) > best_acc1:
-            shutil.copy(logger.get_checkpoint_path('latest'), logger.get_checkpoint_path('best'))
-            best_acc1 = max(results)
-            best_results = results
-
-    print("best_acc1 = {:3.1f}, results = {}".format(best_acc1, best_results))
-
-    # evaluate on test set
-    checkpoint = torch.load(logger.get_checkpoint_path('best'), map_location='cpu')
-    G.load_state_dict(checkpoint['G'])
-    F1.load_state_dict(checkpoint['F1'])
-    F2.load_state_dict(checkpoint['F2'])
-    results = validate(test_loader, G, F1, F2, args)
-    print("test_acc1 = {:3.1f}".format(max(results)))
-
-    logger.close()
-
-
-def train(train_source_iter: ForeverDataIterator, train_target_iter: ForeverDataIterator,
-          G: nn.Module, F1: ImageClassifierHead, F2: ImageClassifierHead,
-          optimizer_g: SGD, optimizer_f: SGD, epoch: int, args: argparse.Namespace):
-    batch_time = AverageMeter('Time', ':3.1f')
-    data_time = AverageMeter('Data', ':3.1f')
-    losses = AverageMeter('Loss', ':3.2f')
-    trans_losses = AverageMeter('Trans Loss', ':3.2f')
-    cls_accs = AverageMeter('Cls Acc', ':3.1f')
+class MCD(engine.Method):
+    meters = (('Loss', ':3.2f'), ('Trans Loss', ':3.2f'), ('Cls Acc', ':3.1f'))
 
-    progress = ProgressMeter(
-        args.iters_per_epoch,
-        [batch_time, data_time, losses, trans_losses, cls_accs],
-        prefix="Epoch: [{}]".format(epoch))
-
-    # switch to train mode
-    G.train()
-    F1.train()
-    F2.train()
-
-    end = time.time()
-    for i in range(args.iters_per_epoch):
-        x_s, labels_s = next(train_source_iter)[:2]
-        x_t, = next(train_target_iter)[:1]
-
-        x_s = x_s.to(device)
-        x_t = x_t.to(device)
-        labels_s = labels_s.to(device)
+    def __init__(self, args: argparse.Namespace):
+        super().__init__(args)
+        if args.reuse_features and args.reference_steps:
+            raise ValueError("--reuse-features is not supported with --reference-steps")
+        num_classes = self.num_classes
+
+        # create model
+        print("=> using model '{}'".format(args.arch))
+        self.G = utils.get_model(args.arch).to(device)  # feature extractor
+        # two image classifier heads
+        pool_layer = nn.Identity()
+        self.F1 = ImageClassifierHead(self.G.out_features, num_classes, args.bottleneck_dim, pool_layer).to(device)
+        self.F2 = ImageClassifierHead(self.G.out_features, num_classes, args.bottleneck_dim, pool_layer).to(device)
+
+        utils.compile_modules(args.compile, self.G, self.F1, self.F2)
+
+        # define optimizer
+        # the learning rate is fixed according to origin paper
+        self.optimizer_g = SGD(self.G.parameters(), lr=args.lr, weight_decay=args.weight_decay)
+        self.optimizer_f = SGD([
+            {"params": self.F1.parameters()},
+            {"params": self.F2.parameters()},
+        ], momentum=args.momentum, lr=args.lr, weight_decay=args.weight_decay)
+
+    def modules(self):
+        return [self.G, self.F1, self.F2]
+
+    def train_step(self, x_s, labels_s, x_t, labels_t):
+        args, G, F1, F2 = self.args, self.G, self.F1, self.F2
+        optimizer_g, optimizer_f = self.optimizer_g, self.optimizer_f
         x = torch.cat((x_s, x_t), dim=0)
         assert x.requires_grad is False
 
-        # measure data loading time
-        data_time.update(time.time() - end)
-
         # Step A train all networks to minimize loss on source domain
         optimizer_g.zero_grad()
         optimizer_f.zero_grad()
 
-        g = G(x)
-        y_1 = F1(g)
-        y_2 = F2(g)
+        with utils.autocast(device, args.amp):
+            g = G(x)
+            y_1 = F1(g)
+            y_2 = F2(g)
+        y_1, y_2 = y_1.float(), y_2.float()
         y1_s, y1_t = y_1.chunk(2, dim=0)
         y2_s, y2_t = y_2.chunk(2, dim=0)
 
@@ -205,9 +81,16 @@ def train(train_source_iter: ForeverDataIterator, train_target_iter: ForeverData
         optimizer_g.zero_grad()
         optimizer_f.zero_grad()
 
-        g = G(x)
-        y_1 = F1(g)
-        y_2 = F2(g)
+        # the generator is not updated, its features need no graph
+        if args.reuse_features:
+            g = g.detach()  # of the generator before step A updated it
+        else:
+            with torch.set_grad_enabled(args.reference_steps), utils.autocast(device, args.amp):
+                g = G(x)
+        with utils.autocast(device, args.amp):
+            y_1 = F1(g)
+            y_2 = F2(g)
+        y_1, y_2 = y_1.float(), y_2.float()
         y1_s, y1_t = y_1.chunk(2, dim=0)
         y2_s, y2_t = y_2.chunk(2, dim=0)
         y1_t, y2_t = F.softmax(y1_t, dim=1), F.softmax(y2_t, dim=1)
@@ -218,37 +101,63 @@ def train(train_source_iter: ForeverDataIterator, train_target_iter: ForeverData
         optimizer_f.step()
 
         # Step C train genrator to minimize discrepancy
+        # the classifiers are not updated, the gradients of their parameters are not computed
+        F1.requires_grad_(args.reference_steps)
+        F2.requires_grad_(args.reference_steps)
         for k in range(args.num_k):
             optimizer_g.zero_grad()
-            g = G(x)
-            y_1 = F1(g)
-            y_2 = F2(g)
+            with utils.autocast(device, args.amp):
+                g = G(x)
+                y_1 = F1(g)
+                y_2 = F2(g)
+            y_1, y_2 = y_1.float(), y_2.float()
             y1_s, y1_t = y_1.chunk(2, dim=0)
             y2_s, y2_t = y_2.chunk(2, dim=0)
             y1_t, y2_t = F.softmax(y1_t, dim=1), F.softmax(y2_t, dim=1)
             mcd_loss = classifier_discrepancy(y1_t, y2_t) * args.trade_off
             mcd_loss.backward()
             optimizer_g.step()
+        F1.requires_grad_(True)
+        F2.requires_grad_(True)
 
         cls_acc = accuracy(y1_s, labels_s)[0]
+        return {'Loss': loss, 'Trans Loss': mcd_loss, 'Cls Acc': cls_acc}
 
-        losses.update(loss.item(), x_s.size(0))
-        cls_accs.update(cls_acc.item(), x_s.size(0))
-        trans_losses.update(mcd_loss.item(), x_s.size(0))
+    def validate(self, val_loader, calc_auc=True) -> float:
+        return max(validate(val_loader, self.G, self.F1, self.F2, self.args, calc_auc=calc_auc))
 
-        # measure elapsed time
-        batch_time.update(time.time() - end)
-        end = time.time()
+    def feature_extractor(self):
+        return nn.Sequential(self.G, self.F1.pool_layer)
+
+    def warm_start(self, state_dict):
+        # only the backbone is shared with a source-only classifier
+        backbone = {name[len('backbone.'):]: value for name, value in state_dict.items()
+                    if name.startswith('backbone.')}
+        self.G.load_state_dict(backbone)
+        print("=> warm start of the {} tensors of the backbone".format(len(backbone)))
+
+    def state_dict(self):
+        return {
+            'G': self.G.state_dict(),
+            'F1': self.F1.state_dict(),
+            'F2': self.F2.state_dict()
+        }
 
-        if i % args.print_freq == 0:
-            progress.display(i)
+    def load_state_dict(self, state_dict):
+        self.G.load_state_dict(state_dict['G'])
+        self.F1.load_state_dict(state_dict['F1'])
+        self.F2.load_state_dict(state_dict['F2'])
+
+
+def main(args: argparse.Namespace):
+    engine.Engine(MCD, args).run()
 
 
 def validate(val_loader: DataLoader, G: nn.Module, F1: ImageClassifierHead,
              F2: ImageClassifierHead, args: argparse.Namespace, calc_auc: bool = True) -> Tuple[float, float]:
     batch_time = AverageMeter('Time', ':6.3f')
-    top1_1 = AverageMeter('Acc_1', ':6.2f')
-    top1_2 = AverageMeter('Acc_2', ':6.2f')
+    top1_1 = utils.DeviceAverageMeter('Acc_1', ':6.2f')
+    top1_2 = utils.DeviceAverageMeter('Acc_2', ':6.2f')
     progress = ProgressMeter(
         len(val_loader),
         [batch_time, top1_1, top1_2],
@@ -289,8 +198,8 @@ def validate(val_loader: DataLoader, G: nn.Module, F1: ImageClassifierHead,
             acc2, = accuracy(y2, target)
             if confmat:
                 confmat.update(target, y1.argmax(1))
-            top1_1.update(acc1.item(), images.size(0))
-            top1_2.update(acc2.item(), images.size(0))
+            top1_1.update(acc1, images.size(0))
+            top1_2.update(acc2, images.size(0))
 
             # measure elapsed time
             batch_time.update(time.time() - end)
@@ -299,12 +208,15 @@ def validate(val_loader: DataLoader, G: nn.Module, F1: ImageClassifierHead,
             if i % args.print_freq == 0:
                 progress.display(i)
 
+        top1_1.synchronize()
+        top1_2.synchronize()
         print(' * Acc1 {top1_1.avg:.3f} Acc2 {top1_2.avg:.3f}'
               .format(top1_1=top1_1, top1_2=top1_2))
         if confmat:
             print(confmat.format(args.class_names))
 
         if calc_auc:
+            from sklearn.metrics import precision_recall_curve, roc_curve, auc
             y1_preds = torch.cat(y1_preds).cpu().numpy()[:, 1]
             y2_preds = torch.cat(y2_preds).cpu().numpy()[:, 1]
             y_true = torch.cat(y_true).cpu().numpy()
@@ -346,18 +258,39 @@ if __name__ == '__main__':
     parser.add_argument('--no-pool', action='store_true',
                         help='no pool layer after the feature extractor.')
     parser.add_argument('--scratch', action='store_true', help='whether train from scratch.')
+    parser.add_argument('--warm-start', action='store_true',
+                        help='initialize the classifier with a classifier pretrained on the source domain')
+    parser.add_argument('--pretrain-cache', type=str, default=None, metavar='PATH',
+                        help='directory of source pretrainings shared by the runs with the same source domain, '
+                             'model, seed and pretraining hyperparameters (default: pretrain in every run)')
+    parser.add_argument('--pretrain-lr', default=0.001, type=float, help='initial pretrain learning rate')
+    parser.add_argument('--pretrain-epochs', default=3, type=int, metavar='N',
+                        help='number of total epochs (pretrain) to run')
+    parser.add_argument('--lr-gamma', default=0.001, type=float, help='parameter for lr scheduler (pretrain)')
+    parser.add_argument('--lr-decay', default=0.75, type=float, help='parameter for lr scheduler (pretrain)')
     parser.add_argument('--trade-off', default=1., type=float,
                         help='the trade-off hyper-parameter for transfer loss')
     parser.add_argument('--trade-off-entropy', default=0.01, type=float,
                         help='the trade-off hyper-parameter for entropy loss')
     parser.add_argument('--num-k', type=int, default=4, metavar='K',
                         help='how many steps to repeat the generator update')
+    parser.add_argument('--reference-steps', action='store_true',
+                        help='build the autograd graph of every forward pass, as the reference implementation, '
+                             'even through the networks a step does not update')
+    parser.add_argument('--reuse-features', action='store_true',
+                        help='train the classifiers in step B on the features of step A, computed before the '
+                             'generator update, instead of a new forward pass of the generator')
     # training parameters
     parser.add_argument('-b', '--batch-size', default=32, type=int,
                         metavar='N',
                         help='mini-batch size (default: 32)')
     parser.add_argument('--lr', '--learning-rate', default=0.001, type=float,
                         metavar='LR', help='initial learning rate', dest='lr')
+    parser.add_argument('--momentum', default=0.9, type=float, metavar='M',
+                        help='momentum of the classifiers')
+    parser.add_argument('--wd', '--weight-decay', default=0.0005, type=float,
+                        metavar='W', help='weight decay (default: 5e-4)',
+                        dest='weight_decay')
     parser.add_argument('-j', '--workers', default=2, type=int, metavar='N',
                         help='number of data loading workers (default: 2)')
     parser.add_argument('--epochs', default=20, type=int, metavar='N',
@@ -375,5 +308,6 @@ if __name__ == '__main__':
     parser.add_argument("--phase", type=str, default='train', choices=['train', 'test', 'analysis'],
                         help="When phase is 'test', only test the model."
                              "When phase is 'analysis', only analysis the model.")
+    engine.add_arguments(parser)
     args = parser.parse_args()
     main(args)
@@ -0,0 +1,123 @@
+"""
+Run the commands of ``train.run`` job files in a single process. The method scripts are executed in place of
+separate ``python3 <method>.py ...`` processes, so torch is imported once and the datasets of a domain pair
+are loaded once for all the methods trained on it. Logs and checkpoints are written to the ``--log``
+directory of every command, as when the commands are run one by one. Run it from the directory the job
+files expect, e.g. ``data/preprocessed/<experiment>``:
+
+    python run_methods.py train.run --test
+    python run_methods.py train.run -m dann mdd src_only
+"""
+import argparse
+import os.path as osp
+import runpy
+import shlex
+import sys
+import time
+import traceback
+
+SCRIPT_DIR = osp.dirname(osp.abspath(__file__))
+# arguments defining the datasets of a run, commands sharing them reuse the loaded datasets
+DATA_ARGS = ('--source-positive', '--source-negative', '--target-train', '--target-positive',
+             '--target-negative', '-c', '--ds-cache', '--packed')
+
+
+class KeepOpen:
+    """Standard stream the method loggers tee to, which is not closed with them"""
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    def close(self):
+        self.stream.flush()
+
+
+def read_commands(filenames, methods=None):
+    """``(method, argv)`` of the method script commands of the job files, grouped by domain pair"""
+    commands = []
+    for filename in filenames:
+        with open(filename) as f:
+            for line in f:
+                argv = shlex.split(line)
+                scripts = [i for i, arg in enumerate(argv) if arg.endswith('.py')]
+                if not scripts:
+                    continue
+                script = argv[scripts[0]]
+                method = osp.splitext(osp.basename(script))[0]
+                if methods is None or method in methods:
+                    commands.append((method, argv[scripts[0] + 1:]))
+    return sorted(commands, key=lambda command: data_key(command[1]))
+
+
+def data_key(argv):
+    parser = argparse.ArgumentParser(add_help=False)
+    for name in DATA_ARGS:
+        if name == '--packed':
+            parser.add_argument(name, action='store_true')
+        else:
+            parser.add_argument(name, dest=name.lstrip('-'))
+    known, _ = parser.parse_known_args(argv)
+    return tuple(str(value) for value in vars(known).values())
+
+
+def run_script(method, argv):
+    """Run a method script as ``python <method>.py <argv>`` would, returns whether it succeeded"""
+    script = osp.join(SCRIPT_DIR, method + '.py')
+    stdout, stderr, sys_argv = sys.stdout, sys.stderr, sys.argv
+    sys.argv = [script] + argv
+    try:
+        runpy.run_path(script, run_name='__main__')
+        return True
+    except SystemExit as e:
+        return not e.code
+    except Exception:
+        traceback.print_exc()
+        return False
+    finally:
+        # the loggers of the scripts redirect the standard streams to their log files
+        sys.stdout, sys.stderr, sys.argv = stdout, stderr, sys_argv
+        if 'torch._dynamo' in sys.modules:
+            # compiled graphs of the previous models are not reused and count towards the recompile limit
+            sys.modules['torch._dynamo'].reset()
+
+
+def main(args: argparse.Namespace):
+    commands = read_commands(args.job_files, args.methods)
+    phases = [[]] + ([['--phase', 'test']] if args.test else [])
+    print("{} commands, {} runs".format(len(commands), len(commands) * len(phases)))
+
+    summary = []
+    start = time.time()
+    for method, argv in commands:
+        for phase in phases:
+            print("=> {} {}".format(method, ' '.join(argv + phase)))
+            run_start = time.time()
+            ok = run_script(method, argv + phase)
+            summary.append((method, argv + phase, ok, time.time() - run_start))
+            print("=> {} in {:.1f} s".format('done' if ok else 'FAILED', summary[-1][-1]))
+
+    print("{:<10} {:<8} {:>10}  {}".format('method', 'status', 'time, s', 'log'))
+    for method, argv, ok, run_time in summary:
+        log = argv[argv.index('--log') + 1] if '--log' in argv else ''
+        phase = argv[argv.index('--phase') + 1] if '--phase' in argv else 'train'
+        print("{:<10} {:<8} {:>10.1f}  {} ({})".format(method, 'ok' if ok else 'FAILED', run_time, log, phase))
+    print("total time: {:.1f} s".format(time.time() - start))
+    if not all(ok for _, _, ok, _ in summary):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    # set before the loggers are imported, which tee to the stream they find at import
+    sys.stdout = KeepOpen(sys.stdout)
+    sys.stderr = KeepOpen(sys.stderr)
+    parser = argparse.ArgumentParser(description='Run several method scripts in a single process')
+    parser.add_argument('job_files', nargs='+', help='files with a method script command per line, e.g. train.run')
+    parser.add_argument('-m', '--methods', nargs='*', default=None,
+                        help='only run the commands of these methods (default: all)')
+    parser.add_argument('--test', action='store_true',
+                        help='run the test phase of every command after its training')
+    args = parser.parse_args()
+    main(args)
@@ -2,18 +2,27 @@
 @author: Junguang Jiang, Baixu Chen
 @contact: JiangJunguang1123@outlook.com, cbx_99_hasta@outlook.com
 """
+import bisect
+import fcntl
+import glob
+import hashlib
+import json
 import os
+import shutil
 import sys
+import tempfile
 import time
+import uuid
+import warnings
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
 
 import numpy as np
-import timm
 import torch
-import torch.nn as nn
 import torch.nn.functional as F
-from Bio import SeqIO
-from sklearn.model_selection import train_test_split
-from sklearn.metrics import precision_recall_curve, roc_curve, auc
+from torch.utils.data import DataLoader, BatchSampler, RandomSampler, SequentialSampler, default_collate
 from torch.utils.data.dataset import Dataset
 
 sys.path.append('../../..')
@@ -21,15 +30,17 @@ import models
 from tllib.utils.metric import accuracy, ConfusionMatrix
 from tllib.utils.meter import AverageMeter, ProgressMeter
 
-from tqdm.auto import tqdm
+# sklearn and tqdm are slow to import and only needed by some code paths, so they are imported where used
 
 
+@lru_cache(maxsize=None)
 def get_model_names():
+    # only the local models can be built by get_model
     return sorted(
         name for name in models.__dict__
         if name.islower() and not name.startswith("__")
         and callable(models.__dict__[name])
-    ) + timm.list_models()
+    )
 
 
 def get_model(model_name):
@@ -41,128 +52,757 @@ def get_model(model_name):
     return backbone
 
 
-def onehot_seq(seq, data, ind):
-    NUCS = "atgc"
+NUCS = "atgc"
+
+# byte -> one-hot row lookup table, so that a whole batch of sequences can be
+# encoded with a single ``np.take``; everything except a/t/g/c maps to zeros
+ONEHOT_LUT = np.zeros((256, len(NUCS)), dtype=np.int8)
+for _i, _nuc in enumerate(NUCS):
+    ONEHOT_LUT[ord(_nuc), _i] = 1
+    ONEHOT_LUT[ord(_nuc.upper()), _i] = 1
+
 
+def onehot_seq(seq, data, ind):
     seq = np.array(list(seq))
     for i, nuc in enumerate(NUCS):
         data[ind, seq == nuc, i] = 1
 
 
-def read_fasta(path: str):
-    with open(path) as f:
-        num_lines = sum(1 for line in f)
-
-    data = None
+def onehot_batch(seqs, out):
+    """Encode equal-length byte sequences into ``out`` of shape (len(seqs), L, 4)"""
+    buf = np.frombuffer(b"".join(seqs), dtype=np.uint8).reshape(len(seqs), -1)
+    np.take(ONEHOT_LUT, buf, axis=0, out=out, mode='clip')
+
+
+def iter_fasta(path: str, start=0, end=None):
+    """Yield the sequence (raw bytes) of every record whose header starts within ``[start, end)``"""
+    seq = None
+    pos = start
+    with open(path, 'rb') as f:
+        f.seek(start)
+        for line in f:
+            if line.startswith(b'>'):
+                if end is not None and pos >= end:
+                    break
+                if seq is not None:
+                    yield b"".join(seq)
+                seq = []
+            elif seq is not None:
+                seq.append(line.rstrip())
+            pos += len(line)
+    if seq is not None:
+        yield b"".join(seq)
+
+
+def fasta_shards(path: str, num_shards: int):
+    """Split a FASTA file into at most ``num_shards`` byte ranges aligned to record headers"""
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, 'rb') as f:
+        for i in range(1, num_shards):
+            pos = max(size * i // num_shards, bounds[-1] + 1)
+            f.seek(pos - 1)
+            tail = b""
+            while True:
+                block = f.read(1 << 16)
+                found = (tail + block).find(b"\n>")
+                if found >= 0 or not block:
+                    break
+                pos += len(block)
+                tail = block[-1:]
+            if found < 0:
+                break
+            bounds.append(pos - 1 - len(tail) + found + 1)
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if start < end]
+
+
+FastaStats = namedtuple('FastaStats', ['kept', 'wrong_length', 'ambiguous'])
+
+
+def fai_num_records(path: str, length: int):
+    """Number of records of the given length according to an up-to-date ``.fai`` index, None if there is none"""
+    fai_path = path + '.fai'
+    if not os.path.exists(fai_path) or os.path.getmtime(fai_path) < os.path.getmtime(path):
+        return None
+    with open(fai_path) as f:
+        return sum(1 for line in f if int(line.split('\t')[1]) == length)
+
+
+def encode_records(records, data, chunk_size=4096):
+    """
+    One-hot encode ``records`` into the head of ``data`` of shape (N, L, 4), skipping records that are
+    not of length L or contain ``n``. ``data`` is grown in place when it owns its memory and runs out of rows.
+    """
+    num_wrong_length = num_ambiguous = 0
     cur_ind = 0
-    for ind, record in tqdm(enumerate(SeqIO.parse(path, "fasta"))):
-        if data is None:
-            data = np.zeros((num_lines, len(record), 4), dtype=np.int8)
-        seq = record.seq.lower()
+    batch = []
+
+    def flush():
+        nonlocal cur_ind
+        if cur_ind + len(batch) > data.shape[0]:
+            data.resize((cur_ind + max(len(batch), chunk_size),) + data.shape[1:], refcheck=False)
+        onehot_batch(batch, data[cur_ind:cur_ind + len(batch)])
+        cur_ind += len(batch)
+        batch.clear()
+
+    for seq in records:
         if len(seq) != data.shape[1]:
+            num_wrong_length += 1
             continue
-        if "n" in seq:
+        if b"n" in seq or b"N" in seq:
+            num_ambiguous += 1
             continue
-        onehot_seq(seq, data, cur_ind)
-        cur_ind += 1
-    data = data[:cur_ind]
+        batch.append(seq)
+        if len(batch) == chunk_size:
+            flush()
+    if batch:
+        flush()
+    return FastaStats(cur_ind, num_wrong_length, num_ambiguous)
+
+
+def _encode_fasta_shard(path, start, end, out_path, out_shape, offset, capacity, chunk_size):
+    out = np.memmap(out_path, dtype=np.int8, mode='r+', shape=out_shape)
+    return encode_records(iter_fasta(path, start, end), out[offset:offset + capacity], chunk_size)
+
+
+def _read_fasta_parallel(path, length, shards, num_workers, chunk_size):
+    # every kept record takes at least length + 1 bytes of its shard, which bounds the rows a shard can produce
+    capacities = [(end - start) // (length + 1) for start, end in shards]
+    offsets = np.concatenate([[0], np.cumsum(capacities)[:-1]]).tolist()
+    out_shape = (sum(capacities), length, 4)
+
+    fd, out_path = tempfile.mkstemp(suffix='.onehot', dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+    try:
+        os.ftruncate(fd, max(int(np.prod(out_shape)), 1))
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            shard_stats = list(executor.map(_encode_fasta_shard, *zip(*[
+                (path, start, end, out_path, out_shape, offset, capacity, chunk_size)
+                for (start, end), offset, capacity in zip(shards, offsets, capacities)
+            ])))
+        out = np.memmap(out_path, dtype=np.int8, mode='r', shape=out_shape)
+        data = np.empty((sum(stats.kept for stats in shard_stats), length, 4), dtype=np.int8)
+        cur_ind = 0
+        for offset, stats in zip(offsets, shard_stats):
+            data[cur_ind:cur_ind + stats.kept] = out[offset:offset + stats.kept]
+            cur_ind += stats.kept
+        del out
+    finally:
+        os.close(fd)
+        os.remove(out_path)
+    return data, FastaStats(*map(sum, zip(*shard_stats)))
+
+
+def available_cores():
+    """Number of cores this process may run on, which the scheduler of the jobs may restrict"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count()
+
+
+def read_fasta(path: str, chunk_size=4096, return_stats=False, num_workers=None, min_shard_size=4 << 20):
+    """
+    One-hot encode every record of a FASTA file.
+
+    Records whose length differs from the first record, or which contain ``n``, are dropped.
+    Files larger than ``min_shard_size`` are split into record-aligned byte ranges which are encoded by
+    ``num_workers`` processes (all available cores by default) into shared memory and concatenated in file order.
+    Otherwise the file is read in a single pass; the output is sized from a ``.fai`` index when there is
+    one, or grown by ``chunk_size`` records at a time, so peak memory stays close to the size of the result.
+    """
+    first = next(iter_fasta(path), None)
+    if first is None:
+        data, stats = np.empty((0, 0, 4), dtype=np.int8), FastaStats(0, 0, 0)
+    else:
+        length = len(first)
+        num_workers = num_workers or available_cores()
+        shards = fasta_shards(path, min(num_workers, os.path.getsize(path) // min_shard_size))
+        if num_workers > 1 and len(shards) > 1:
+            data, stats = _read_fasta_parallel(path, length, shards, num_workers, chunk_size)
+        else:
+            capacity = fai_num_records(path, length)
+            data = np.empty((chunk_size if capacity is None else capacity, length, 4), dtype=np.int8)
+            from tqdm.auto import tqdm
+            stats = encode_records(tqdm(iter_fasta(path)), data, chunk_size)
+            data.resize((stats.kept, length, 4), refcheck=False)
+
+    print(f"{path}: {stats.kept} records, dropped {stats.wrong_length} of wrong length "
+          f"and {stats.ambiguous} containing 'n'")
+    if return_stats:
+        return data, stats
     return data
 
 
+def as_tensor(array, dtype=None):
+    """``torch.as_tensor`` that also shares the memory of read-only (memory-mapped) arrays"""
+    with warnings.catch_warnings():
+        warnings.filterwarnings('ignore', message='The given NumPy array is not writable')
+        return torch.as_tensor(array, dtype=dtype)
+
+
+def is_batch(index):
+    return isinstance(index, (list, tuple, np.ndarray, torch.Tensor)) and np.ndim(index) == 1
+
+
+def unlabelled(batch_size, device=None):
+    return torch.full((batch_size,), np.nan, dtype=torch.float64, device=device)
+
+
 class SeqDataset(Dataset):
-    def __init__(self, data, labels=None):
-        self.data = torch.tensor(data, dtype=torch.int8)
+    """
+    One-hot sequences of shape (N, L, 4) with optional labels. ``indices`` makes the dataset a view over
+    the given rows, so that several datasets (e.g. train and test split) can share the same arrays.
+
+    Indexing with a list of indices returns the whole collated batch at once, see :func:`get_data_loader`.
+    """
+    array_names = ('data', 'labels', 'indices')
+    attr_names = ()
+
+    def __init__(self, data, labels=None, indices=None):
+        self.data = as_tensor(data, dtype=torch.int8)
         self.labels = None
         if labels is not None:
-            self.labels = torch.tensor(labels, dtype=torch.int8)
+            self.labels = as_tensor(labels, dtype=torch.int8)
+        self.indices = None
+        if indices is not None:
+            self.indices = as_tensor(indices, dtype=torch.int64)
+
+    @classmethod
+    def from_arrays(cls, arrays, attrs=None):
+        dataset = cls.__new__(cls)
+        for name in cls.array_names:
+            setattr(dataset, name, arrays.get(name))
+        for name, value in (attrs or {}).items():
+            setattr(dataset, name, value)
+        return dataset
 
     def __getitem__(self, index):
+        if is_batch(index):
+            return self.get_batch(torch.as_tensor(index))
+        if self.indices is not None:
+            index = self.indices[index]
         if self.labels is not None:
             return self.data[index].float(), self.labels[index].long()
         else:
             return self.data[index].float(), np.nan
 
+    def get_batch(self, index):
+        # index_select is much faster than advanced indexing for int8 tensors
+        if self.indices is not None:
+            index = self.indices.index_select(0, index)
+        data = self.data.index_select(0, index).float()
+        if self.labels is not None:
+            return data, self.labels.index_select(0, index).long()
+        return data, unlabelled(len(index), index.device)
+
     def __len__(self):
+        if self.indices is not None:
+            return self.indices.shape[0]
         return self.data.shape[0]
 
+    def subset(self, indices):
+        """View of the given rows of this dataset sharing its arrays"""
+        arrays = {name: getattr(self, name) for name in self.array_names}
+        indices = as_tensor(indices, dtype=torch.int64)
+        arrays['indices'] = indices if self.indices is None else self.indices[indices]
+        return self.from_arrays(arrays, {attr: getattr(self, attr) for attr in self.attr_names})
+
+    def to(self, device):
+        """Copy of this dataset with its arrays moved to ``device``"""
+        arrays = {name: getattr(self, name) for name in self.array_names}
+        arrays = {name: array.to(device) for name, array in arrays.items() if array is not None}
+        return self.from_arrays(arrays, {attr: getattr(self, attr) for attr in self.attr_names})
+
+    collate_fn = staticmethod(default_collate)
+
+
+# byte -> 4 one-hot rows, and byte -> 8 mask bits (np.packbits order) lookup tables for PackedSeqDataset
+UNPACK_LUT = torch.eye(len(NUCS))[torch.arange(256)[:, None] >> torch.arange(0, 8, 2) & 3]
+UNPACK_BITS_LUT = (torch.arange(256)[:, None] >> torch.arange(7, -1, -1) & 1).bool()
+
+
+def pack_onehot(data, chunk_size=8192):
+    """
+    Pack one-hot sequences of shape (N, L, 4) into 2-bit codes of shape (N, ceil(L / 4)).
+    Positions without a nucleotide (ambiguous bases) are returned as bit masks of shape (M, ceil(L / 8))
+    for the M sequences that have any, together with the row of each sequence in the masks (-1 for none).
+    """
+    num, length = data.shape[:2]
+    packed = np.zeros((num, -(-length // 4)), dtype=np.uint8)
+    mask_index = np.full(num, -1, dtype=np.int64)
+    masks = []
+    for start in range(0, num, chunk_size):
+        chunk = data[start:start + chunk_size].astype(np.uint8)
+        codes = chunk[..., 1] + 2 * chunk[..., 2] + 3 * chunk[..., 3]
+        for shift in range(4):
+            packed[start:start + chunk_size, :(length - shift + 3) // 4] |= codes[:, shift::4] << (2 * shift)
+        ambiguous = chunk.sum(-1) == 0
+        rows = np.flatnonzero(ambiguous.any(1))
+        mask_index[start + rows] = np.arange(len(rows)) + sum(map(len, masks))
+        masks.append(np.packbits(ambiguous[rows], axis=1))
+    masks = np.concatenate(masks) if masks else np.zeros((0, -(-length // 8)), dtype=np.uint8)
+    return packed, masks, mask_index
+
+
+def unpack_onehot(packed, masks, length):
+    """Inverse of :func:`pack_onehot` for a batch, ``masks`` holds one (possibly all-zero) bit mask per sequence"""
+    data = UNPACK_LUT.to(packed.device)[packed.long()].flatten(1, 2)[:, :length]
+    if masks.any():
+        ambiguous = UNPACK_BITS_LUT.to(masks.device)[masks.long()].flatten(1)[:, :length]
+        data.masked_fill_(ambiguous.unsqueeze(-1), 0)
+    return data
 
-def get_train_datasets(source_positive: str, source_random: str, target_train_random: str,
-                       dataset_name=None, cache_dir=None, trim_random=True, train_size=0.8, random_state=42):
-    if not os.path.exists(cache_dir):
-        os.mkdir(cache_dir)
-    if dataset_name:
-        if dataset_name in os.listdir(cache_dir):
-            path = os.path.join(cache_dir, dataset_name)
-            src_train_dataset = torch.load(os.path.join(path, 'src_train_dataset'))
-            tgt_train_dataset = torch.load(os.path.join(path, 'tgt_train_dataset'))
-            src_test_dataset = torch.load(os.path.join(path, 'src_test_dataset'))
-            return src_train_dataset, tgt_train_dataset, src_test_dataset
-
-    src_pos = read_fasta(source_positive)
-    src_random = read_fasta(source_random)
-    if trim_random:
-        src_random = src_random[:src_pos.shape[0]]
-    src_data = np.concatenate([src_pos, src_random], axis=0)
-    src_labels = np.concatenate([
-        np.ones(src_pos.shape[0]),
-        np.zeros(src_random.shape[0])
-    ], axis=0)
-    src_data_train, src_data_test, src_lbl_train, src_lbl_test = train_test_split(src_data, src_labels,
-                                                                                  train_size=train_size, shuffle=True,
-                                                                                  random_state=random_state)
-    src_train_dataset = SeqDataset(src_data_train, src_lbl_train)
-    src_test_dataset = SeqDataset(src_data_test, src_lbl_test)
-
-    tgt_train_rnd = read_fasta(target_train_random)
-    tgt_train_rnd = tgt_train_rnd[:src_data.shape[0]]
-    tgt_train_dataset = SeqDataset(tgt_train_rnd)
-
-    if dataset_name:
-        path = os.path.join(cache_dir, dataset_name)
-        if dataset_name not in os.listdir(cache_dir):
-            os.mkdir(path)
-        torch.save(src_train_dataset, os.path.join(path, 'src_train_dataset'))
-        torch.save(tgt_train_dataset, os.path.join(path, 'tgt_train_dataset'))
-        torch.save(src_test_dataset, os.path.join(path, 'src_test_dataset'))
 
-    return src_train_dataset, tgt_train_dataset, src_test_dataset
+class PackedSeqDataset(SeqDataset):
+    """
+    Drop-in alternative to :class:`SeqDataset` storing 4 nucleotides per byte. Single items stay packed and are
+    expanded to float one-hot by :meth:`collate_fn`, batches of indices are expanded right away.
+    """
+
+    array_names = SeqDataset.array_names + ('masks', 'mask_index')
+    attr_names = ('length',)
+
+    def __init__(self, data, labels=None, indices=None):
+        self.length = data.shape[1]
+        packed, masks, mask_index = pack_onehot(data)
+        self.data = torch.from_numpy(packed)
+        # the last row is the all-zero mask shared by sequences without ambiguous bases
+        self.masks = torch.from_numpy(np.concatenate([masks, np.zeros_like(masks, shape=(1, masks.shape[1]))]))
+        self.mask_index = torch.from_numpy(mask_index)
+        self.labels = None
+        if labels is not None:
+            self.labels = as_tensor(labels, dtype=torch.int8)
+        self.indices = None
+        if indices is not None:
+            self.indices = as_tensor(indices, dtype=torch.int64)
+
+    def __getitem__(self, index):
+        if is_batch(index):
+            return self.get_batch(torch.as_tensor(index))
+        if self.indices is not None:
+            index = self.indices[index]
+        item = self.data[index], self.masks[self.mask_index[index]]
+        if self.labels is not None:
+            return item + (self.labels[index].long(),)
+        else:
+            return item + (np.nan,)
+
+    def get_batch(self, index):
+        if self.indices is not None:
+            index = self.indices.index_select(0, index)
+        # -1 selects the trailing all-zero mask
+        mask_index = self.mask_index.index_select(0, index).remainder(self.masks.shape[0])
+        masks = self.masks.index_select(0, mask_index)
+        data = unpack_onehot(self.data.index_select(0, index), masks, self.length)
+        if self.labels is not None:
+            return data, self.labels.index_select(0, index).long()
+        return data, unlabelled(len(index), index.device)
+
+    def collate_fn(self, batch):
+        packed, masks, labels = zip(*batch)
+        return unpack_onehot(torch.stack(packed), torch.stack(masks), self.length), default_collate(labels)
 
 
-def get_test_dataset(target_pos: str, target_random: str, dataset_name=None, cache_dir=None,
-                     trim_random=True):
-    if not os.path.exists(cache_dir):
-        os.mkdir(cache_dir)
-    if dataset_name:
-        if dataset_name in os.listdir(cache_dir):
-            path = os.path.join(cache_dir, dataset_name)
-            tgt_test_dataset = torch.load(os.path.join(path, 'tgt_test_dataset'))
-            return tgt_test_dataset
+class ConcatSeqDataset(Dataset):
+    """
+    View over the concatenation of several unlabelled datasets of the same type, optionally labelled and
+    restricted to ``indices``, which does not copy their arrays
+    """
 
-    tgt_pos = read_fasta(target_pos)
-    tgt_random = read_fasta(target_random)
+    def __init__(self, datasets, labels=None, indices=None):
+        self.datasets = list(datasets)
+        self.offsets = np.cumsum([0] + [len(dataset) for dataset in self.datasets]).tolist()
+        self.labels = None
+        if labels is not None:
+            self.labels = as_tensor(labels, dtype=torch.int8)
+        self.indices = None
+        if indices is not None:
+            self.indices = as_tensor(indices, dtype=torch.int64)
+
+    def __getitem__(self, index):
+        if is_batch(index):
+            return self.get_batch(torch.as_tensor(index))
+        if self.indices is not None:
+            index = self.indices[index]
+        index = int(index)
+        k = bisect.bisect_right(self.offsets, index) - 1
+        item = self.datasets[k][index - self.offsets[k]]
+        if self.labels is not None:
+            return item[:-1] + (self.labels[index].long(),)
+        return item
+
+    def get_batch(self, index):
+        if self.indices is not None:
+            index = self.indices.index_select(0, index)
+        offsets = torch.tensor(self.offsets, device=index.device)
+        sources = torch.searchsorted(offsets, index, right=True) - 1
+        if (sources == sources[0]).all():
+            k = int(sources[0])
+            data, labels = self.datasets[k].get_batch(index - self.offsets[k])
+        else:
+            data = labels = None
+            for k in sources.unique().tolist():
+                rows = (sources == k).nonzero().squeeze(1)
+                x, y = self.datasets[k].get_batch(index.index_select(0, rows) - self.offsets[k])
+                if data is None:
+                    data = x.new_empty((len(index),) + x.shape[1:])
+                    labels = y.new_empty(len(index))
+                data.index_copy_(0, rows, x)
+                labels.index_copy_(0, rows, y)
+        if self.labels is not None:
+            labels = self.labels.index_select(0, index).long()
+        return data, labels
+
+    def __len__(self):
+        if self.indices is not None:
+            return self.indices.shape[0]
+        return self.offsets[-1]
+
+    def subset(self, indices):
+        """View of the given rows of this dataset"""
+        indices = as_tensor(indices, dtype=torch.int64)
+        return ConcatSeqDataset(self.datasets, self.labels, indices if self.indices is None else self.indices[indices])
+
+    def to(self, device):
+        """Copy of this dataset with its arrays moved to ``device``"""
+        return ConcatSeqDataset([dataset.to(device) for dataset in self.datasets],
+                                None if self.labels is None else self.labels.to(device),
+                                None if self.indices is None else self.indices.to(device))
+
+    @property
+    def collate_fn(self):
+        return self.datasets[0].collate_fn
+
+
+class IndexedDataset(Dataset):
+    """View of a dataset whose items and batches end with their indices in it, e.g. to look up per-sample data"""
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __getitem__(self, index):
+        if is_batch(index):
+            return self.get_batch(torch.as_tensor(index))
+        return tuple(self.dataset[index]) + (index,)
+
+    def get_batch(self, index):
+        return tuple(self.dataset.get_batch(index)) + (index,)
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def to(self, device):
+        """Copy of this dataset with its arrays moved to ``device``"""
+        return IndexedDataset(self.dataset.to(device))
+
+    @property
+    def collate_fn(self):
+        return self.dataset.collate_fn
+
+
+def get_data_loader(dataset, batch_size, shuffle=False, num_workers=0, drop_last=False):
+    """
+    Data loader fetching every batch with a single indexing call: the batch sampler passes the list of
+    indices of a batch to the dataset, which gathers and converts the whole batch at once.
+    """
+    sampler = ResumableRandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+    return DataLoader(dataset, sampler=BatchSampler(sampler, batch_size, drop_last), batch_size=None,
+                      num_workers=num_workers)
+
+
+class ResumableRandomSampler(RandomSampler):
+    """
+    ``RandomSampler`` which can restart in the middle of a permutation. Like ``RandomSampler``, every pass
+    draws the seed of its permutation from the global torch generator, unless :meth:`resume` gave it the seed
+    and the position of an interrupted pass.
+    """
+
+    def __init__(self, data_source):
+        super().__init__(data_source)
+        self.seed = None
+        self.start = None
+
+    def resume(self, seed, start):
+        self.seed, self.start = seed, start
+
+    def __iter__(self):
+        start, self.start = self.start, None
+        if start is None:
+            self.seed = int(torch.empty((), dtype=torch.int64).random_().item())
+            start = 0
+        generator = torch.Generator()
+        generator.manual_seed(self.seed)
+        yield from torch.randperm(len(self.data_source), generator=generator).tolist()[start:]
+
+
+class ForeverDataIterator:
+    """
+    ``tllib.utils.data.ForeverDataIterator`` over a shuffled data loader of :func:`get_data_loader`, whose
+    position can be saved with :meth:`state_dict` and restored with :meth:`load_state_dict`.
+    """
+
+    def __init__(self, data_loader):
+        self.data_loader = data_loader
+        self.iter = iter(self.data_loader)
+        self.pos = 0
+
+    def __next__(self):
+        try:
+            data = next(self.iter)
+        except StopIteration:
+            self.iter = iter(self.data_loader)
+            self.pos = 0
+            data = next(self.iter)
+        self.pos += 1
+        return data
+
+    def __iter__(self):
+        return self
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    def state_dict(self):
+        return {'seed': self.data_loader.sampler.sampler.seed, 'pos': self.pos}
+
+    def load_state_dict(self, state_dict):
+        batch_sampler = self.data_loader.sampler
+        if state_dict['seed'] is not None:
+            batch_sampler.sampler.resume(state_dict['seed'], state_dict['pos'] * batch_sampler.batch_size)
+        # start a new pass, the one started before resuming is dropped with its prefetched batches
+        self.iter = iter(self.data_loader)
+        self.pos = state_dict['pos']
+
+
+class DeviceDataIterator:
+    """
+    In-process alternative to :class:`ForeverDataIterator` over a shuffled data loader dropping the last batch.
+    The dataset is moved to ``device`` once and every batch is gathered there from a permutation drawn on
+    the device, so no worker processes are started and the batches need no copy to the device.
+    """
+
+    def __init__(self, dataset, batch_size, device):
+        self.dataset = dataset.to(device)
+        self.batch_size = batch_size
+        self.device = device
+        self.permutation = None
+        self.pos = 0
+
+    def __next__(self):
+        if self.permutation is None or self.pos + self.batch_size > len(self.permutation):
+            self.permutation = torch.randperm(len(self.dataset), device=self.device)
+            self.pos = 0
+        index = self.permutation[self.pos:self.pos + self.batch_size]
+        self.pos += self.batch_size
+        return self.dataset.get_batch(index)
+
+    def __iter__(self):
+        return self
+
+    def __len__(self):
+        return len(self.dataset) // self.batch_size
+
+    def state_dict(self):
+        return {'permutation': None if self.permutation is None else self.permutation.cpu(), 'pos': self.pos}
+
+    def load_state_dict(self, state_dict):
+        permutation = state_dict['permutation']
+        self.permutation = None if permutation is None else permutation.to(self.device)
+        self.pos = state_dict['pos']
+
+
+DATASET_TYPES = {cls.__name__: cls for cls in (SeqDataset, PackedSeqDataset)}
+
+
+def save_datasets(path: str, **datasets):
+    """
+    Save datasets as one ``.npy`` file per array plus a ``manifest.json`` describing the arrays (file, shape,
+    dtype) and which arrays and attributes make up every dataset. Arrays shared between datasets are saved once.
+    """
+    os.makedirs(path, exist_ok=True)
+    manifest = {'format': 1, 'arrays': {}, 'datasets': {}}
+    saved = {}
+    for name, dataset in datasets.items():
+        refs = {}
+        for array_name in dataset.array_names:
+            tensor = getattr(dataset, array_name)
+            if tensor is None:
+                continue
+            if id(tensor) not in saved:
+                key = f"{name}.{array_name}"
+                array = tensor.numpy()
+                np.save(os.path.join(path, key + '.npy'), array)
+                manifest['arrays'][key] = {'file': key + '.npy', 'shape': list(array.shape), 'dtype': array.dtype.str}
+                saved[id(tensor)] = key
+            refs[array_name] = saved[id(tensor)]
+        manifest['datasets'][name] = {
+            'type': type(dataset).__name__,
+            'arrays': refs,
+            'attrs': {attr: getattr(dataset, attr) for attr in dataset.attr_names},
+        }
+    with open(os.path.join(path, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+
+def load_datasets(path: str):
+    """
+    Open datasets written by :func:`save_datasets`. Arrays are memory-mapped read-only, so loading takes no
+    time regardless of their size and processes using the same cache share it through the page cache.
+    """
+    with open(os.path.join(path, 'manifest.json')) as f:
+        manifest = json.load(f)
+    arrays = {}
+    for key, spec in manifest['arrays'].items():
+        array = np.load(os.path.join(path, spec['file']), mmap_mode='r')
+        if list(array.shape) != spec['shape'] or array.dtype.str != spec['dtype']:
+            raise ValueError(f"{spec['file']} in {path} does not match its manifest")
+        arrays[key] = as_tensor(array)
+    return {
+        name: DATASET_TYPES[spec['type']].from_arrays(
+            {array_name: arrays[key] for array_name, key in spec['arrays'].items()}, spec['attrs'])
+        for name, spec in manifest['datasets'].items()
+    }
+
+
+# bump when the encoding of cached FASTA files changes
+FASTA_CACHE_VERSION = 1
+
+
+def fasta_cache_key(path: str, **params):
+    """Key of the encoding of a FASTA file with the given parameters, changes whenever the file is modified"""
+    stat = os.stat(path)
+    key = [os.path.realpath(path), stat.st_size, stat.st_mtime_ns, FASTA_CACHE_VERSION, sorted(params.items())]
+    return hashlib.sha1(json.dumps(key).encode()).hexdigest()[:16]
+
+
+@contextmanager
+def file_lock(path: str):
+    """Exclusive advisory lock on ``path``, shared by all processes on the host (and on NFS with lockd)"""
+    with open(path, 'a') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            print(f"Waiting for the lock on {path}")
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def get_fasta_dataset(path: str, cache_dir=None, num_workers=None, packed=False):
+    """
+    Unlabelled dataset of all records of a FASTA file. With ``cache_dir`` every file is encoded only once,
+    into ``cache_dir/fasta/<file name>.<key>``, and is memory-mapped from there afterwards.
+
+    Concurrent jobs are safe: the entry is built by a single job holding ``<entry>.lock`` while the others
+    wait for it, and it is written to a temporary directory which is renamed into place once complete.
+    """
+    dataset_cls = PackedSeqDataset if packed else SeqDataset
+    if cache_dir is None:
+        return dataset_cls(read_fasta(path, num_workers=num_workers))
+
+    entry = os.path.join(cache_dir, 'fasta', f"{os.path.basename(path)}.{fasta_cache_key(path, packed=packed)}")
+    if not os.path.exists(os.path.join(entry, 'manifest.json')):
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        with file_lock(entry + '.lock'):
+            if not os.path.exists(os.path.join(entry, 'manifest.json')):
+                # whatever is left here was written by jobs that died while holding the lock
+                for stale in glob.glob(glob.escape(entry) + '.tmp-*') + glob.glob(glob.escape(entry)):
+                    shutil.rmtree(stale, ignore_errors=True)
+                tmp = f"{entry}.tmp-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+                try:
+                    save_datasets(tmp, fasta=dataset_cls(read_fasta(path, num_workers=num_workers)))
+                    os.rename(tmp, entry)
+                finally:
+                    shutil.rmtree(tmp, ignore_errors=True)
+    return load_datasets(entry)['fasta']
+
+
+def labelled_dataset(positive, random, trim_random=True):
+    """Positives labelled 1 followed by (at most as many, if ``trim_random``) randoms labelled 0"""
     if trim_random:
-        tgt_random = tgt_random[:tgt_pos.shape[0]]
-    src_data = np.concatenate([tgt_pos, tgt_random], axis=0)
-    src_labels = np.concatenate([
-        np.ones(tgt_pos.shape[0]),
-        np.zeros(tgt_random.shape[0])
-    ], axis=0)
+        random = random.subset(np.arange(min(len(random), len(positive))))
+    labels = np.concatenate([np.ones(len(positive)), np.zeros(len(random))])
+    return ConcatSeqDataset([positive, random], labels)
 
-    tgt_test_dataset = SeqDataset(src_data, src_labels)
 
-    if dataset_name:
-        path = os.path.join(cache_dir, dataset_name)
-        if dataset_name not in os.listdir(cache_dir):
-            os.mkdir(path)
-        torch.save(tgt_test_dataset, os.path.join(path, 'tgt_test_dataset'))
+def get_train_datasets(source_positive: str, source_random: str, target_train_random: str,
+                       cache_dir=None, trim_random=True, train_size=0.8, random_state=42,
+                       num_workers=None, packed=False):
+    src_dataset = labelled_dataset(get_fasta_dataset(source_positive, cache_dir, num_workers, packed),
+                                   get_fasta_dataset(source_random, cache_dir, num_workers, packed),
+                                   trim_random)
+    from sklearn.model_selection import train_test_split
+    src_ind_train, src_ind_test = train_test_split(np.arange(len(src_dataset)), train_size=train_size,
+                                                   shuffle=True, random_state=random_state)
+    src_train_dataset = src_dataset.subset(src_ind_train)
+    src_test_dataset = src_dataset.subset(src_ind_test)
+
+    tgt_train_dataset = get_fasta_dataset(target_train_random, cache_dir, num_workers, packed)
+    tgt_train_dataset = tgt_train_dataset.subset(np.arange(min(len(tgt_train_dataset), len(src_dataset))))
+
+    return src_train_dataset, tgt_train_dataset, src_test_dataset
 
-    return tgt_test_dataset
+
+def stratified_subset(dataset, size, random_state=42):
+    """Fixed subset of ``size`` rows of a labelled dataset, with the class proportions of the whole dataset"""
+    if size >= len(dataset):
+        return dataset
+    labels = dataset.labels if dataset.indices is None else dataset.labels[dataset.indices]
+    from sklearn.model_selection import train_test_split
+    indices, _ = train_test_split(np.arange(len(dataset)), train_size=size, shuffle=True,
+                                  random_state=random_state, stratify=labels.numpy())
+    return dataset.subset(np.sort(indices))
+
+
+def get_test_dataset(target_pos: str, target_random: str, cache_dir=None, trim_random=True,
+                     num_workers=None, packed=False):
+    return labelled_dataset(get_fasta_dataset(target_pos, cache_dir, num_workers, packed),
+                            get_fasta_dataset(target_random, cache_dir, num_workers, packed),
+                            trim_random)
+
+
+class DeviceAverageMeter(AverageMeter):
+    """
+    :class:`AverageMeter` of tensor values, which are accumulated on their device and read back only when the
+    meter is displayed or synchronized, so that updating it does not wait for the device. The sums are kept in
+    float64 like the Python floats of :class:`AverageMeter`, which gives the same averages. The weights ``n`` may
+    be tensors too, e.g. a number of selected samples, whose count is then also kept on the device.
+    """
+
+    def update(self, val, n=1):
+        if torch.is_tensor(val):
+            val = val.detach().double()
+        if torch.is_tensor(n):
+            n = n.detach().double()
+        self.val = val
+        self.sum = self.sum + val * n
+        self.count = self.count + n
+        if torch.is_tensor(self.count) or self.count > 0:
+            self.avg = self.sum / self.count
+
+    def synchronize(self):
+        """Read the current value, the sum and the count back from the device"""
+        if torch.is_tensor(self.sum):
+            values = [self.val, self.sum] + ([self.count] if torch.is_tensor(self.count) else [])
+            values = torch.stack([torch.as_tensor(value, dtype=torch.float64, device=self.sum.device)
+                                  for value in values]).tolist()
+            self.val, self.sum = values[:2]
+            if len(values) > 2:
+                self.count = values[2]
+            self.avg = self.sum / self.count if self.count > 0 else 0.
+
+    def __str__(self):
+        self.synchronize()
+        return super().__str__()
 
 
 def validate(val_loader, model, args, device, calc_auc=False) -> float:
     batch_time = AverageMeter('Time', ':6.3f')
-    losses = AverageMeter('Loss', ':.4e')
-    top1 = AverageMeter('Acc@1', ':6.2f')
+    losses = DeviceAverageMeter('Loss', ':.4e')
+    top1 = DeviceAverageMeter('Acc@1', ':6.2f')
     progress = ProgressMeter(
         len(val_loader),
         [batch_time, losses, top1],
@@ -197,8 +837,8 @@ def validate(val_loader, model, args, device, calc_auc=False) -> float:
             acc1, = accuracy(output, target, topk=(1,))
             if confmat:
                 confmat.update(target, output.argmax(1))
-            losses.update(loss.item(), images.size(0))
-            top1.update(acc1.item(), images.size(0))
+            losses.update(loss, images.size(0))
+            top1.update(acc1, images.size(0))
 
             # measure elapsed time
             batch_time.update(time.time() - end)
@@ -207,11 +847,13 @@ def validate(val_loader, model, args, device, calc_auc=False) -> float:
             if i % args.print_freq == 0:
                 progress.display(i)
 
+        top1.synchronize()
         print(' * Acc@1 {top1.avg:.3f}'.format(top1=top1))
         if confmat:
             print(confmat.format(args.class_names))
 
     if calc_auc:
+        from sklearn.metrics import precision_recall_curve, roc_curve, auc
         y_preds = torch.cat(y_preds).cpu().numpy()[:, 1]
         y_true = torch.cat(y_true).cpu().numpy()
         precision, recall, thresholds = precision_recall_curve(y_true, y_preds)
@@ -225,49 +867,41 @@ def validate(val_loader, model, args, device, calc_auc=False) -> float:
     return top1.avg
 
 
-def empirical_risk_minimization(train_source_iter, model, optimizer, lr_scheduler, epoch, args, device):
-    batch_time = AverageMeter('Time', ':3.1f')
-    data_time = AverageMeter('Data', ':3.1f')
-    losses = AverageMeter('Loss', ':3.2f')
-    cls_accs = AverageMeter('Cls Acc', ':3.1f')
-
-    progress = ProgressMeter(
-        args.iters_per_epoch,
-        [batch_time, data_time, losses, cls_accs],
-        prefix="Epoch: [{}]".format(epoch))
-
-    # switch to train mode
-    model.train()
-
-    end = time.time()
-    for i in range(args.iters_per_epoch):
-        x_s, labels_s = next(train_source_iter)[:2]
-        x_s = x_s.to(device)
-        labels_s = labels_s.to(device)
-
-        # measure data loading time
-        data_time.update(time.time() - end)
-
-        # compute output
-        y_s, f_s = model(x_s)
-
-        cls_loss = F.cross_entropy(y_s, labels_s)
-        loss = cls_loss
-
-        cls_acc = accuracy(y_s, labels_s)[0]
-
-        losses.update(loss.item(), x_s.size(0))
-        cls_accs.update(cls_acc.item(), x_s.size(0))
-
-        # compute gradient and do SGD step
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
-        lr_scheduler.step()
-
-        # measure elapsed time
-        batch_time.update(time.time() - end)
-        end = time.time()
+def autocast(device, enabled=True):
+    """
+    bfloat16 autocast for the forward passes of the ``--amp`` mode. The outputs are cast back with ``.float()``
+    so that the losses, including the discrepancy terms, are computed in fp32.
+    """
+    return torch.autocast(device.type, dtype=torch.bfloat16, enabled=enabled)
+
+
+COMPILED_PARTS = ('backbone', 'bottleneck', 'head', 'adv_head')
+
+
+def compile_modules(enabled, *modules):
+    """
+    Compile the forward of ``modules`` in place for the ``--compile`` mode. Classifiers are compiled part by part
+    (see ``COMPILED_PARTS``), so that the Python-side state of e.g. gradient reverse layers, which changes every
+    iteration, stays out of the graphs. Without a working torch.compile, or when a graph fails to compile, the
+    modules simply run eagerly.
+    """
+    if not enabled:
+        return
+    try:
+        import torch._dynamo
+        torch._dynamo.config.suppress_errors = True
+    except ImportError as e:
+        warnings.warn(f"torch.compile is not available, running eagerly: {e}")
+        return
+    for module in modules:
+        parts = [getattr(module, name) for name in COMPILED_PARTS
+                 if isinstance(getattr(module, name, None), torch.nn.Module)]
+        for part in parts or [module]:
+            # modules sharing a backbone, e.g. the pretrained and the final classifier, compile it once
+            if getattr(part, '_compiled_call_impl', None) is not None:
+                continue
+            try:
+                part.compile()
+            except Exception as e:
+                warnings.warn(f"could not compile {type(part).__name__}, running it eagerly: {e}")
 
-        if i % args.print_freq == 0:
-            progress.display(i)